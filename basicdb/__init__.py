@@ -1,22 +1,40 @@
 import falcon
 import importlib
 import os
+import threading
 import time
 import urllib
-import uuid
-import xml.etree.cElementTree as etree
 
+from basicdb import responses
 from basicdb import utils
 import basicdb.exceptions
 
 global backend
 backend = None
 
-def load_backend(name):
+def load_backend(name, cache_size=None):
+    """Load the named backend, with an item cache of cache_size bytes
+    (default: $BASICDB_BACKEND_CACHE_SIZE) in front of it unless that is 0"""
     global backend
     backend = importlib.import_module('basicdb.backends.%s' % (name,)).driver()
-
-load_backend(os.environ.get('BASICDB_BACKEND_DRIVER', 'fake'))
+    if cache_size is None:
+        cache_size = int(os.environ.get('BASICDB_BACKEND_CACHE_SIZE', '0'))
+    if cache_size:
+        caching = importlib.import_module('basicdb.backends.caching')
+        backend = caching.CachingBackend(backend, cache_size)
+
+_backend_lock = threading.Lock()
+
+def get_backend():
+    """The backend, loaded from $BASICDB_BACKEND_DRIVER (default: fake) on
+    first use unless load_backend() was called already. This happens in
+    the process that serves requests, so a server can import this module
+    before forking its workers."""
+    if backend is None:
+        with _backend_lock:
+            if backend is None:
+                load_backend(os.environ.get('BASICDB_BACKEND_DRIVER', 'fake'))
+    return backend
 
 class AllAttributes(object):
     pass
@@ -24,12 +42,12 @@ class AllAttributes(object):
 class DomainResource(object):
     def on_get(self, req, resp):
         start_time = time.time()
+        request_id = responses.request_id()
 
-        metadata = etree.Element("ResponseMetadata")
-        etree.SubElement(metadata, "RequestId").text = str(uuid.uuid4())
-
+        backend = get_backend()
         owner = os.environ['REMOTE_USER']
 
+        result = ''
         action = req.get_param("Action")
         if action == "CreateDomain":
             domain_name = req.get_param("DomainName")
@@ -37,119 +55,99 @@ class DomainResource(object):
             backend.create_domain(owner, domain_name)
 
             resp.status = falcon.HTTP_200  # This is the default status
-            dom = etree.Element("CreateDomainResponse")
+            root = "CreateDomainResponse"
         elif action == "DeleteDomain":
             domain_name = req.get_param("DomainName")
 
             backend.delete_domain(owner, domain_name)
 
             resp.status = falcon.HTTP_200  # This is the default status
-            dom = etree.Element("DeleteDomainResponse")
+            root = "DeleteDomainResponse"
         elif action == "ListDomains":
             resp.status = falcon.HTTP_200
-            dom = etree.Element("ListDomainsResponse")
-
-            result = etree.SubElement(dom, "ListDomainsResult")
-            for name in backend.list_domains(owner):
-                domain_name = etree.SubElement(result, "DomainName")
-                domain_name.text = name
+            root = "ListDomainsResponse"
+            result = responses.domain_names_xml(backend.list_domains(owner))
         elif action == "DeleteAttributes":
             domain_name = req.get_param("DomainName")
             item_name = req.get_param("ItemName")
 
-            deletions = utils.extract_deletions_from_query_params(req)
-            expectations = utils.extract_expectations_from_query_params(req)
+            params = utils.decode_params(req._params, deletions=True)
 
-            backend.delete_attributes(owner, domain_name, item_name, deletions)
+            backend.delete_attributes(owner, domain_name, item_name, params.deletions)
 
             resp.status = falcon.HTTP_200
-            dom = etree.Element("DeleteAttributesResponse")
+            root = "DeleteAttributesResponse"
         elif action == "PutAttributes":
             domain_name = req.get_param("DomainName")
             item_name = req.get_param("ItemName")
 
-            additions, replacements = utils.extract_additions_and_replacements_from_query_params(req)
-            expectations = utils.extract_expectations_from_query_params(req)
+            params = utils.decode_params(req._params)
 
             try:
-                backend.put_attributes(owner, domain_name, item_name, additions,
-                                       replacements, expectations)
+                backend.put_attributes(owner, domain_name, item_name, params.additions,
+                                       params.replacements, params.expectations)
                 resp.status = falcon.HTTP_200
-                dom = etree.Element("PutAttributesResponse")
+                root = "PutAttributesResponse"
             except basicdb.exceptions.APIException, e:
                 resp.status = e.http_status
-                dom = etree.Element(e.root_element)
+                root = e.root_element
 
         elif action == "BatchDeleteAttributes":
             domain_name = req.get_param("DomainName")
 
-            deletions = utils.extract_batch_deletions_from_query_params(req)
+            params = utils.decode_params(req._params, deletions=True, batch=True)
 
             try:
-                backend.batch_delete_attributes(owner, domain_name, deletions)
+                backend.batch_delete_attributes(owner, domain_name, params.deletions)
                 resp.status = falcon.HTTP_200
-                dom = etree.Element("BatchDeleteAttributesResponse")
+                root = "BatchDeleteAttributesResponse"
             except basicdb.exceptions.APIException, e:
                 resp.status = e.http_status
-                dom = etree.Element(e.root_element)
+                root = e.root_element
 
         elif action == "BatchPutAttributes":
             domain_name = req.get_param("DomainName")
 
-            additions, replacements = utils.extract_batch_additions_and_replacements_from_query_params(req)
+            params = utils.decode_params(req._params, batch=True)
 
             try:
-                backend.batch_put_attributes(owner, domain_name, additions, replacements)
+                backend.batch_put_attributes(owner, domain_name, params.additions,
+                                             params.replacements)
                 resp.status = falcon.HTTP_200
-                dom = etree.Element("BatchPutAttributesResponse")
+                root = "BatchPutAttributesResponse"
             except basicdb.exceptions.APIException, e:
                 resp.status = e.http_status
-                dom = etree.Element(e.root_element)
+                root = e.root_element
 
         elif action == "Select":
             sql_expr = urllib.unquote(req.get_param('SelectExpression'))
-            order, results = backend.select_wrapper(owner, sql_expr)
+            items = backend.select_items(owner, sql_expr)
 
             resp.status = falcon.HTTP_200
-            dom = etree.Element("SelectResponse")
-            result = etree.SubElement(dom, "SelectResult")
-
-            for item_name in order:
-                item_elem = etree.SubElement(result, "Item")
-                etree.SubElement(item_elem, "Name").text = item_name
-                for attr_name, attr_values in results[item_name].iteritems():
-                    for attr_value in attr_values:
-                        attr_elem = etree.SubElement(item_elem, "Attribute")
-                        etree.SubElement(attr_elem, "Name").text = attr_name
-                        etree.SubElement(attr_elem, "Value").text = attr_value
+            resp.stream = responses.stream("SelectResponse", responses.items_xml(items),
+                                           request_id, start_time)
+            return
         elif action == "DomainMetadata":
             domain_name = req.get_param("DomainName")
             resp.status = falcon.HTTP_200
-            dom = etree.Element("DomainMetadataResponse")
-            result = etree.SubElement(dom, "DomainMetadataResult")
-            for k, v in backend.domain_metadata(owner, domain_name).iteritems():
-                etree.SubElement(result, k).text = str(v)
+            root = "DomainMetadataResponse"
+            result = responses.domain_metadata_xml(backend.domain_metadata(owner, domain_name))
         elif action == "GetAttributes":
             domain_name = req.get_param("DomainName")
             item_name = req.get_param("ItemName")
+            item_attrs = backend.get_attributes(owner, domain_name, item_name)
+
             resp.status = falcon.HTTP_200
-            dom = etree.Element("GetAttributesResponse")
-            result = etree.SubElement(dom, "GetAttributesResult")
-
-            for attr_name, attr_values in backend.get_attributes(owner, domain_name, item_name).iteritems():
-                for attr_value in attr_values:
-                    attr_elem = etree.SubElement(result, "Attribute")
-                    etree.SubElement(attr_elem, "Name").text = attr_name
-                    etree.SubElement(attr_elem, "Value").text = attr_value
+            resp.stream = responses.stream("GetAttributesResponse",
+                                           responses.iter_attributes_xml(item_attrs),
+                                           request_id, start_time)
+            return
         else:
             resp.status = falcon.HTTP_500
-            dom = etree.Element("UnknownCommand")
+            root = "UnknownCommand"
             print "Unknown action: %s" % (action,)
 
-        time_spent = time.time() - start_time
-        etree.SubElement(metadata, "BoxUsage").text = str(time_spent)
-        dom.append(metadata)
-        resp.body = etree.tostring(dom)
+        resp.body = responses.encode(root, result, request_id, time.time() - start_time)
 
     on_post = on_get
 
@@ -0,0 +1,443 @@
+import argparse
+import asyncore
+import collections
+import errno
+import fcntl
+import os
+import Queue
+import resource
+import socket
+import StringIO
+import sys
+import threading
+import time
+import traceback
+import urllib
+
+from basicdb.server import ResponseFraming
+
+"""
+An event-driven HTTP/1.1 front end for BasicDB.
+
+A single thread runs an asyncore loop (using poll(), so it isn't limited to
+FD_SETSIZE connections) that accepts connections, reads and parses requests
+and writes responses, so an idle keep-alive connection costs a socket and a
+few buffers rather than a thread. Requests are handed to the WSGI app (and
+so DomainResource and its blocking backend calls) in a bounded pool of
+executor threads.
+
+At most --threads requests run at once and at most --queue more wait for a
+thread. Connections with a request beyond that are parked, and like
+connections whose responses haven't been sent yet, they aren't read from
+until they are served, so clients are held back by TCP flow control rather
+than requests piling up in memory. An executor thread producing a streamed
+response waits while more than HIGH_WATER bytes of it are waiting to be
+sent.
+"""
+
+# Bytes of response waiting to be sent to a client above which the
+# executor thread producing it waits
+HIGH_WATER = 256 * 1024
+
+# Requests with a longer request line and headers are rejected
+MAX_HEADER_SIZE = 65536
+
+class _Waker(asyncore.file_dispatcher):
+    """Runs callbacks from other threads in the loop thread"""
+    def __init__(self, map):
+        self._read_fd, self._write_fd = os.pipe()
+        asyncore.file_dispatcher.__init__(self, self._read_fd, map)
+        os.close(self._read_fd)
+        flags = fcntl.fcntl(self._write_fd, fcntl.F_GETFL)
+        fcntl.fcntl(self._write_fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self._callbacks = collections.deque()
+
+    def call_soon_threadsafe(self, callback, *args):
+        self._callbacks.append((callback, args))
+        try:
+            os.write(self._write_fd, 'x')
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        try:
+            self.recv(4096)
+        except (OSError, socket.error):
+            pass
+        while self._callbacks:
+            callback, args = self._callbacks.popleft()
+            callback(*args)
+
+    def handle_close(self):
+        pass
+
+    def close(self):
+        asyncore.file_dispatcher.close(self)
+        os.close(self._write_fd)
+
+class _Response(object):
+    """Sends what an executor thread produces for a request to the client,
+    framing it and waiting while too much of it is waiting to be sent"""
+    def __init__(self, conn, environ, keep_alive):
+        self.conn = conn
+        self.environ = environ
+        self.framing = ResponseFraming(environ['SERVER_PROTOCOL'], keep_alive)
+        self.status = None
+        self.headers = None
+
+    def start_response(self, status, headers, exc_info=None):
+        if exc_info:
+            try:
+                if self.framing.headers_sent:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+            finally:
+                exc_info = None
+        self.status = status
+        self.headers = headers
+        return self.write
+
+    def write(self, data):
+        header_block = ''
+        if not self.framing.headers_sent:
+            header_block = self.framing.header_block(self.status, self.headers)
+        self.conn.send_threadsafe(header_block + self.framing.body(data))
+
+    def finish(self):
+        if not self.framing.headers_sent:
+            self.conn.send_threadsafe(self.framing.header_block(self.status, self.headers,
+                                                                empty=True))
+        elif self.framing.chunked:
+            self.conn.send_threadsafe(self.framing.end())
+
+    def fail(self):
+        already_sent = self.framing.headers_sent
+        self.framing.keep_alive = False
+        if already_sent:
+            # Nothing to do but cut the response short
+            return
+        self.conn.send_threadsafe(self.framing.header_block('500 Internal Server Error',
+                                                           [('Content-Length', '0')]))
+
+class _Connection(asyncore.dispatcher):
+    def __init__(self, sock, addr, server):
+        asyncore.dispatcher.__init__(self, sock, server.map)
+        self.addr = addr
+        self.server = server
+        self.inbuf = ''
+        self.outbuf = collections.deque()
+        self.busy = False
+        self.close_when_sent = False
+        self.last_activity = time.time()
+        # Bytes handed over by executor threads and not sent yet
+        self._pending = 0
+        self._space = threading.Condition(threading.Lock())
+        self._closed = False
+
+    def readable(self):
+        return not self.busy and not self.close_when_sent
+
+    def writable(self):
+        return bool(self.outbuf)
+
+    def handle_read(self):
+        data = self.recv(65536)
+        if not data:
+            return
+        self.last_activity = time.time()
+        self.inbuf += data
+        self._parse()
+
+    def _parse(self):
+        end = self.inbuf.find('\r\n\r\n')
+        if end < 0:
+            if len(self.inbuf) > MAX_HEADER_SIZE:
+                self._reject('431 Request Header Fields Too Large')
+            return
+        lines = self.inbuf[:end].split('\r\n')
+        try:
+            method, path, version = lines[0].split()
+        except ValueError:
+            self._reject('400 Bad Request')
+            return
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            headers[name.strip().upper().replace('-', '_')] = value.strip()
+        if 'TRANSFER_ENCODING' in headers:
+            self._reject('411 Length Required')
+            return
+        try:
+            length = int(headers.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            self._reject('400 Bad Request')
+            return
+        if len(self.inbuf) < end + 4 + length:
+            return
+
+        body = self.inbuf[end + 4:end + 4 + length]
+        self.inbuf = self.inbuf[end + 4 + length:]
+        connection = headers.get('CONNECTION', '').lower()
+        if version == 'HTTP/1.1':
+            keep_alive = connection != 'close'
+        else:
+            keep_alive = connection == 'keep-alive'
+
+        environ = self.server.base_environ.copy()
+        path, _, query = path.partition('?')
+        environ.update({'REQUEST_METHOD': method,
+                        'PATH_INFO': urllib.unquote(path),
+                        'QUERY_STRING': query,
+                        'SERVER_PROTOCOL': version,
+                        'REMOTE_ADDR': self.addr[0],
+                        'REMOTE_PORT': str(self.addr[1]),
+                        'wsgi.input': StringIO.StringIO(body)})
+        for name, value in headers.iteritems():
+            if name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                environ[name] = value
+            else:
+                environ['HTTP_' + name] = value
+
+        self.busy = True
+        self.server.submit(_Response(self, environ, keep_alive))
+
+    def _reject(self, status):
+        data = 'HTTP/1.1 %s\r\nContent-Length: 0\r\nConnection: close\r\n\r\n' % (status,)
+        self.busy = True
+        self.close_when_sent = True
+        with self._space:
+            self._pending += len(data)
+        self.outbuf.append(data)
+
+    def send_threadsafe(self, data):
+        """Queue data to be sent, from an executor thread. Waits while too
+        much is queued already."""
+        with self._space:
+            while self._pending > HIGH_WATER and not self._closed:
+                self._space.wait(1)
+            if self._closed:
+                raise socket.error(errno.EPIPE, 'Connection closed')
+            self._pending += len(data)
+        self.server.waker.call_soon_threadsafe(self.outbuf.append, data)
+
+    def response_done(self, keep_alive):
+        """Called in the loop thread once the response has been produced"""
+        if not keep_alive:
+            self.close_when_sent = True
+        if not self.outbuf:
+            self._response_sent()
+
+    def _response_sent(self):
+        if self.close_when_sent:
+            self.close()
+            return
+        self.busy = False
+        self.last_activity = time.time()
+        # The client may have sent its next request already
+        self._parse()
+
+    def handle_write(self):
+        data = self.outbuf.popleft()
+        while self.outbuf and len(data) < 65536:
+            data += self.outbuf.popleft()
+        sent = self.send(data)
+        if sent < len(data):
+            self.outbuf.appendleft(data[sent:])
+        if sent:
+            self.last_activity = time.time()
+            with self._space:
+                self._pending -= sent
+                self._space.notify_all()
+        if not self.outbuf and self.busy and self._pending == 0 and self.server.is_done(self):
+            self._response_sent()
+
+    def handle_close(self):
+        self.close()
+
+    def handle_error(self):
+        traceback.print_exc()
+        self.close()
+
+    def close(self):
+        with self._space:
+            self._closed = True
+            self._space.notify_all()
+        asyncore.dispatcher.close(self)
+
+class _Listener(asyncore.dispatcher):
+    def __init__(self, sock, server):
+        asyncore.dispatcher.__init__(self, sock, server.map)
+        self.accepting = True
+        self.server = server
+
+    def writable(self):
+        return False
+
+    def handle_accept(self):
+        # Take all the connections that are waiting, not just one
+        for i in range(64):
+            try:
+                conn, addr = self.socket.accept()
+            except socket.error, e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ECONNABORTED,
+                               errno.EINTR):
+                    return
+                if e.errno in (errno.EMFILE, errno.ENFILE):
+                    print >> sys.stderr, 'Out of file descriptors: %s' % (e,)
+                    return
+                raise
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            _Connection(conn, addr, self.server)
+
+class AsyncServer(object):
+    def __init__(self, listener, app, threads=16, queue=64, keepalive=60):
+        self.app = app
+        self.keepalive = keepalive
+        self.map = {}
+        self.waker = _Waker(self.map)
+        listener.setblocking(0)
+        self.listener = _Listener(listener, self)
+        host, port = listener.getsockname()[:2]
+        self.address = (host, port)
+        self.base_environ = {'SERVER_NAME': host,
+                             'SERVER_PORT': str(port),
+                             'SCRIPT_NAME': '',
+                             'wsgi.version': (1, 0),
+                             'wsgi.url_scheme': 'http',
+                             'wsgi.errors': sys.stderr,
+                             'wsgi.multithread': True,
+                             'wsgi.multiprocess': False,
+                             'wsgi.run_once': False}
+        self.max_running = threads + queue
+        self.running = set()
+        self.waiting = collections.deque()
+        self._jobs = Queue.Queue()
+        self._threads = []
+        for i in range(threads):
+            thread = threading.Thread(target=self._execute)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        self._stopping = False
+
+    def submit(self, response):
+        """Hand a request to the executor, or park it until there's room"""
+        if len(self.running) < self.max_running:
+            self.running.add(response.conn)
+            self._jobs.put(response)
+        else:
+            self.waiting.append(response)
+
+    def is_done(self, conn):
+        return conn not in self.running
+
+    def _job_done(self, response):
+        self.running.discard(response.conn)
+        while self.waiting and len(self.running) < self.max_running:
+            waiting = self.waiting.popleft()
+            if waiting.conn.connected:
+                self.running.add(waiting.conn)
+                self._jobs.put(waiting)
+        if response.conn.connected:
+            response.conn.response_done(response.framing.keep_alive)
+
+    def _execute(self):
+        while True:
+            response = self._jobs.get()
+            if response is None:
+                return
+            try:
+                result = self.app(response.environ, response.start_response)
+                try:
+                    for data in result:
+                        if data:
+                            response.write(data)
+                    response.finish()
+                finally:
+                    if hasattr(result, 'close'):
+                        result.close()
+            except socket.error:
+                response.framing.keep_alive = False
+            except Exception:
+                traceback.print_exc()
+                try:
+                    response.fail()
+                except socket.error:
+                    pass
+            self.waker.call_soon_threadsafe(self._job_done, response)
+
+    def _close_idle(self, now):
+        for dispatcher in self.map.values():
+            if (isinstance(dispatcher, _Connection) and not dispatcher.busy and
+                not dispatcher.outbuf and now - dispatcher.last_activity > self.keepalive):
+                dispatcher.close()
+
+    def connections(self):
+        return sum(1 for dispatcher in self.map.values()
+                   if isinstance(dispatcher, _Connection))
+
+    def serve_forever(self):
+        last_check = time.time()
+        while not self._stopping:
+            asyncore.loop(timeout=1, use_poll=True, map=self.map, count=1)
+            now = time.time()
+            if now - last_check >= 1:
+                self._close_idle(now)
+                last_check = now
+        for dispatcher in self.map.values():
+            dispatcher.close()
+        for thread in self._threads:
+            self._jobs.put(None)
+
+    def stop(self):
+        """Stop serving. Can be called from any thread."""
+        def stop():
+            self._stopping = True
+        self.waker.call_soon_threadsafe(stop)
+
+def _raise_fd_limit():
+    """Allow as many open files (and so connections) as we're allowed to"""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY:
+        hard = 65536
+    if soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except ValueError:
+            pass
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve BasicDB from an event loop, '
+                                                 'with backend calls in a thread pool')
+    parser.add_argument('port', type=int, nargs='?', default=8000)
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--threads', type=int, default=16,
+                        help='Threads handling requests (and waiting for the backend)')
+    parser.add_argument('--queue', type=int, default=64,
+                        help='Requests that may wait for a thread before connections '
+                             'stop being read from')
+    parser.add_argument('--keepalive', type=float, default=60,
+                        help='Seconds an idle connection is kept open')
+    args = parser.parse_args(argv)
+
+    _raise_fd_limit()
+    import basicdb
+    basicdb.get_backend()
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((args.host, args.port))
+    listener.listen(1024)
+    server = AsyncServer(listener, basicdb.app, args.threads, args.queue, args.keepalive)
+    print >> sys.stderr, ('Listening on http://%s:%d/ with %d threads' %
+                          (server.address + (args.threads,)))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,7 +1,143 @@
+import contextlib
+import heapq
+import itertools
+import threading
+
 import basicdb
 import basicdb.exceptions
 import basicdb.sqlparser as sqlparser
 
+def sort_items(items, key, reverse=False, limit=None):
+    """Sort (item_name, item_attrs) pairs by the given sort key
+
+    Items are sorted by their lowest value for the key attribute in
+    ascending order and by their highest in descending order, so each item
+    appears once. Items without a value for key are left out. If limit is
+    given, only that many items are returned, which doesn't require sorting
+    (or holding on to) all of them."""
+    if key == 'itemName()':
+        sort_keys = ((item_name, item_name, item_attrs)
+                     for item_name, item_attrs in items)
+    else:
+        pick = max if reverse else min
+        sort_keys = ((pick(item_attrs[key]), item_name, item_attrs)
+                     for item_name, item_attrs in items
+                     if item_attrs.get(key))
+    if limit is None:
+        order = sorted(sort_keys, reverse=reverse)
+    elif reverse:
+        order = heapq.nlargest(limit, sort_keys)
+    else:
+        order = heapq.nsmallest(limit, sort_keys)
+    return [(item_name, item_attrs) for _, item_name, item_attrs in order]
+
+def project(item_attrs, columns):
+    """The attributes of an item to return for the given Select columns, or
+    None if the item shouldn't be returned at all"""
+    if columns == ['*']:
+        return item_attrs
+    matching_attributes = dict((attr_name, attr_values)
+                               for attr_name, attr_values in item_attrs.iteritems()
+                               if attr_name in columns)
+    if matching_attributes or any(isinstance(col, (sqlparser.SqlParser.ItemName, sqlparser.SqlParser.Count))
+                                  for col in columns):
+        return matching_attributes
+    return None
+
+def check_sort_key(parsed):
+    """Raise InvalidSortExpressionException if a parsed Select expression
+    sorts by an attribute that its WHERE clause doesn't mention"""
+    key = parsed.order_by_terms.key
+    if key and (parsed.where_expr == '' or key not in parsed.where_expr.identifiers()):
+        raise basicdb.exceptions.InvalidSortExpressionException('Blah')
+
+def apply_changes(item_attrs, additions=None, replacements=None, deletions=None):
+    """Change item_attrs (a dict mapping attribute names to sets of values)
+    in place the way put_attributes and delete_attributes would: additions
+    are applied first, then replacements, then deletions. Attributes left
+    without values are removed."""
+    for attr_name, attr_values in (additions or {}).iteritems():
+        item_attrs.setdefault(attr_name, set()).update(attr_values)
+    for attr_name, attr_values in (replacements or {}).iteritems():
+        item_attrs[attr_name] = set(attr_values)
+    for attr_name, attr_values in (deletions or {}).iteritems():
+        if basicdb.AllAttributes in attr_values:
+            item_attrs.pop(attr_name, None)
+        elif attr_name in item_attrs:
+            item_attrs[attr_name].difference_update(attr_values)
+    for attr_name in [attr_name for attr_name, attr_values in item_attrs.iteritems()
+                      if not attr_values]:
+        del item_attrs[attr_name]
+
+def check_expectation(item_attrs, expectation):
+    """Check a PutAttributes expectation (see StorageBackend.put_attributes)
+    against an item's attributes. Returns True if it is met and raises the
+    appropriate exception otherwise."""
+    attr_name, attr_value_expected = expectation
+
+    if attr_name in item_attrs:
+        if attr_value_expected == False:
+            raise basicdb.exceptions.FoundUnexpectedAttribute(attr_name)
+        attr = item_attrs[attr_name]
+
+        if len(attr) > 1:
+            raise basicdb.exceptions.MultiValuedAttribute(attr_name)
+
+        if attr_value_expected == True:
+            return True
+
+        attr_value = iter(attr).next()
+
+        if attr_value == attr_value_expected:
+            return True
+        else:
+            raise basicdb.exceptions.WrongValueFound(attr_name,
+                                                     attr_value_expected,
+                                                     attr_value)
+    else:
+        if attr_value_expected == False:
+            return True
+        raise basicdb.exceptions.AttributeDoesNotExist(attr_name)
+
+# Locks serializing changes to items within the process, so that checking
+# expectations and making the change can't interleave with another change
+# to the same item, and changes to domains, for backends that keep
+# per-domain structures in memory. Items and domains are hashed onto a
+# fixed number of locks, which are shared by all backends (a CachingBackend
+# and the backend it wraps, say) and reentrant, so nested calls for the
+# same item don't deadlock. Item locks must be taken before domain locks.
+LOCK_STRIPES = 64
+_item_locks = [threading.RLock() for i in range(LOCK_STRIPES)]
+_domain_locks = [threading.RLock() for i in range(LOCK_STRIPES)]
+
+def _item_lock_stripe(owner, domain_name, item_name):
+    return hash((owner, domain_name, item_name)) % LOCK_STRIPES
+
+def item_lock(owner, domain_name, item_name):
+    """The lock to hold while checking or changing an item"""
+    return _item_locks[_item_lock_stripe(owner, domain_name, item_name)]
+
+def domain_lock(owner, domain_name):
+    """The lock to hold while changing a domain's in-memory structures"""
+    return _domain_locks[hash((owner, domain_name)) % LOCK_STRIPES]
+
+@contextlib.contextmanager
+def item_locks(owner, domain_name, item_names):
+    """Hold the locks of several items of a domain at once
+
+    They are taken in a fixed order, so two threads doing this can't
+    deadlock, but a thread holding the lock of one item must not take
+    others this way."""
+    stripes = sorted(set(_item_lock_stripe(owner, domain_name, item_name)
+                         for item_name in item_names))
+    for stripe in stripes:
+        _item_locks[stripe].acquire()
+    try:
+        yield
+    finally:
+        for stripe in reversed(stripes):
+            _item_locks[stripe].release()
+
 class StorageBackend(object):
     def create_domain(self, owner, domain_name):
         """Create a new domain"""
@@ -49,11 +185,14 @@ class StorageBackend(object):
         to exist.
         
         If the backend does not have a quick mechanism for this, just leave
-        this method alone and implement some of the more low-level methods"""
-        if expectations and not self.check_expectations(owner, domain_name, item_name, expectations):
-            raise basicdb.exceptions.ConditionalCheckFailed()
-        self.add_attributes(owner, domain_name, item_name, additions)
-        self.replace_attributes(owner, domain_name, item_name, replacements)
+        this method alone and implement some of the more low-level methods.
+        Otherwise, check the expectations and make the change while holding
+        the item's item_lock()."""
+        with item_lock(owner, domain_name, item_name):
+            if expectations and not self.check_expectations(owner, domain_name, item_name, expectations):
+                raise basicdb.exceptions.ConditionalCheckFailed()
+            self.add_attributes(owner, domain_name, item_name, additions)
+            self.replace_attributes(owner, domain_name, item_name, replacements)
 
     def add_attributes(self, owner, domain_name, item_name, additions):
         """Add attributes to an item
@@ -101,8 +240,9 @@ class StorageBackend(object):
             self.delete_attributes(owner, domain_name, item_name, item_deletions)
 
     def delete_attributes(self, owner, domain_name, item_name, deletions):
-        for attr_name, attr_values in deletions.iteritems():
-            self.delete_attribute(owner, domain_name, item_name, attr_name, attr_values)
+        with item_lock(owner, domain_name, item_name):
+            for attr_name, attr_values in deletions.iteritems():
+                self.delete_attribute(owner, domain_name, item_name, attr_name, attr_values)
 
     def delete_attribute(self, owner, domain_name, item_name, attr_name, attr_values):
         if basicdb.AllAttributes in attr_values:
@@ -120,74 +260,135 @@ class StorageBackend(object):
     def get_attributes(self, owner, domain_name, item_name):
         raise NotImplementedError()
 
+    def get_items(self, owner, domain_name, item_names):
+        """Iterate over (item_name, item_attrs) pairs for those of the given
+        items that exist
+
+        If the backend does not have a quick mechanism for this, just leave
+        this method alone and implement get_attributes"""
+        for item_name in item_names:
+            item_attrs = self.get_attributes(owner, domain_name, item_name)
+            if item_attrs:
+                yield item_name, item_attrs
+
     def select_wrapper(self, owner, sql_expr):
-        parsed = sqlparser.SqlParser().parse(sql_expr)
-        if parsed.where_expr == '':
-            identifiers = []
-        else:
-            identifiers = parsed.where_expr.identifiers()
-        raw_results = self.select(owner, parsed)
+        results = list(self.select_items(owner, sql_expr))
+        return [item_name for item_name, _ in results], dict(results)
+
+    def select_items(self, owner, sql_expr):
+        """Iterate over the (item_name, item_attrs) pairs of the result of a
+        Select expression in their final order, like select_wrapper but
+        without collecting them first
+
+        The expression is parsed (and count(*) is counted) before this
+        returns, so errors in it are raised right away rather than while
+        iterating."""
+        parsed = sqlparser.parse(sql_expr)
+        if not isinstance(parsed.columns[0], basicdb.sqlparser.SqlParser.Count):
+            return self.select_stream(owner, parsed)
+
         if parsed.order_by_terms.key:
-            if parsed.order_by_terms.key not in identifiers:
-                raise basicdb.exceptions.InvalidSortExpressionException('Blah')
-            order = []
-            for item_name, item_attrs in raw_results.iteritems():
-                if parsed.order_by_terms.key == 'itemName()':
-                    order.append((item_name, item_name))
-                else:
-                    for val in item_attrs[parsed.order_by_terms.key]:
-                        order.append((val, item_name))
-            order.sort(key=lambda x:x[0], reverse=parsed.order_by_terms.reverse)
-            order = map(lambda x:x[1], order)
-            self.prev = None
-            def remove_if_same_as_previous(x):
-                retval = x != self.prev
-                self.prev = x
-                return retval
-            order = filter(remove_if_same_as_previous, order)
+            count = sum(1 for _ in self.select_stream(owner, parsed))
         else:
-            order = raw_results.keys()
+            matches = self.select_by_item_name(owner, parsed)
+            if matches is None:
+                count = self.count(owner, parsed)
+            else:
+                count = sum(1 for _ in matches)
+            if parsed.limit_terms:
+                count = min(count, int(parsed.limit_terms[1]))
+        return iter([(parsed.table, {"count": set([str(count)])})])
+
+    def count(self, owner, parsed):
+        """Number of items matching a parsed "select count(*)" expression,
+        disregarding its LIMIT
+
+        Backends that can count items without fetching their attributes
+        should override this."""
+        return sum(1 for _ in self._select_matches(owner, parsed))
+
+    def select_stream(self, owner, parsed):
+        """Iterate over the (item_name, item_attrs) pairs of the result of a
+        parsed Select expression in their final order
+
+        Without ORDER BY, items are pulled from select_iter only until LIMIT
+        is reached."""
         if parsed.limit_terms:
-            order = order[:int(parsed.limit_terms[1])]
-        if isinstance(parsed.columns[0], basicdb.sqlparser.SqlParser.Count):
-            raw_results = {parsed.table: {"count":set([str(len(order))])}}
-            order = [parsed.table]
-        return order, raw_results
+            limit = int(parsed.limit_terms[1])
+        else:
+            limit = None
 
-    def select(self, owner, sql_expr):
-        raise NotImplementedError()
+        key = parsed.order_by_terms.key
+        if not key:
+            matches = self._select_matches(owner, parsed)
+            if limit is not None:
+                matches = itertools.islice(matches, limit)
+            return matches
 
-    def domain_metadata(self, owner, domain_name):
-        raise NotImplementedError()
+        check_sort_key(parsed)
+        if key == 'itemName()' or parsed.columns == ['*'] or key in parsed.columns:
+            return iter(sort_items(self._select_matches(owner, parsed),
+                                   key, parsed.order_by_terms.reverse, limit))
 
-    def check_expectations(self, owner, domain_name, item_name, expectations):
-        return all([self.check_expectation(owner, domain_name, item_name, expectation) for expectation in expectations])
+        # The sort key isn't among the columns, so fetch all attributes
+        # and project once the items are in order. Items without any of the
+        # columns are only dropped here, so the backend mustn't stop at
+        # LIMIT matches.
+        matches = ((item_name, item_attrs) for item_name, item_attrs
+                   in self._select_matches(owner, parsed._replace(columns=['*'],
+                                                                  limit_terms=()))
+                   if project(item_attrs, parsed.columns) is not None)
+        return ((item_name, project(item_attrs, parsed.columns))
+                for item_name, item_attrs
+                in sort_items(matches, key, parsed.order_by_terms.reverse, limit))
 
-    def check_expectation(self, owner, domain_name, item_name, expectation):
-        attr_name, attr_value_expected = expectation
+    def _select_matches(self, owner, parsed):
+        matches = self.select_by_item_name(owner, parsed)
+        if matches is None:
+            matches = self.select_iter(owner, parsed)
+        return matches
 
-        attrs = self.get_attributes(owner, domain_name, item_name)
+    def select_by_item_name(self, owner, parsed):
+        """If the WHERE clause restricts itemName() to a known set of names,
+        iterate over the matching items (like select_iter does), looking up
+        just those items through get_items. Otherwise, return None."""
+        item_names = sqlparser.item_names(parsed.where_expr)
+        if item_names is None:
+            return None
 
-        if attr_name in attrs:
-            if attr_value_expected == False:
-                raise basicdb.exceptions.FoundUnexpectedAttribute(attr_name)
-            attr = attrs[attr_name]
+        def matches():
+            predicate = parsed.predicate
+            for item_name, item_attrs in self.get_items(owner, parsed.table, sorted(item_names)):
+                if predicate(item_name, item_attrs):
+                    item_attrs = project(item_attrs, parsed.columns)
+                    if item_attrs is not None:
+                        yield item_name, item_attrs
+        return matches()
 
-            if len(attr) > 1:
-                raise basicdb.exceptions.MultiValuedAttribute(attr_name)
+    def select_iter(self, owner, parsed):
+        """Iterate over (item_name, item_attrs) pairs of the items matching
+        a parsed Select expression, with their attributes projected to its
+        columns (see project()). The order doesn't matter.
 
-            if attr_value_expected == True:
-                return True
+        Backends should yield items as they find them, so that queries with
+        a LIMIT don't need to look at every item. This default is for
+        backends that implement select() instead."""
+        return self.select(owner, parsed).iteritems()
 
-            attr_value = attr.copy().pop()
+    def select(self, owner, sql_expr):
+        """Return a dict mapping the names of the items matching a parsed
+        Select expression to their attributes, projected to its columns"""
+        raise NotImplementedError()
 
-            if attr_value == attr_value_expected:
-                return True
-            else:
-                raise basicdb.exceptions.WrongValueFound(attr_name,
-                                                         attr_value_expected,
-                                                         attr_value)
-        else:
-            if attr_value_expected == False:
-                return True
-            raise basicdb.exceptions.AttributeDoesNotExist(attr_name)
+    def domain_metadata(self, owner, domain_name):
+        raise NotImplementedError()
+
+    def check_expectations(self, owner, domain_name, item_name, expectations):
+        """Check expectations (see put_attributes) against the item, which is
+        only fetched once. Returns True if they're all met and raises the
+        exception for the first one that isn't otherwise."""
+        attrs = self.get_attributes(owner, domain_name, item_name)
+        return all([check_expectation(attrs, expectation) for expectation in expectations])
+
+    def check_expectation(self, owner, domain_name, item_name, expectation):
+        return check_expectation(self.get_attributes(owner, domain_name, item_name), expectation)
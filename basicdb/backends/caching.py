@@ -0,0 +1,276 @@
+import collections
+import threading
+
+import basicdb.backends
+import basicdb.exceptions
+import basicdb.sqlparser
+
+"""
+An LRU cache of item attributes in front of another backend.
+
+get_attributes and get_items (and so expectation checks and Select
+expressions that only look up given item names) are answered from the
+cache when possible. Everything that changes an item goes through to the
+backend and drops the item from the cache, and deleting or creating a
+domain drops all of its items. Other Select expressions go straight to the
+backend.
+
+Items that get_items finds don't exist are remembered as such, but only
+get_items answers from that, as backends differ in what get_attributes
+does for them.
+
+The cache only knows about changes made through it, so it must not be used
+with a backend that other processes write to.
+"""
+
+# Rough per-entry overhead of the cache and of each attribute and value, in
+# bytes, for estimating the size of the cache
+_ENTRY_OVERHEAD = 400
+_ATTRIBUTE_OVERHEAD = 250
+_VALUE_OVERHEAD = 80
+
+def _estimate_size(key, item_attrs):
+    size = _ENTRY_OVERHEAD + sum(len(s) for s in key)
+    for attr_name, attr_values in item_attrs.iteritems():
+        size += _ATTRIBUTE_OVERHEAD + len(attr_name)
+        for attr_value in attr_values:
+            size += _VALUE_OVERHEAD + len(attr_value)
+    return size
+
+# Cached for items get_items found not to exist
+_ABSENT = object()
+
+def _copy(item_attrs):
+    return dict((attr_name, set(attr_values))
+                for attr_name, attr_values in item_attrs.iteritems())
+
+class CachingBackend(basicdb.backends.StorageBackend):
+    def __init__(self, backend, max_size):
+        """Cache up to about max_size bytes worth of items from backend"""
+        self.backend = backend
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._reset_cache()
+
+    def __getattr__(self, name):
+        # Anything else the backend offers (close(), compact(), ...)
+        return getattr(self.backend, name)
+
+    def _reset_cache(self):
+        self._entries = collections.OrderedDict()
+        self._domains = {}
+        self._size = 0
+        # Bumped on every invalidation, so that a lookup that raced with a
+        # change doesn't put what it read in the cache afterwards
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _reset(self):
+        self.backend._reset()
+        with self._lock:
+            self._reset_cache()
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'invalidations': self.invalidations,
+                    'entries': len(self._entries),
+                    'size_bytes': self._size,
+                    'max_size_bytes': self.max_size}
+
+    def _lookup(self, key, absent=False):
+        """The cached attributes for key, or None. If absent is true, an
+        item known not to exist is found as _ABSENT rather than missed.
+        Call with the lock held."""
+        entry = self._entries.pop(key, None)
+        if entry is None or (entry[0] is _ABSENT and not absent):
+            if entry is not None:
+                self._entries[key] = entry
+            self.misses += 1
+            return None
+        self._entries[key] = entry
+        self.hits += 1
+        return entry[0]
+
+    def _store(self, key, item_attrs, generation):
+        """Cache item_attrs (read when the generation was as given) for key.
+        Call with the lock held."""
+        if generation != self._generation:
+            return
+        if item_attrs is _ABSENT:
+            size = _estimate_size(key, {})
+        else:
+            size = _estimate_size(key, item_attrs)
+            item_attrs = _copy(item_attrs)
+        if size > self.max_size:
+            return
+        self._discard(key)
+        self._entries[key] = (item_attrs, size)
+        self._domains.setdefault(key[:2], set()).add(key[2])
+        self._size += size
+        while self._size > self.max_size:
+            self._discard(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= entry[1]
+            items = self._domains[key[:2]]
+            items.discard(key[2])
+            if not items:
+                del self._domains[key[:2]]
+
+    def _invalidate(self, owner, domain_name, item_names):
+        with self._lock:
+            self._generation += 1
+            for item_name in item_names:
+                key = (owner, domain_name, item_name)
+                if key in self._entries:
+                    self._discard(key)
+                    self.invalidations += 1
+
+    def _invalidate_domain(self, owner, domain_name):
+        with self._lock:
+            self._generation += 1
+            for item_name in list(self._domains.get((owner, domain_name), ())):
+                self._discard((owner, domain_name, item_name))
+                self.invalidations += 1
+
+    def get_attributes(self, owner, domain_name, item_name):
+        key = (owner, domain_name, item_name)
+        with self._lock:
+            item_attrs = self._lookup(key)
+            generation = self._generation
+        if item_attrs is not None:
+            return _copy(item_attrs)
+
+        item_attrs = self.backend.get_attributes(owner, domain_name, item_name)
+        with self._lock:
+            self._store(key, item_attrs, generation)
+        return item_attrs
+
+    def get_items(self, owner, domain_name, item_names):
+        item_names = list(item_names)
+        cached = {}
+        missing = []
+        with self._lock:
+            for item_name in item_names:
+                item_attrs = self._lookup((owner, domain_name, item_name), absent=True)
+                if item_attrs is None:
+                    missing.append(item_name)
+                elif item_attrs is not _ABSENT:
+                    cached[item_name] = item_attrs
+            generation = self._generation
+
+        fetched = {}
+        if missing:
+            fetched = dict(self.backend.get_items(owner, domain_name, missing))
+            with self._lock:
+                for item_name in missing:
+                    self._store((owner, domain_name, item_name),
+                                fetched.get(item_name, _ABSENT), generation)
+
+        for item_name in item_names:
+            if item_name in fetched:
+                yield item_name, fetched[item_name]
+            elif cached.get(item_name):
+                yield item_name, _copy(cached[item_name])
+
+    def create_domain(self, owner, domain_name):
+        try:
+            self.backend.create_domain(owner, domain_name)
+        finally:
+            self._invalidate_domain(owner, domain_name)
+
+    def delete_domain(self, owner, domain_name):
+        try:
+            self.backend.delete_domain(owner, domain_name)
+        finally:
+            self._invalidate_domain(owner, domain_name)
+
+    def list_domains(self, owner):
+        return self.backend.list_domains(owner)
+
+    def check_expectations(self, owner, domain_name, item_name, expectations):
+        # Against the cached item if there is one. What expectations on an
+        # item that doesn't exist come to is up to the wrapped backend.
+        try:
+            item_attrs = dict(self.get_items(owner, domain_name, [item_name])).get(item_name)
+        except KeyError:
+            item_attrs = None
+        if not item_attrs:
+            return self.backend.check_expectations(owner, domain_name, item_name, expectations)
+        return all([basicdb.backends.check_expectation(item_attrs, expectation)
+                    for expectation in expectations])
+
+    def put_attributes(self, owner, domain_name, item_name, additions, replacements,
+                       expectations=None):
+        # Checked here, against the cached item if there is one
+        with basicdb.backends.item_lock(owner, domain_name, item_name):
+            if expectations and not self.check_expectations(owner, domain_name, item_name, expectations):
+                raise basicdb.exceptions.ConditionalCheckFailed()
+            try:
+                self.backend.put_attributes(owner, domain_name, item_name, additions, replacements)
+            finally:
+                self._invalidate(owner, domain_name, [item_name])
+
+    def batch_put_attributes(self, owner, domain_name, additions, replacements):
+        try:
+            self.backend.batch_put_attributes(owner, domain_name, additions, replacements)
+        finally:
+            self._invalidate(owner, domain_name, set(additions.keys() + replacements.keys()))
+
+    def delete_attributes(self, owner, domain_name, item_name, deletions):
+        try:
+            self.backend.delete_attributes(owner, domain_name, item_name, deletions)
+        finally:
+            self._invalidate(owner, domain_name, [item_name])
+
+    def batch_delete_attributes(self, owner, domain_name, deletions):
+        try:
+            self.backend.batch_delete_attributes(owner, domain_name, deletions)
+        finally:
+            self._invalidate(owner, domain_name, deletions.keys())
+
+    def add_attribute_value(self, owner, domain_name, item_name, attr_name, attr_value):
+        try:
+            self.backend.add_attribute_value(owner, domain_name, item_name, attr_name, attr_value)
+        finally:
+            self._invalidate(owner, domain_name, [item_name])
+
+    def delete_attribute_all(self, owner, domain_name, item_name, attr_name):
+        try:
+            self.backend.delete_attribute_all(owner, domain_name, item_name, attr_name)
+        finally:
+            self._invalidate(owner, domain_name, [item_name])
+
+    def delete_attribute_value(self, owner, domain_name, item_name, attr_name, attr_value):
+        try:
+            self.backend.delete_attribute_value(owner, domain_name, item_name,
+                                                attr_name, attr_value)
+        finally:
+            self._invalidate(owner, domain_name, [item_name])
+
+    def select_stream(self, owner, parsed):
+        if basicdb.sqlparser.item_names(parsed.where_expr) is not None:
+            # Looks the items up through get_items, and so the cache
+            return super(CachingBackend, self).select_stream(owner, parsed)
+        return self.backend.select_stream(owner, parsed)
+
+    def select_iter(self, owner, parsed):
+        return self.backend.select_iter(owner, parsed)
+
+    def select(self, owner, parsed):
+        return self.backend.select(owner, parsed)
+
+    def count(self, owner, parsed):
+        return self.backend.count(owner, parsed)
+
+    def domain_metadata(self, owner, domain_name):
+        return self.backend.domain_metadata(owner, domain_name)
@@ -1,118 +1,681 @@
+import functools
+import itertools
+import os
+import sys
+import threading
 import time
+import traceback
 
 import basicdb
 import basicdb.backends
+import basicdb.exceptions
+import basicdb.index
 import basicdb.sqlparser
+import basicdb.wal
 
-class FakeBackend(basicdb.backends.StorageBackend):
+def _logged(method):
+    """Decorator for the methods that change the data, making them append
+    a record of the call to the write-ahead log (if there is one), which
+    is replayed on startup"""
+    @functools.wraps(method)
+    def wrapper(self, *args):
+        if self._wal is None:
+            return method(self, *args)
+        with self._lock:
+            retval = method(self, *args)
+            seq = self._wal.append((method.__name__,) + args)
+        self._wal.sync(seq)
+        return retval
+    return wrapper
+
+class DictDomain(object):
+    """The items of a domain as a dict mapping item names to dicts mapping
+    attribute names to sets of values
+
+    Changes are made by the backend with the domain's lock held. They
+    replace an item's dict (and the changed set) with a changed copy
+    rather than changing them in place, so readers can use what they got
+    without any locking."""
     def __init__(self):
+        self.items = {}
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, item_name):
+        return item_name in self.items
+
+    def item_names(self):
+        return self.items.keys()
+
+    def attributes(self, item_name):
+        """The attributes of an item as a dict of sets (KeyError if it
+        doesn't exist)"""
+        return self.items[item_name]
+
+    def get(self, item_name):
+        """The attributes of an item in a form the compiled predicates and
+        attributes_of() take, or None if it doesn't exist"""
+        return self.items.get(item_name)
+
+    def iteritems(self):
+        """Iterate over (item_name, item_attrs) pairs, item_attrs being
+        like what get() returns, as of when this is called"""
+        return iter(self.items.items())
+
+    def attributes_of(self, item_attrs):
+        """Turn what get() returns into a dict of sets"""
+        return item_attrs
+
+    def add_item(self, item_name):
+        """Create an item without attributes if it doesn't exist. Returns
+        whether it is new."""
+        if item_name in self.items:
+            return False
+        self.items[item_name] = {}
+        return True
+
+    def add(self, item_name, attr_name, attr_value):
+        """Add a value, creating the item if needed. Returns whether the
+        item is new."""
+        new = self.add_item(item_name)
+        item_attrs = self.items[item_name]
+        attr_values = item_attrs.get(attr_name)
+        if attr_values is not None and attr_value in attr_values:
+            return new
+        item_attrs = dict(item_attrs)
+        item_attrs[attr_name] = (attr_values or set()) | set([attr_value])
+        self.items[item_name] = item_attrs
+        return new
+
+    def set_item(self, item_name, item_attrs):
+        """Replace all of an item's attributes with item_attrs (a dict of
+        sets that is kept), creating the item if needed"""
+        self.items[item_name] = item_attrs
+
+    def remove(self, item_name, attr_name, attr_value):
+        """Remove a value. Returns whether it was there."""
+        item_attrs = self.items.get(item_name)
+        if item_attrs is None or attr_value not in item_attrs.get(attr_name, ()):
+            return False
+        item_attrs = dict(item_attrs)
+        item_attrs[attr_name] = item_attrs[attr_name] - set([attr_value])
+        if not item_attrs[attr_name]:
+            del item_attrs[attr_name]
+        self.items[item_name] = item_attrs
+        return True
+
+    def remove_all(self, item_name, attr_name):
+        """Remove all values of an attribute and return them"""
+        item_attrs = self.items.get(item_name)
+        if item_attrs is None or attr_name not in item_attrs:
+            return ()
+        item_attrs = dict(item_attrs)
+        attr_values = item_attrs.pop(attr_name)
+        self.items[item_name] = item_attrs
+        return attr_values
+
+    def export(self):
+        """The items in a form marshal takes, for snapshots. Later changes
+        don't affect what is returned."""
+        return self.items.copy()
+
+
+class _CompactAttributes(object):
+    """Read-only view of an item's attributes in a CompactDomain, with
+    just enough of the dict interface for the compiled predicates"""
+    __slots__ = ('_attr_ids', '_record')
+
+    def __init__(self, attr_ids, record):
+        self._attr_ids = attr_ids
+        self._record = record
+
+    def get(self, attr_name, default=None):
+        attr_id = self._attr_ids.get(attr_name)
+        if attr_id is not None:
+            record = self._record
+            for i in xrange(0, len(record), 2):
+                if record[i] == attr_id:
+                    attr_values = record[i + 1]
+                    if type(attr_values) is tuple:
+                        return attr_values
+                    return (attr_values,)
+        return default
+
+
+def _intern(s):
+    if type(s) is str:
+        return intern(s)
+    return s
+
+def _record_to_dict(attr_names, record):
+    item_attrs = {}
+    for i in xrange(0, len(record), 2):
+        attr_values = record[i + 1]
+        if type(attr_values) is tuple:
+            item_attrs[attr_names[record[i]]] = set(attr_values)
+        else:
+            item_attrs[attr_names[record[i]]] = set([attr_values])
+    return item_attrs
+
+def _exported_items(exported):
+    """Iterate over the (item name, dict of sets) pairs of what a
+    domain's export() returned"""
+    if type(exported) is dict:
+        return exported.iteritems()
+    attr_names, records = exported
+    return ((item_name, _record_to_dict(attr_names, record))
+            for item_name, record in records.iteritems())
+
+class CompactDomain(object):
+    """The items of a domain, stored to take as little memory as possible
+
+    Attribute names are numbered per domain, and each item is a flat tuple
+    of (attribute number, values) pairs, where values is a single value or,
+    for multi-valued attributes, a tuple of them. Names and values are
+    interned so that equal strings are only stored once. Changing an item
+    builds a new tuple, and reading it builds a dict of sets, so this is
+    somewhat slower than DictDomain. As the tuples are never changed,
+    readers don't need any locking either."""
+    def __init__(self):
+        self.items = {}
+        self._attr_ids = {}
+        self._attr_names = []
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, item_name):
+        return item_name in self.items
+
+    def item_names(self):
+        return self.items.keys()
+
+    def _attr_id(self, attr_name):
+        attr_id = self._attr_ids.get(attr_name)
+        if attr_id is None:
+            attr_name = _intern(attr_name)
+            attr_id = self._attr_ids[attr_name] = len(self._attr_names)
+            self._attr_names.append(attr_name)
+        return attr_id
+
+    def _to_dict(self, record):
+        return _record_to_dict(self._attr_names, record)
+
+    def attributes(self, item_name):
+        return self._to_dict(self.items[item_name])
+
+    def get(self, item_name):
+        record = self.items.get(item_name)
+        if record is None:
+            return None
+        return _CompactAttributes(self._attr_ids, record)
+
+    def iteritems(self):
+        attr_ids = self._attr_ids
+        for item_name, record in self.items.items():
+            yield item_name, _CompactAttributes(attr_ids, record)
+
+    def attributes_of(self, item_attrs):
+        return self._to_dict(item_attrs._record)
+
+    def _find(self, record, attr_id):
+        for i in xrange(0, len(record), 2):
+            if record[i] == attr_id:
+                return i
+        return None
+
+    def add_item(self, item_name):
+        if item_name in self.items:
+            return False
+        self.items[item_name] = ()
+        return True
+
+    def add(self, item_name, attr_name, attr_value):
+        new = self.add_item(item_name)
+        record = self.items[item_name]
+        attr_id = self._attr_id(attr_name)
+        attr_value = _intern(attr_value)
+        i = self._find(record, attr_id)
+        if i is None:
+            record += (attr_id, attr_value)
+        else:
+            attr_values = record[i + 1]
+            if type(attr_values) is not tuple:
+                attr_values = (attr_values,)
+            if attr_value in attr_values:
+                return new
+            record = record[:i + 1] + (attr_values + (attr_value,),) + record[i + 2:]
+        self.items[item_name] = record
+        return new
+
+    def set_item(self, item_name, item_attrs):
+        record = ()
+        for attr_name, attr_values in item_attrs.iteritems():
+            if len(attr_values) == 1:
+                attr_values = _intern(iter(attr_values).next())
+            else:
+                attr_values = tuple(_intern(attr_value) for attr_value in attr_values)
+            record += (self._attr_id(attr_name), attr_values)
+        self.items[item_name] = record
+
+    def remove(self, item_name, attr_name, attr_value):
+        record = self.items.get(item_name)
+        attr_id = self._attr_ids.get(attr_name)
+        if record is None or attr_id is None:
+            return False
+        i = self._find(record, attr_id)
+        if i is None:
+            return False
+        attr_values = record[i + 1]
+        if type(attr_values) is not tuple:
+            attr_values = (attr_values,)
+        if attr_value not in attr_values:
+            return False
+        remaining = tuple(v for v in attr_values if v != attr_value)
+        if not remaining:
+            self.items[item_name] = record[:i] + record[i + 2:]
+        else:
+            if len(remaining) == 1:
+                remaining = remaining[0]
+            self.items[item_name] = record[:i + 1] + (remaining,) + record[i + 2:]
+        return True
+
+    def remove_all(self, item_name, attr_name):
+        record = self.items.get(item_name)
+        attr_id = self._attr_ids.get(attr_name)
+        if record is None or attr_id is None:
+            return ()
+        i = self._find(record, attr_id)
+        if i is None:
+            return ()
+        attr_values = record[i + 1]
+        self.items[item_name] = record[:i] + record[i + 2:]
+        if type(attr_values) is not tuple:
+            return (attr_values,)
+        return attr_values
+
+    def export(self):
+        """The attribute names and the records as they are, so snapshots
+        don't need more memory than the domain itself"""
+        return list(self._attr_names), self.items.copy()
+
+STORAGE = {'dicts': DictDomain,
+           'compact': CompactDomain}
+
+class FakeBackend(basicdb.backends.StorageBackend):
+    def __init__(self, index=None, data_dir=None, sync_interval=None,
+                 snapshot_interval=None, storage=None):
+        """storage (default: $BASICDB_FAKE_STORAGE or 'dicts') picks how
+        items are kept in memory (see STORAGE).
+
+        If data_dir (default: $BASICDB_FAKE_DATA_DIR) is set, changes are
+        logged there and a snapshot of the data is written every
+        snapshot_interval seconds (default: $BASICDB_FAKE_SNAPSHOT_INTERVAL
+        or 60), so the data survives restarts. sync_interval (default:
+        $BASICDB_FAKE_SYNC_INTERVAL or 0) is how often the log is fsynced,
+        0 meaning before each call returns. See basicdb.wal."""
+        if index is None:
+            index = os.environ.get('BASICDB_FAKE_INDEX', 'ordered')
+        self.index_class = basicdb.index.INDEXES[index]
+        if storage is None:
+            storage = os.environ.get('BASICDB_FAKE_STORAGE', 'dicts')
+        self.domain_class = STORAGE[storage]
+        self._wal = None
+        self._lock = threading.RLock()
         self._reset()
 
+        if data_dir is None:
+            data_dir = os.environ.get('BASICDB_FAKE_DATA_DIR')
+        if data_dir:
+            if sync_interval is None:
+                sync_interval = float(os.environ.get('BASICDB_FAKE_SYNC_INTERVAL', '0'))
+            if snapshot_interval is None:
+                snapshot_interval = float(os.environ.get('BASICDB_FAKE_SNAPSHOT_INTERVAL', '60'))
+            self._open_wal(data_dir, sync_interval, snapshot_interval)
+
+    def _open_wal(self, data_dir, sync_interval, snapshot_interval):
+        wal = basicdb.wal.WriteAheadLog(data_dir, sync_interval)
+        users, records = wal.recover()
+        if users is not None:
+            self._load(users)
+        replayed = 0
+        for record in records:
+            getattr(self, record[0])(*record[1:])
+            replayed += 1
+        self._wal = wal
+        if replayed:
+            self.snapshot()
+
+        self._closed = threading.Event()
+        self._snapshotter = threading.Thread(target=self._snapshot_periodically,
+                                             args=(snapshot_interval,))
+        self._snapshotter.daemon = True
+        self._snapshotter.start()
+
+    def _load(self, users):
+        self._reset()
+        for owner, domains in users.iteritems():
+            self._ensure_owner(owner)
+            for domain_name, exported in domains.iteritems():
+                self.create_domain(owner, domain_name)
+                domain = self._users[owner][domain_name]
+                index = self._index(owner, domain_name)
+                for item_name, item_attrs in _exported_items(exported):
+                    domain.add_item(item_name)
+                    if index is not None:
+                        index.add_item(item_name)
+                    for attr_name, attr_values in item_attrs.iteritems():
+                        for attr_value in attr_values:
+                            domain.add(item_name, attr_name, attr_value)
+                            if index is not None:
+                                index.add(item_name, attr_name, attr_value)
+
+    def _export(self):
+        return dict((owner, dict((domain_name, domain.export())
+                                 for domain_name, domain in domains.iteritems()))
+                    for owner, domains in self._users.iteritems())
+
+    def snapshot(self):
+        """Write a snapshot of the data, so the log up to this point no
+        longer needs to be replayed on startup
+
+        Changes are only held up while the domains are exported, which
+        copies their item dicts but none of the items, as those are
+        replaced rather than changed. Serializing them happens after."""
+        with self._lock:
+            snapshot = self._wal.start_snapshot(self._export())
+        self._wal.write_snapshot(snapshot)
+
+    def _snapshot_periodically(self, interval):
+        while not self._closed.wait(interval):
+            if self._wal.records_since_snapshot():
+                try:
+                    self.snapshot()
+                except Exception:
+                    print >> sys.stderr, "Writing snapshot failed:"
+                    traceback.print_exc()
+
+    def close(self):
+        if self._wal is not None:
+            self._closed.set()
+            self._snapshotter.join()
+            self._wal.close()
+            self._wal = None
+
+    @_logged
     def _reset(self):
         self._users = {}
+        self._indexes = {}
 
     def _ensure_owner(self, owner):
         if not owner in self._users:
-            self._users[owner] = {}
+            # setdefault, as another thread may be doing the same
+            self._indexes.setdefault(owner, {})
+            self._users.setdefault(owner, {})
+
+    def _index(self, owner, domain_name):
+        return self._indexes[owner].get(domain_name)
 
+    @_logged
     def create_domain(self, owner, domain_name):
         self._ensure_owner(owner)
-        self._users[owner][domain_name] = {}
+        with basicdb.backends.domain_lock(owner, domain_name):
+            if self.index_class is not None:
+                self._indexes[owner][domain_name] = self.index_class()
+            self._users[owner][domain_name] = self.domain_class()
 
+    @_logged
     def delete_domain(self, owner, domain_name):
         self._ensure_owner(owner)
-        del self._users[owner][domain_name]
+        with basicdb.backends.domain_lock(owner, domain_name):
+            del self._users[owner][domain_name]
+            self._indexes[owner].pop(domain_name, None)
 
     def list_domains(self, owner):
         self._ensure_owner(owner)
         return self._users[owner].keys() 
 
+    def _add_value(self, domain, index, item_name, attr_name, attr_value):
+        new = domain.add(item_name, attr_name, attr_value)
+        if index is not None:
+            if new:
+                index.add_item(item_name)
+            index.add(item_name, attr_name, attr_value)
+
+    def _remove_all(self, domain, index, item_name, attr_name):
+        attr_values = domain.remove_all(item_name, attr_name)
+        if index is not None:
+            for attr_value in attr_values:
+                index.remove(item_name, attr_name, attr_value)
+
+    def _remove_value(self, domain, index, item_name, attr_name, attr_value):
+        if domain.remove(item_name, attr_name, attr_value) and index is not None:
+            index.remove(item_name, attr_name, attr_value)
+
+    @_logged
     def delete_attribute_all(self, owner, domain_name, item_name, attr_name):
         self._ensure_owner(owner)
-        if domain_name not in self._users[owner]:
-            return
-
-        if item_name not in self._users[owner][domain_name]:
-            return
+        with basicdb.backends.domain_lock(owner, domain_name):
+            if domain_name not in self._users[owner]:
+                return
 
-        if attr_name in self._users[owner][domain_name][item_name]:
-            del self._users[owner][domain_name][item_name][attr_name]
+            self._remove_all(self._users[owner][domain_name], self._index(owner, domain_name),
+                             item_name, attr_name)
 
+    @_logged
     def delete_attribute_value(self, owner, domain_name, item_name, attr_name, attr_value):
         self._ensure_owner(owner)
-        if (domain_name in self._users[owner] and
-            item_name in self._users[owner][domain_name] and
-            attr_name in self._users[owner][domain_name][item_name]):
-            try:
-                self._users[owner][domain_name][item_name][attr_name].remove(attr_value)
-            except KeyError:
-                pass
-            if not self._users[owner][domain_name][item_name][attr_name]:
-                del self._users[owner][domain_name][item_name][attr_name]
+        with basicdb.backends.domain_lock(owner, domain_name):
+            if domain_name not in self._users[owner]:
+                return
 
+            self._remove_value(self._users[owner][domain_name], self._index(owner, domain_name),
+                               item_name, attr_name, attr_value)
+
+    @_logged
     def add_attribute_value(self, owner, domain_name, item_name, attr_name, attr_value):
         self._ensure_owner(owner)
-        if not item_name in self._users[owner][domain_name]:
-            self._users[owner][domain_name][item_name] = {}
+        with basicdb.backends.domain_lock(owner, domain_name):
+            self._add_value(self._users[owner][domain_name], self._index(owner, domain_name),
+                            item_name, attr_name, attr_value)
+
+    @_logged
+    def _update_items(self, owner, domain_name, updates):
+        """Apply a list of (item_name, additions, replacements, deletions)
+        changes to a domain, like basicdb.backends.apply_changes does, as a
+        single logged change. deletions map attribute names to sets of
+        values, or to None for all of them (which, unlike AllAttributes,
+        can be logged)."""
+        self._ensure_owner(owner)
+        with basicdb.backends.domain_lock(owner, domain_name):
+            domain = self._users[owner][domain_name]
+            index = self._index(owner, domain_name)
+            for item_name, additions, replacements, deletions in updates:
+                if item_name in domain:
+                    old_attrs = domain.attributes(item_name)
+                elif additions or replacements:
+                    old_attrs = None
+                else:
+                    continue
+                item_attrs = dict((attr_name, set(attr_values))
+                                  for attr_name, attr_values in (old_attrs or {}).iteritems())
+                deletions = dict((attr_name, set([basicdb.AllAttributes])
+                                             if attr_values is None else attr_values)
+                                 for attr_name, attr_values in deletions.iteritems())
+                basicdb.backends.apply_changes(item_attrs, additions, replacements, deletions)
+
+                # Readers see the item change all at once
+                domain.set_item(item_name, item_attrs)
+                if index is not None:
+                    if old_attrs is None:
+                        index.add_item(item_name)
+                        old_attrs = {}
+                    for attr_name in set(old_attrs.keys() + item_attrs.keys()):
+                        old_values = old_attrs.get(attr_name, set())
+                        new_values = item_attrs.get(attr_name, set())
+                        for attr_value in old_values - new_values:
+                            index.remove(item_name, attr_name, attr_value)
+                        for attr_value in new_values - old_values:
+                            index.add(item_name, attr_name, attr_value)
+
+    def put_attributes(self, owner, domain_name, item_name, additions, replacements,
+                       expectations=None):
+        with basicdb.backends.item_lock(owner, domain_name, item_name):
+            if expectations and not self.check_expectations(owner, domain_name, item_name, expectations):
+                raise basicdb.exceptions.ConditionalCheckFailed()
+            self._update_items(owner, domain_name, [(item_name, additions, replacements, {})])
+
+    def batch_put_attributes(self, owner, domain_name, additions, replacements):
+        item_names = set(additions.keys() + replacements.keys())
+        with basicdb.backends.item_locks(owner, domain_name, item_names):
+            self._update_items(owner, domain_name,
+                               [(item_name, additions.get(item_name, {}),
+                                 replacements.get(item_name, {}), {})
+                                for item_name in item_names])
 
-        if not attr_name in self._users[owner][domain_name][item_name]:
-            self._users[owner][domain_name][item_name][attr_name] = set()
+    def delete_attributes(self, owner, domain_name, item_name, deletions):
+        self.batch_delete_attributes(owner, domain_name, {item_name: deletions})
 
-        self._users[owner][domain_name][item_name][attr_name].add(attr_value)
+    def batch_delete_attributes(self, owner, domain_name, deletions):
+        self._ensure_owner(owner)
+        if domain_name not in self._users[owner]:
+            return
+
+        updates = []
+        for item_name, item_deletions in deletions.iteritems():
+            item_deletions = dict((attr_name, None if basicdb.AllAttributes in attr_values
+                                              else attr_values)
+                                  for attr_name, attr_values in item_deletions.iteritems())
+            updates.append((item_name, {}, {}, item_deletions))
+        with basicdb.backends.item_locks(owner, domain_name, deletions.keys()):
+            self._update_items(owner, domain_name, updates)
 
     def get_attributes(self, owner, domain_name, item_name):
         self._ensure_owner(owner)
-        return self._users[owner][domain_name][item_name]
+        return self._users[owner][domain_name].attributes(item_name)
+
+    def get_items(self, owner, domain_name, item_names):
+        self._ensure_owner(owner)
+        domain = self._users[owner][domain_name]
+        return ((item_name, domain.attributes(item_name)) for item_name in item_names
+                if item_name in domain)
 
     def _get_all_items(self, owner, domain_name):
         self._ensure_owner(owner)
         return self._users[owner][domain_name]
 
-    def select(self, owner, parsed):
-        self._ensure_owner(owner)
-        domain_name = parsed.table
-        desired_attributes = parsed.columns
+    def _candidate_items(self, owner, parsed):
+        """(item_name, item_attrs) pairs of the items that may match the
+        query, narrowed down using the domain's index if possible, and
+        whether they come in the order requested by the query. item_attrs
+        are in the domain's own form (see DictDomain.get())."""
+        domain = self._get_all_items(owner, parsed.table)
+        index = self._index(owner, parsed.table)
+        if index is None:
+            return domain.iteritems(), False
 
-        if parsed.where_expr != '':
-            f = lambda kv:parsed.where_expr.match(*kv)
-        else:
-            f = lambda _:True
+        # Looking things up in the index may change it (see OrderedIndex),
+        # and what it returns may be changed afterwards, so look up and copy
+        # the candidates with the lock held
+        with basicdb.backends.domain_lock(owner, parsed.table):
+            item_names = basicdb.sqlparser.candidate_items(parsed.where_expr, index)
+            if item_names is not None:
+                item_names = set(item_names)
+            ordered = self._ordered_item_names(index, parsed, item_names, len(domain))
 
-        matching_items = dict(filter(f, self._get_all_items(owner, domain_name).iteritems()))
+        if ordered is not None:
+            return self._get_items_attrs(domain, ordered), True
 
-        if desired_attributes == ['*']:
-            result = matching_items
-        else:
-            result = {}
+        if item_names is None:
+            return domain.iteritems(), False
+        return self._get_items_attrs(domain, item_names), False
+
+    def _get_items_attrs(self, domain, item_names):
+        for item_name in item_names:
+            item_attrs = domain.get(item_name)
+            # The item may be gone if the domain was just recreated
+            if item_attrs is not None:
+                yield item_name, item_attrs
+
+    def _ordered_item_names(self, index, parsed, candidates, item_count):
+        """If the query is sorted and limited and the index can list the items
+        in sort order, the distinct candidate item names in that order.
 
-            return_all = any(isinstance(attr, (basicdb.sqlparser.SqlParser.ItemName, basicdb.sqlparser.SqlParser.Count)) for attr in desired_attributes)
+        The caller stops consuming these once it has enough matches, so
+        only the start of the index is looked at. That only pays off when the
+        index couldn't narrow the search down to a small set already."""
+        if not (parsed.order_by_terms.key and parsed.limit_terms):
+            return None
+        if candidates is not None and len(candidates) * 2 < item_count:
+            return None
+        ordered = index.ordered(parsed.order_by_terms.key,
+                                parsed.order_by_terms.reverse)
+        if ordered is None:
+            return None
 
-            for item, item_attrs in matching_items.iteritems():
-                matching_attributes = dict([(attr_name, attr_values) for attr_name, attr_values in item_attrs.iteritems() if attr_name in desired_attributes])
-                if return_all or matching_attributes:
-                    result[item] = matching_attributes
+        def distinct_candidates():
+            seen = set()
+            for item_name in ordered:
+                if item_name in seen:
+                    continue
+                seen.add(item_name)
+                if candidates is None or item_name in candidates:
+                    yield item_name
+        return distinct_candidates()
 
-        return result
+    def select_iter(self, owner, parsed):
+        self._ensure_owner(owner)
+        predicate = parsed.predicate
+        attributes_of = self._get_all_items(owner, parsed.table).attributes_of
+        candidates, in_order = self._candidate_items(owner, parsed)
+        matches = ((item_name, basicdb.backends.project(attributes_of(item_attrs), parsed.columns))
+                   for item_name, item_attrs in candidates
+                   if predicate(item_name, item_attrs))
+        matches = ((item_name, item_attrs) for item_name, item_attrs in matches
+                   if item_attrs is not None)
+        if in_order:
+            # The result is only ever the first matches in sort order
+            matches = itertools.islice(matches, int(parsed.limit_terms[1]))
+        return matches
+
+    def select(self, owner, parsed):
+        return dict(self.select_iter(owner, parsed))
+
+    def count(self, owner, parsed):
+        self._ensure_owner(owner)
+        if parsed.where_expr == '':
+            return len(self._get_all_items(owner, parsed.table))
+        predicate = parsed.predicate
+        candidates, _ = self._candidate_items(owner, parsed._replace(limit_terms=()))
+        return sum(1 for item_name, item_attrs in candidates
+                   if predicate(item_name, item_attrs))
 
     def domain_metadata(self, owner, domain_name):
         self._ensure_owner(owner)
-        return {"ItemCount": len(self._users[owner][domain_name]),
-                "ItemNamesSizeBytes": sum((len(s) for s in self._users[owner][domain_name].keys())),
-                "AttributeNameCount": '12',
-                "AttributeNamesSizeBytes": '120',
-                "AttributeValueCount": '120',
-                "AttributeValuesSizeBytes": '100020',
-                "Timestamp": str(int(time.time()))}
-
-    def check_expectation(self, owner, domain_name, item_name, expectation):
+        metadata = {"ItemCount": len(self._users[owner][domain_name]),
+                    "ItemNamesSizeBytes": sum((len(s) for s in self._users[owner][domain_name].item_names())),
+                    "AttributeNameCount": '12',
+                    "AttributeNamesSizeBytes": '120',
+                    "AttributeValueCount": '120',
+                    "AttributeValuesSizeBytes": '100020',
+                    "Timestamp": str(int(time.time()))}
+        index = self._index(owner, domain_name)
+        if index is not None:
+            with basicdb.backends.domain_lock(owner, domain_name):
+                metadata["IndexEntryCount"] = len(index)
+                metadata["IndexSizeBytes"] = index.size_bytes()
+        return metadata
+
+    def check_expectations(self, owner, domain_name, item_name, expectations):
         self._ensure_owner(owner)
         if (domain_name not in self._users[owner] or
             item_name not in self._users[owner][domain_name]):
             return False
 
-        return super(FakeBackend, self).check_expectation(owner,
-                                                          domain_name,
-                                                          item_name,
-                                                          expectation)
+        return super(FakeBackend, self).check_expectations(owner,
+                                                           domain_name,
+                                                           item_name,
+                                                           expectations)
 
 driver = FakeBackend
@@ -1,19 +1,56 @@
 import errno
 import glob
+import marshal
 import md5
 import os
 import shutil
+import sys
+import threading
 import time
 
 import basicdb
 import basicdb.backends
+import basicdb.exceptions
 import basicdb.sqlparser
 
+if hasattr(os, 'scandir'):
+    _scandir = os.scandir
+else:
+    try:
+        from scandir import scandir as _scandir
+    except ImportError:
+        _scandir = None
+
+def _list_dir(path):
+    """Iterate over the names in a directory, without reading all of them
+    up front if scandir is available"""
+    if _scandir is None:
+        return iter(os.listdir(path))
+    return (entry.name for entry in _scandir(path))
+
+def _leaf_dirs(path, depth):
+    """Iterate over the directories depth levels below path"""
+    if not depth:
+        yield path
+        return
+    for name in _list_dir(path):
+        if not name.startswith('.'):
+            for leaf_dir in _leaf_dirs(os.path.join(path, name), depth - 1):
+                yield leaf_dir
+
 class FileSystemBackend(basicdb.backends.StorageBackend):
     _domains = {}
 
-    def __init__(self, base_dir='/tmp/mystor'):
+    def __init__(self, base_dir='/tmp/mystor', fanout=None):
+        """fanout is the number of levels of directories named after pairs of
+        hex digits of the MD5 of item names (so 2 gives <domain>/ab/cd/<item>)
+        that items are spread over. It defaults to
+        $BASICDB_FILESYSTEM_FANOUT or 0, and must not be changed once there
+        is data in base_dir."""
         self.base_dir = base_dir
+        if fanout is None:
+            fanout = int(os.environ.get('BASICDB_FILESYSTEM_FANOUT', '0'))
+        self.fanout = fanout
         if not os.path.exists(self.base_dir):
             os.makedirs(self.base_dir)
 
@@ -45,7 +82,11 @@ class FileSystemBackend(basicdb.backends.StorageBackend):
         return os.path.join(self._owner_dir(owner), domain_name)
 
     def _item_dir(self, owner, domain_name, item_name):
-        return os.path.join(self._domain_dir(owner, domain_name), item_name)
+        if not self.fanout:
+            return os.path.join(self._domain_dir(owner, domain_name), item_name)
+        digest = self._md5_hex(item_name)
+        return os.path.join(self._domain_dir(owner, domain_name),
+                            *[digest[i * 2:i * 2 + 2] for i in range(self.fanout)] + [item_name])
 
     def _attr_dir(self, owner, domain_name, item_name, attr_name):
         return os.path.join(self._item_dir(owner, domain_name, item_name), attr_name)
@@ -69,7 +110,7 @@ class FileSystemBackend(basicdb.backends.StorageBackend):
                 raise
 
     def list_domains(self, owner):
-        return [d.split('/')[-1] for d in glob.glob(os.path.join(self._owner_dir(owner), '*'))]
+        return [name for name in _list_dir(self._owner_dir(owner)) if not name.startswith('.')]
 
     def delete_attribute_all(self, owner, domain_name, item_name, attr_name):
         attr_dir = self._attr_dir(owner, domain_name, item_name, attr_name)
@@ -103,18 +144,125 @@ class FileSystemBackend(basicdb.backends.StorageBackend):
                                             attr_name, attr_value), 'w') as fp:
             fp.write(attr_value)
 
+    def _update_item_files(self, item_dir, additions=None, replacements=None, deletions=None):
+        """Apply changes (see basicdb.backends.apply_changes) to an item's
+        directory, listing each affected attribute once and then only
+        writing and removing the value files that change"""
+        def hashed(changes):
+            return dict((attr_name, set(attr_value if attr_value is basicdb.AllAttributes
+                                        else self._md5_hex(attr_value)
+                                        for attr_value in attr_values))
+                        for attr_name, attr_values in (changes or {}).iteritems())
+
+        values = {}
+        for changes in (additions, replacements):
+            for attr_values in (changes or {}).itervalues():
+                for attr_value in attr_values:
+                    values[self._md5_hex(attr_value)] = attr_value
+
+        try:
+            attr_names = set(_list_dir(item_dir))
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            attr_names = set()
+
+        before = {}
+        for changes in (additions, replacements, deletions):
+            for attr_name in (changes or {}):
+                if attr_name in attr_names and attr_name not in before:
+                    before[attr_name] = set(_list_dir(os.path.join(item_dir, attr_name)))
+        after = dict((attr_name, set(filenames)) for attr_name, filenames in before.iteritems())
+        basicdb.backends.apply_changes(after, hashed(additions), hashed(replacements),
+                                       hashed(deletions))
+
+        for attr_name in set(before.keys() + after.keys()):
+            attr_dir = os.path.join(item_dir, attr_name)
+            old, new = before.get(attr_name, set()), after.get(attr_name, set())
+            if new and not old:
+                try:
+                    os.mkdir(attr_dir)
+                except OSError, e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                    os.makedirs(attr_dir)
+            for filename in new - old:
+                with file(os.path.join(attr_dir, filename), 'w') as fp:
+                    fp.write(values[filename])
+            for filename in old - new:
+                try:
+                    os.unlink(os.path.join(attr_dir, filename))
+                except OSError, e:
+                    if e.errno != errno.ENOENT:
+                        raise
+            if old and not new:
+                try:
+                    os.rmdir(attr_dir)
+                except OSError, e:
+                    if e.errno not in (errno.ENOTEMPTY, errno.ENOENT):
+                        raise
+
+    def put_attributes(self, owner, domain_name, item_name, additions, replacements,
+                       expectations=None):
+        with basicdb.backends.item_lock(owner, domain_name, item_name):
+            if expectations and not self.check_expectations(owner, domain_name, item_name, expectations):
+                raise basicdb.exceptions.ConditionalCheckFailed()
+            self._update_item_files(self._item_dir(owner, domain_name, item_name),
+                                    additions, replacements)
+
+    def delete_attributes(self, owner, domain_name, item_name, deletions):
+        with basicdb.backends.item_lock(owner, domain_name, item_name):
+            self._update_item_files(self._item_dir(owner, domain_name, item_name),
+                                    deletions=deletions)
+
     def get_attributes(self, owner, domain_name, item_name):
         retval = {}
         for attr_dir in glob.glob(os.path.join(self._item_dir(owner, domain_name, item_name), '*')):
             attr_name = attr_dir.split('/')[-1]
-            retval[attr_name] = set()
-            for attr_value_file in glob.glob(os.path.join(attr_dir, '*')):
-                with file(attr_value_file, 'r') as fp:
-                    retval[attr_name].add(fp.read())
+            retval[attr_name] = self._read_attr_values(attr_dir)
         return retval
 
+    def get_items(self, owner, domain_name, item_names):
+        for item_name in item_names:
+            if os.path.isdir(self._item_dir(owner, domain_name, item_name)):
+                yield item_name, self.get_attributes(owner, domain_name, item_name)
+
+    def _read_attr_values(self, attr_dir):
+        values = set()
+        for attr_value_file in glob.glob(os.path.join(attr_dir, '*')):
+            try:
+                fp = file(attr_value_file, 'r')
+            except IOError, e:
+                # Removed by a concurrent change since it was listed
+                if e.errno == errno.ENOENT:
+                    continue
+                raise
+            with fp:
+                values.add(fp.read())
+        return values
+
+    def _get_some_attributes(self, owner, domain_name, item_name, attr_names):
+        """Like get_attributes, but only reads the given attributes"""
+        retval = {}
+        for attr_name in attr_names:
+            attr_dir = self._attr_dir(owner, domain_name, item_name, attr_name)
+            if os.path.isdir(attr_dir):
+                retval[attr_name] = self._read_attr_values(attr_dir)
+        return retval
+
+    def _iter_items_names(self, owner, domain_name):
+        """Iterate over the names of the items in a domain as the directory
+        tree is walked"""
+        domain_dir = self._domain_dir(owner, domain_name)
+        if not os.path.isdir(domain_dir):
+            return
+        for leaf_dir in _leaf_dirs(domain_dir, self.fanout):
+            for item_name in _list_dir(leaf_dir):
+                if not item_name.startswith('.'):
+                    yield item_name
+
     def _get_all_items_names(self, owner, domain_name):
-        return [d.split('/')[-1] for d in glob.glob(os.path.join(self._domain_dir(owner, domain_name), '*'))]
+        return list(self._iter_items_names(owner, domain_name))
 
     def _get_all_items(self, owner, domain_name):
         retval = {}
@@ -122,32 +270,34 @@ class FileSystemBackend(basicdb.backends.StorageBackend):
             retval[item_name] = self.get_attributes(owner, domain_name, item_name)
         return retval
 
-    def select(self, owner, parsed):
-        domain_name = parsed.table
-        desired_attributes = parsed.columns
-
-        if parsed.where_expr != '':
-            f = lambda kv:parsed.where_expr.match(*kv)
-        else:
-            f = lambda _:True
-
-        matching_items = dict(filter(f, self._get_all_items(owner, domain_name).iteritems()))
+    def select_iter(self, owner, parsed):
+        predicate = parsed.predicate
+        for item_name in self._iter_items_names(owner, parsed.table):
+            item_attrs = self.get_attributes(owner, parsed.table, item_name)
+            if predicate(item_name, item_attrs):
+                item_attrs = basicdb.backends.project(item_attrs, parsed.columns)
+                if item_attrs is not None:
+                    yield item_name, item_attrs
 
-        if desired_attributes == ['*']:
-            result = matching_items
-        else:
-            result = {}
+    def select(self, owner, parsed):
+        return dict(self.select_iter(owner, parsed))
 
-            return_all = any(isinstance(attr, (basicdb.sqlparser.SqlParser.ItemName, basicdb.sqlparser.SqlParser.Count)) for attr in desired_attributes)
-            for item, item_attrs in matching_items.iteritems():
-                matching_attributes = dict([(attr_name, attr_values) for attr_name, attr_values in item_attrs.iteritems() if attr_name in desired_attributes])
-                if return_all or matching_attributes:
-                    result[item] = matching_attributes
+    def count(self, owner, parsed):
+        item_names = self._iter_items_names(owner, parsed.table)
+        if parsed.where_expr == '':
+            return sum(1 for _ in item_names)
 
-        return result
+        # The predicate only looks at the attributes named in the query, so
+        # there's no need to read any others
+        attr_names = set(parsed.where_expr.identifiers())
+        attr_names.discard('itemName()')
+        predicate = parsed.predicate
+        return sum(1 for item_name in item_names
+                   if predicate(item_name, self._get_some_attributes(owner, parsed.table,
+                                                                     item_name, attr_names)))
 
     def domain_metadata(self, owner, domain_name):
-        return {"ItemCount": len(self._get_all_items_names(owner, domain_name)),
+        return {"ItemCount": sum(1 for _ in self._iter_items_names(owner, domain_name)),
                 "ItemNamesSizeBytes": '120',
                 "AttributeNameCount": '12',
                 "AttributeNamesSizeBytes": '120',
@@ -155,4 +305,163 @@ class FileSystemBackend(basicdb.backends.StorageBackend):
                 "AttributeValuesSizeBytes": '100020',
                 "Timestamp": str(int(time.time()))}
 
-driver = FileSystemBackend
+
+class PackedFileSystemBackend(FileSystemBackend):
+    """Keeps each item in a single file (in place of the item's directory),
+    holding its attributes as a marshalled dict mapping attribute names to
+    lists of values. Files are replaced atomically by writing a temporary
+    file next to them and renaming it into place, so readers see either
+    the old or the new version of an item. An item without attributes has
+    no file."""
+
+    def _read_item(self, path):
+        """The attributes stored in an item file as a dict of sets, or None
+        if there is no such file"""
+        try:
+            with open(path, 'rb') as fp:
+                data = fp.read()
+        except IOError, e:
+            if e.errno in (errno.ENOENT, errno.EISDIR):
+                return None
+            raise
+        return dict((attr_name, set(attr_values))
+                    for attr_name, attr_values in marshal.loads(data).iteritems())
+
+    def _write_item(self, path, item_attrs):
+        if not item_attrs:
+            try:
+                os.unlink(path)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+            return
+
+        dirname, basename = os.path.split(path)
+        tmp_path = os.path.join(dirname, '.%s.%d.%d.tmp' % (basename, os.getpid(),
+                                                            threading.current_thread().ident))
+        data = marshal.dumps(dict((attr_name, list(attr_values))
+                                  for attr_name, attr_values in item_attrs.iteritems()), 2)
+        try:
+            fp = open(tmp_path, 'wb')
+        except IOError, e:
+            if e.errno != errno.ENOENT or not self.fanout:
+                raise
+            os.makedirs(dirname)
+            fp = open(tmp_path, 'wb')
+        with fp:
+            fp.write(data)
+        os.rename(tmp_path, path)
+
+    def _update_item(self, owner, domain_name, item_name, additions=None, replacements=None,
+                     deletions=None):
+        """Apply changes (see basicdb.backends.apply_changes) to an item with
+        a single read and write"""
+        path = self._item_dir(owner, domain_name, item_name)
+        with basicdb.backends.item_lock(owner, domain_name, item_name):
+            existing = self._read_item(path)
+            item_attrs = existing or {}
+            basicdb.backends.apply_changes(item_attrs, additions, replacements, deletions)
+            if existing is None and not item_attrs:
+                return
+            self._write_item(path, item_attrs)
+
+    def put_attributes(self, owner, domain_name, item_name, additions, replacements,
+                       expectations=None):
+        with basicdb.backends.item_lock(owner, domain_name, item_name):
+            if expectations and not self.check_expectations(owner, domain_name, item_name, expectations):
+                raise basicdb.exceptions.ConditionalCheckFailed()
+            self._update_item(owner, domain_name, item_name, additions, replacements)
+
+    def delete_attributes(self, owner, domain_name, item_name, deletions):
+        if os.path.isdir(self._domain_dir(owner, domain_name)):
+            self._update_item(owner, domain_name, item_name, deletions=deletions)
+
+    def batch_delete_attributes(self, owner, domain_name, deletions):
+        if os.path.isdir(self._domain_dir(owner, domain_name)):
+            for item_name, item_deletions in deletions.iteritems():
+                self._update_item(owner, domain_name, item_name, deletions=item_deletions)
+
+    def add_attribute_value(self, owner, domain_name, item_name, attr_name, attr_value):
+        self.put_attributes(owner, domain_name, item_name, {attr_name: set([attr_value])}, {})
+
+    def delete_attribute_all(self, owner, domain_name, item_name, attr_name):
+        self.delete_attributes(owner, domain_name, item_name,
+                               {attr_name: set([basicdb.AllAttributes])})
+
+    def delete_attribute_value(self, owner, domain_name, item_name, attr_name, attr_value):
+        self.delete_attributes(owner, domain_name, item_name, {attr_name: set([attr_value])})
+
+    def get_attributes(self, owner, domain_name, item_name):
+        return self._read_item(self._item_dir(owner, domain_name, item_name)) or {}
+
+    def get_items(self, owner, domain_name, item_names):
+        for item_name in item_names:
+            item_attrs = self._read_item(self._item_dir(owner, domain_name, item_name))
+            if item_attrs is not None:
+                yield item_name, item_attrs
+
+    def _get_some_attributes(self, owner, domain_name, item_name, attr_names):
+        item_attrs = self.get_attributes(owner, domain_name, item_name)
+        return dict((attr_name, item_attrs[attr_name])
+                    for attr_name in attr_names if attr_name in item_attrs)
+
+LAYOUTS = {'directories': FileSystemBackend,
+           'packed': PackedFileSystemBackend}
+
+def driver(base_dir='/tmp/mystor', layout=None, fanout=None):
+    """Create a filesystem backend using the given layout (see LAYOUTS),
+    which defaults to $BASICDB_FILESYSTEM_LAYOUT or 'directories'"""
+    if layout is None:
+        layout = os.environ.get('BASICDB_FILESYSTEM_LAYOUT', 'directories')
+    return LAYOUTS[layout](base_dir, fanout)
+
+def migrate(base_dir, fanout=None):
+    """Convert the items under base_dir from the directories layout to the
+    packed one. Must not run while a backend is using base_dir.
+
+    Each item is written to a temporary file, its directory is moved aside
+    and the file renamed into its place, so an interrupted migration can be
+    resumed by running it again. Returns the number of migrated items."""
+    old = FileSystemBackend(base_dir, fanout)
+    new = PackedFileSystemBackend(base_dir, fanout)
+    migrated = 0
+    for owner in os.listdir(base_dir):
+        for domain_name in old.list_domains(owner):
+            for leaf_dir in _leaf_dirs(old._domain_dir(owner, domain_name), old.fanout):
+                for entry in os.listdir(leaf_dir):
+                    if entry.startswith('.') and entry.endswith('.old'):
+                        # Left behind by an interrupted migration
+                        item_dir = os.path.join(leaf_dir, entry[1:-len('.old')])
+                        if os.path.exists(item_dir):
+                            shutil.rmtree(os.path.join(leaf_dir, entry))
+                        else:
+                            os.rename(os.path.join(leaf_dir, entry), item_dir)
+
+                for item_name in os.listdir(leaf_dir):
+                    item_dir = os.path.join(leaf_dir, item_name)
+                    if item_name.startswith('.') or not os.path.isdir(item_dir):
+                        continue
+                    item_attrs = old.get_attributes(owner, domain_name, item_name)
+                    tmp_path = os.path.join(leaf_dir, '.%s.migrate.tmp' % (item_name,))
+                    old_dir = os.path.join(leaf_dir, '.%s.old' % (item_name,))
+                    new._write_item(tmp_path, item_attrs)
+                    os.rename(item_dir, old_dir)
+                    if item_attrs:
+                        os.rename(tmp_path, item_dir)
+                    shutil.rmtree(old_dir)
+                    migrated += 1
+    return migrated
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if len(argv) != 1:
+        print "Usage: python -m basicdb.backends.filesystem <base dir>"
+        print
+        print "Converts a filesystem backend's data to the packed layout."
+        return 1
+    print "Migrated %d items" % (migrate(argv[0]),)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
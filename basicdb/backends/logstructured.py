@@ -0,0 +1,337 @@
+import errno
+import marshal
+import mmap
+import os
+import Queue
+import shutil
+import struct
+import sys
+import threading
+import time
+import traceback
+import zlib
+
+import basicdb
+import basicdb.backends
+import basicdb.exceptions
+import basicdb.sqlparser
+
+"""
+Data model:
+
+Each domain is a single append-only file, base_dir/<owner>/<domain>.log,
+holding a sequence of records. A record holds the complete state of one
+item (its name and a dict mapping attribute names to lists of values) and
+is preceded by a header with its length and CRC32. Any change to an item
+appends a new record for it, so the latest record for an item wins. A
+record without attributes marks the item as deleted.
+
+An in-memory index maps each item name to the location of its latest
+record. It is rebuilt by scanning the log when a domain is first used. A
+torn record at the end of the log (from a crash in the middle of a write)
+is cut off at that point.
+
+Records are read through an mmap of the log. Once enough of the log is
+taken up by outdated records, a background thread compacts it by copying
+the live records to a new file and renaming it over the old one.
+
+Only one process may use a given base_dir at a time.
+"""
+
+_HEADER = struct.Struct('<II')
+
+# A domain's log is compacted once it has at least this many bytes of
+# outdated records and they make up at least half of it.
+COMPACTION_MIN_GARBAGE = 1024 * 1024
+
+class _LogDomain(object):
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        self.index = {}
+        self.garbage = 0
+        self.compaction_pending = False
+        self._closed = False
+        self._map = None
+        self._mapped_size = 0
+        self._open()
+
+    def _open(self):
+        self._fp = open(self.path, 'ab+')
+        self._fp.seek(0, os.SEEK_END)
+        self.size = self._fp.tell()
+        self._remap()
+        self._scan()
+
+    def _remap(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._mapped_size = self.size
+        if self.size:
+            self._map = mmap.mmap(self._fp.fileno(), self.size, access=mmap.ACCESS_READ)
+
+    def _scan(self):
+        offset = 0
+        while offset + _HEADER.size <= self.size:
+            length, crc = _HEADER.unpack(self._map[offset:offset + _HEADER.size])
+            start = offset + _HEADER.size
+            payload = self._map[start:start + length]
+            if len(payload) != length or zlib.crc32(payload) & 0xffffffff != crc:
+                break
+            item_name, item_attrs = marshal.loads(payload)
+            self._replace_entry(item_name, offset, _HEADER.size + length, bool(item_attrs))
+            offset = start + length
+
+        if offset != self.size:
+            # Get rid of a partially written record at the end
+            self._fp.truncate(offset)
+            self.size = offset
+            self._remap()
+
+    def _replace_entry(self, item_name, offset, length, live):
+        if item_name in self.index:
+            self.garbage += self.index[item_name][1]
+        if live:
+            self.index[item_name] = (offset, length)
+        else:
+            self.index.pop(item_name, None)
+            self.garbage += length
+
+    def _read(self, offset, length):
+        if offset + length > self._mapped_size:
+            self._remap()
+        return marshal.loads(self._map[offset + _HEADER.size:offset + length])[1]
+
+    def get(self, item_name):
+        """The attributes of an item as a dict of lists, or None if it
+        doesn't exist"""
+        with self.lock:
+            location = self.index.get(item_name)
+            if location is None:
+                return None
+            return self._read(*location)
+
+    def put(self, item_name, item_attrs):
+        payload = marshal.dumps((item_name, item_attrs), 2)
+        record = _HEADER.pack(len(payload), zlib.crc32(payload) & 0xffffffff) + payload
+        with self.lock:
+            self._fp.write(record)
+            self._fp.flush()
+            self._replace_entry(item_name, self.size, len(record), bool(item_attrs))
+            self.size += len(record)
+
+    def item_names(self):
+        with self.lock:
+            return self.index.keys()
+
+    def needs_compaction(self):
+        return (self.garbage >= COMPACTION_MIN_GARBAGE and
+                self.garbage * 2 >= self.size)
+
+    def compact(self):
+        with self.lock:
+            self.compaction_pending = False
+            if self._closed:
+                return
+            if self._mapped_size < self.size:
+                self._remap()
+            tmp_path = self.path + '.compact'
+            index = {}
+            offset = 0
+            with open(tmp_path, 'wb') as fp:
+                for item_name, (old_offset, length) in sorted(self.index.iteritems(),
+                                                              key=lambda x: x[1][0]):
+                    fp.write(self._map[old_offset:old_offset + length])
+                    index[item_name] = (offset, length)
+                    offset += length
+                fp.flush()
+                os.fsync(fp.fileno())
+            os.rename(tmp_path, self.path)
+            self._close_files()
+            self._fp = open(self.path, 'ab+')
+            self.size = offset
+            self.index = index
+            self.garbage = 0
+            self._remap()
+
+    def _close_files(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._fp.close()
+
+    def close(self):
+        with self.lock:
+            if not self._closed:
+                self._closed = True
+                self._close_files()
+
+
+class LogStructuredBackend(basicdb.backends.StorageBackend):
+    def __init__(self, base_dir='/tmp/mylogstor'):
+        self.base_dir = base_dir
+        if not os.path.exists(self.base_dir):
+            os.makedirs(self.base_dir)
+        self._domains = {}
+        self._domains_lock = threading.Lock()
+        self._compaction_queue = Queue.Queue()
+        self._compactor = threading.Thread(target=self._compact_domains)
+        self._compactor.daemon = True
+        self._compactor.start()
+
+    def _compact_domains(self):
+        while True:
+            domain = self._compaction_queue.get()
+            if domain is None:
+                return
+            try:
+                domain.compact()
+            except Exception:
+                print >> sys.stderr, "Compacting %s failed:" % (domain.path,)
+                traceback.print_exc()
+
+    def close(self):
+        self._compaction_queue.put(None)
+        self._compactor.join()
+        self._close_domains()
+
+    def _close_domains(self):
+        with self._domains_lock:
+            for domain in self._domains.values():
+                domain.close()
+            self._domains = {}
+
+    def _reset(self):
+        self._close_domains()
+        try:
+            shutil.rmtree(self.base_dir)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+        os.mkdir(self.base_dir)
+
+    def _owner_dir(self, owner):
+        owner_dir = os.path.join(self.base_dir, owner)
+        if not os.path.exists(owner_dir):
+            os.makedirs(owner_dir)
+        return owner_dir
+
+    def _domain_path(self, owner, domain_name):
+        return os.path.join(self._owner_dir(owner), domain_name + '.log')
+
+    def _domain(self, owner, domain_name):
+        key = (owner, domain_name)
+        with self._domains_lock:
+            if key not in self._domains:
+                path = self._domain_path(owner, domain_name)
+                if not os.path.exists(path):
+                    raise KeyError(domain_name)
+                self._domains[key] = _LogDomain(path)
+            return self._domains[key]
+
+    def _update_item(self, owner, domain_name, item_name, additions=None,
+                     replacements=None, deletions=None):
+        """Apply changes (see basicdb.backends.apply_changes) to an item and
+        write it back as one record"""
+        domain = self._domain(owner, domain_name)
+        with domain.lock:
+            existing = domain.get(item_name)
+            item_attrs = dict((attr_name, set(attr_values)) for attr_name, attr_values
+                              in (existing or {}).iteritems())
+            basicdb.backends.apply_changes(item_attrs, additions, replacements, deletions)
+            item_attrs = dict((attr_name, list(attr_values))
+                              for attr_name, attr_values in item_attrs.iteritems())
+            if existing is None and not item_attrs:
+                return
+            domain.put(item_name, item_attrs)
+            if domain.needs_compaction() and not domain.compaction_pending:
+                domain.compaction_pending = True
+                self._compaction_queue.put(domain)
+
+    def compact(self, owner, domain_name):
+        """Compact a domain's log right away"""
+        self._domain(owner, domain_name).compact()
+
+    def create_domain(self, owner, domain_name):
+        open(self._domain_path(owner, domain_name), 'ab').close()
+
+    def delete_domain(self, owner, domain_name):
+        with self._domains_lock:
+            domain = self._domains.pop((owner, domain_name), None)
+        if domain is not None:
+            domain.close()
+        try:
+            os.unlink(self._domain_path(owner, domain_name))
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def list_domains(self, owner):
+        return [filename[:-len('.log')] for filename in os.listdir(self._owner_dir(owner))
+                if filename.endswith('.log')]
+
+    def put_attributes(self, owner, domain_name, item_name, additions, replacements,
+                       expectations=None):
+        domain = self._domain(owner, domain_name)
+        with domain.lock:
+            if expectations and not self.check_expectations(owner, domain_name, item_name, expectations):
+                raise basicdb.exceptions.ConditionalCheckFailed()
+            self._update_item(owner, domain_name, item_name, additions, replacements)
+
+    def delete_attributes(self, owner, domain_name, item_name, deletions):
+        if os.path.exists(self._domain_path(owner, domain_name)):
+            self._update_item(owner, domain_name, item_name, deletions=deletions)
+
+    def add_attribute_value(self, owner, domain_name, item_name, attr_name, attr_value):
+        self.put_attributes(owner, domain_name, item_name, {attr_name: set([attr_value])}, {})
+
+    def delete_attribute_all(self, owner, domain_name, item_name, attr_name):
+        self.delete_attributes(owner, domain_name, item_name,
+                               {attr_name: set([basicdb.AllAttributes])})
+
+    def delete_attribute_value(self, owner, domain_name, item_name, attr_name, attr_value):
+        self.delete_attributes(owner, domain_name, item_name, {attr_name: set([attr_value])})
+
+    def get_attributes(self, owner, domain_name, item_name):
+        item_attrs = self._domain(owner, domain_name).get(item_name) or {}
+        return dict((attr_name, set(attr_values)) for attr_name, attr_values in item_attrs.iteritems())
+
+    def get_items(self, owner, domain_name, item_names):
+        domain = self._domain(owner, domain_name)
+        for item_name in item_names:
+            item_attrs = domain.get(item_name)
+            if item_attrs is not None:
+                yield item_name, dict((attr_name, set(attr_values))
+                                      for attr_name, attr_values in item_attrs.iteritems())
+
+    def select_iter(self, owner, parsed):
+        predicate = parsed.predicate
+        domain = self._domain(owner, parsed.table)
+        for item_name, item_attrs in self.get_items(owner, parsed.table, domain.item_names()):
+            if predicate(item_name, item_attrs):
+                item_attrs = basicdb.backends.project(item_attrs, parsed.columns)
+                if item_attrs is not None:
+                    yield item_name, item_attrs
+
+    def select(self, owner, parsed):
+        return dict(self.select_iter(owner, parsed))
+
+    def count(self, owner, parsed):
+        domain = self._domain(owner, parsed.table)
+        if parsed.where_expr == '':
+            return len(domain.index)
+        return super(LogStructuredBackend, self).count(owner, parsed)
+
+    def domain_metadata(self, owner, domain_name):
+        domain = self._domain(owner, domain_name)
+        return {"ItemCount": len(domain.index),
+                "ItemNamesSizeBytes": sum(len(s) for s in domain.item_names()),
+                "AttributeNameCount": '12',
+                "AttributeNamesSizeBytes": '120',
+                "AttributeValueCount": '120',
+                "AttributeValuesSizeBytes": '100020',
+                "LogSizeBytes": domain.size,
+                "Timestamp": str(int(time.time()))}
+
+driver = LogStructuredBackend
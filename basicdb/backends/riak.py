@@ -8,6 +8,7 @@ import uuid
 
 import basicdb
 import basicdb.backends
+import basicdb.exceptions
 import basicdb.sqlparser
 
 """
@@ -188,6 +189,49 @@ class RiakBackend(basicdb.backends.StorageBackend):
 
         item_object.store()
 
+    def _update_item(self, domain_bucket, item_name, additions=None, replacements=None,
+                     deletions=None):
+        """Apply changes (see basicdb.backends.apply_changes) to an item with
+        a single fetch and store"""
+        item_object = domain_bucket.get(item_name)
+        if item_object.data is None:
+            item_attrs = {}
+        else:
+            item_attrs = dict((attr_name, set(attr_values))
+                              for attr_name, attr_values in item_object.data.iteritems())
+        basicdb.backends.apply_changes(item_attrs, additions, replacements, deletions)
+        if item_object.data is None and not item_attrs:
+            return
+        item_object.data = dict((attr_name, list(attr_values))
+                                for attr_name, attr_values in item_attrs.iteritems())
+        item_object.store()
+
+    def put_attributes(self, owner, domain_name, item_name, additions, replacements,
+                       expectations=None):
+        with basicdb.backends.item_lock(owner, domain_name, item_name):
+            if expectations and not self.check_expectations(owner, domain_name, item_name, expectations):
+                raise basicdb.exceptions.ConditionalCheckFailed()
+            domain_bucket = self._domain_bucket(owner, domain_name)
+            self._update_item(domain_bucket, item_name, additions, replacements)
+
+    def batch_put_attributes(self, owner, domain_name, additions, replacements):
+        domain_bucket = self._domain_bucket(owner, domain_name)
+        for item_name in set(additions.keys() + replacements.keys()):
+            with basicdb.backends.item_lock(owner, domain_name, item_name):
+                self._update_item(domain_bucket, item_name,
+                                  additions.get(item_name), replacements.get(item_name))
+
+    def delete_attributes(self, owner, domain_name, item_name, deletions):
+        self.batch_delete_attributes(owner, domain_name, {item_name: deletions})
+
+    def batch_delete_attributes(self, owner, domain_name, deletions):
+        domain_bucket = self._domain_bucket(owner, domain_name)
+        if domain_bucket is None:
+            return
+        for item_name, item_deletions in deletions.iteritems():
+            with basicdb.backends.item_lock(owner, domain_name, item_name):
+                self._update_item(domain_bucket, item_name, deletions=item_deletions)
+
     def get_attributes(self, owner, domain_name, item_name):
         try:
             item_object = self._item_object(owner, domain_name, item_name)
@@ -197,6 +241,15 @@ class RiakBackend(basicdb.backends.StorageBackend):
             pass
         return {}
 
+    def get_items(self, owner, domain_name, item_names):
+        domain_bucket = self._domain_bucket(owner, domain_name)
+        if domain_bucket is None:
+            return
+        for item_name in item_names:
+            item_object = domain_bucket.get(item_name)
+            if item_object.data is not None:
+                yield item_name, dict([(attr_name, set(attr_values)) for attr_name, attr_values in item_object.data.iteritems()])
+
     def select(self, owner, parsed):
         domain_name = parsed.table
         desired_attributes = parsed.columns
@@ -276,4 +329,9 @@ class RiakBackend(basicdb.backends.StorageBackend):
                 "AttributeValuesSizeBytes": '100020',
                 "Timestamp": str(int(time.time()))}
 
+# Conditional puts are only atomic within one process (see
+# basicdb.backends.item_lock), so several server processes mustn't share the
+# data until they are made with vclock-based conditional stores
+MULTIPROCESS = False
+
 driver = RiakBackend
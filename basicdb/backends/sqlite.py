@@ -0,0 +1,553 @@
+import contextlib
+import itertools
+import os
+import re
+import sqlite3
+import threading
+import time
+
+import basicdb
+import basicdb.backends
+import basicdb.exceptions
+import basicdb.sqlparser as sqlparser
+
+"""
+Data model:
+
+domains holds a row per (owner, domain name), items a row per item in a
+domain and attrs a row per (item, attribute name, value) triple. attrs also
+carries the domain id so that it can be searched by (domain, name, value)
+without going through items. Items are removed once they have no
+attributes left.
+
+Select expressions are translated into SQL (see _WhereTranslator), so
+filtering, sorting and LIMIT are done by SQLite using its indexes. Where
+part of an expression can't be translated, the translatable part is used to
+narrow down the items and the compiled predicate makes the final call.
+"""
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS domains (
+    id INTEGER PRIMARY KEY,
+    owner TEXT NOT NULL,
+    name TEXT NOT NULL,
+    UNIQUE (owner, name)
+);
+CREATE TABLE IF NOT EXISTS items (
+    id INTEGER PRIMARY KEY,
+    domain_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    UNIQUE (domain_id, name)
+);
+CREATE TABLE IF NOT EXISTS attrs (
+    domain_id INTEGER NOT NULL,
+    item_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (item_id, name, value)
+);
+CREATE INDEX IF NOT EXISTS attrs_by_value ON attrs (domain_id, name, value);
+"""
+
+def _like(value, pattern):
+    return re.match(sqlparser.regex_from_like(pattern), value) is not None
+
+_OPERATORS = {'<': '<', '<=': '<=', '>': '>', '>=': '>=',
+              '=': '=', '==': '=', '!=': '=', '<>': '='}
+
+class _Untranslatable(Exception):
+    pass
+
+class _WhereTranslator(object):
+    """Translates a parsed WHERE expression into an SQL condition on the
+    items table, following the semantics of sqlparser.compile_where
+
+    Parameters are collected in self.params and referred to by name."""
+    def __init__(self, params):
+        self.params = params
+        self._aliases = itertools.count()
+
+    def param(self, value):
+        name = 'p%d' % (len(self.params),)
+        self.params[name] = value
+        return ':' + name
+
+    def alias(self):
+        return 'a%d' % (next(self._aliases),)
+
+    def exists(self, node):
+        if isinstance(node, sqlparser.SqlParser.Intersection):
+            return self._join('AND', [self.exists(arg) for arg in node.args])
+        elif isinstance(node, sqlparser.SqlParser.BoolOr):
+            return self._join('OR', [self.exists(arg) for arg in node.args])
+        elif isinstance(node, sqlparser.SqlParser.BoolAnd):
+            conditions = []
+            for group in sqlparser._connected(node.args):
+                if len(group) == 1:
+                    conditions.append(self.exists(group[0]))
+                else:
+                    conditions.append(self.enumerate(group))
+            return self._join('AND', conditions)
+        return self.enumerate([node])
+
+    def _join(self, operator, conditions):
+        return '(' + (' %s ' % (operator,)).join(conditions) + ')'
+
+    def enumerate(self, nodes):
+        """Condition telling whether some combination of the values of the
+        attributes the nodes refer to satisfies all of them"""
+        names = []
+        for node in nodes:
+            sqlparser._bound_names(node, names)
+        aliases = dict((name, self.alias()) for name in names)
+        self._correlated = False
+        condition = self._join('AND', [self.compile(node, aliases) for node in nodes])
+        if not names:
+            return condition
+
+        if self._conjunctive(nodes) and not self._correlated:
+            # Every comparison fails for a missing attribute, so only
+            # combinations of existing values need to be looked at, and
+            # those can be found through the (domain, name, value) index.
+            first = aliases[names[0]]
+            tables = ['attrs %s' % (first,)]
+            for name in names[1:]:
+                tables.append('JOIN attrs %s ON %s.item_id = %s.item_id AND %s.name = %s' %
+                              (aliases[name], aliases[name], first, aliases[name], self.param(name)))
+            return ('items.id IN (SELECT %s.item_id FROM %s WHERE %s.domain_id = :domain_id '
+                    'AND %s.name = %s AND %s)' % (first, ' '.join(tables), first, first,
+                                                  self.param(names[0]), condition))
+
+        # A missing attribute takes part as a single NULL, like it does in
+        # compile_where
+        tables = ['(SELECT 1)']
+        for name in names:
+            tables.append('LEFT JOIN attrs %s ON %s.item_id = items.id AND %s.name = %s' %
+                          (aliases[name], aliases[name], aliases[name], self.param(name)))
+        return 'EXISTS (SELECT 1 FROM %s WHERE %s)' % (' '.join(tables), condition)
+
+    def _conjunctive(self, nodes):
+        for node in nodes:
+            if isinstance(node, (sqlparser.SqlParser.BoolOr, sqlparser.SqlParser.BoolNot)):
+                return False
+            if (isinstance(node, (sqlparser.SqlParser.BoolAnd, sqlparser.SqlParser.Intersection)) and
+                not self._conjunctive(node.args)):
+                return False
+        return True
+
+    def compile(self, node, aliases):
+        if isinstance(node, (sqlparser.SqlParser.BoolAnd, sqlparser.SqlParser.Intersection)):
+            return self._join('AND', [self.compile(arg, aliases) for arg in node.args])
+        elif isinstance(node, sqlparser.SqlParser.BoolOr):
+            return self._join('OR', [self.compile(arg, aliases) for arg in node.args])
+        elif isinstance(node, sqlparser.SqlParser.BoolNot):
+            return '(NOT %s)' % (self.compile(node.args[0], aliases),)
+        elif isinstance(node, sqlparser.SqlParser.BetweenXAndY):
+            return self._between(node, aliases)
+        elif isinstance(node, sqlparser.SqlParser.BinaryComparisonOperator):
+            return self._comparison(node, aliases)
+        raise _Untranslatable()
+
+    def operand(self, node, aliases):
+        if isinstance(node, sqlparser.SqlParser.Literal):
+            return 'const', node.get_single_value_or_raise()
+        elif isinstance(node, sqlparser.SqlParser.ValueList):
+            return 'list', [v.get_single_value_or_raise() for v in node._value]
+        elif isinstance(node, sqlparser.SqlParser.Null):
+            return 'null', None
+        elif isinstance(node, sqlparser.SqlParser.ItemName):
+            self._correlated = True
+            return 'single', 'items.name'
+        elif isinstance(node, sqlparser.SqlParser.EveryIdentifier):
+            self._correlated = True
+            return 'every', node.reference
+        elif isinstance(node, sqlparser.SqlParser.Identifier):
+            return 'single', '%s.value' % (aliases[node.reference],)
+        raise _Untranslatable()
+
+    def test(self, kind, value, test, negate=False):
+        """Condition applying test (a function turning an SQL expression
+        into a condition on it) to an operand"""
+        if kind == 'single':
+            return '(%s IS NOT NULL AND %s%s)' % (value, negate and 'NOT ' or '', test(value))
+        elif kind == 'every':
+            alias = self.alias()
+            values = ('SELECT 1 FROM attrs %s WHERE %s.item_id = items.id AND %s.name = %s' %
+                      (alias, alias, alias, self.param(value)))
+            failing = '%s AND NOT %s' % (values, test('%s.value' % (alias,)))
+            if negate:
+                return 'EXISTS (%s)' % (failing,)
+            return '(EXISTS (%s) AND NOT EXISTS (%s))' % (values, failing)
+        raise _Untranslatable()
+
+    def _comparison(self, node, aliases):
+        symbol = node.reprsymbol
+        left_kind, left = self.operand(node.args[0], aliases)
+        right_kind, right = self.operand(node.args[1], aliases)
+
+        if not isinstance(symbol, basestring):
+            # IS NOT NULL
+            if right_kind != 'null':
+                raise _Untranslatable()
+            return self.test(left_kind, left, lambda v: '1')
+        elif symbol == 'IS':
+            return '0'
+        elif symbol == 'IN':
+            if right_kind != 'list':
+                raise _Untranslatable()
+            values = ', '.join(self.param(v) for v in right)
+            return self.test(left_kind, left, lambda v: '(%s IN (%s))' % (v, values))
+        elif symbol == 'LIKE':
+            if right_kind != 'const':
+                raise _Untranslatable()
+            pattern = self.param(right)
+            return self.test(left_kind, left, lambda v: 'basicdb_like(%s, %s)' % (v, pattern))
+
+        operator = _OPERATORS[symbol]
+        negate = symbol in ('!=', '<>')
+        if right_kind == 'const' and left_kind in ('single', 'every'):
+            value = self.param(right)
+            return self.test(left_kind, left, lambda v: '(%s %s %s)' % (v, operator, value), negate)
+        elif left_kind == 'const' and right_kind in ('single', 'every'):
+            value = self.param(left)
+            return self.test(right_kind, right, lambda v: '(%s %s %s)' % (value, operator, v), negate)
+        raise _Untranslatable()
+
+    def _between(self, node, aliases):
+        bounds = [self.operand(arg, aliases) for arg in node.args[1:]]
+        if any(kind != 'const' for kind, _ in bounds):
+            raise _Untranslatable()
+        lower = self.param(min(value for _, value in bounds))
+        upper = self.param(max(value for _, value in bounds))
+        kind, value = self.operand(node.args[0], aliases)
+        return self.test(kind, value, lambda v: '(%s > %s AND %s < %s)' % (v, lower, v, upper))
+
+def translate_where(where_expr, params):
+    """Translate a parsed WHERE expression into an SQL condition on the
+    items table. Returns the condition and whether it is exact; if not, it
+    only narrows down the items and the predicate has to be applied too.
+
+    The condition expects the id of the domain as the domain_id parameter."""
+    if where_expr == '':
+        return '1', True
+    translator = _WhereTranslator(params)
+    try:
+        return translator.exists(where_expr), True
+    except _Untranslatable:
+        pass
+
+    conditions = ['1']
+    if isinstance(where_expr, (sqlparser.SqlParser.BoolAnd, sqlparser.SqlParser.Intersection)):
+        for arg in where_expr.args:
+            try:
+                conditions.append(translator.exists(arg))
+            except _Untranslatable:
+                pass
+    return ' AND '.join(conditions), False
+
+
+def _enable_wal(conn, attempts=100):
+    """Switch the database to write-ahead logging. That needs it to be the
+    only connection for a moment, and SQLite fails right away rather than
+    waiting if it isn't, so retry while several processes are opening a new
+    database at once."""
+    for attempt in range(attempts):
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            return
+        except sqlite3.OperationalError, e:
+            if 'locked' not in str(e) or attempt == attempts - 1:
+                raise
+            time.sleep(0.05)
+
+
+class SQLiteBackend(basicdb.backends.StorageBackend):
+    def __init__(self, path=None):
+        if path is None:
+            path = os.environ.get('BASICDB_SQLITE_PATH', '/tmp/basicdb.sqlite')
+        self.path = path
+        self._local = threading.local()
+        # In a transaction of its own, as several processes may be starting
+        # on the same database at once
+        with self._transaction() as conn:
+            for statement in SCHEMA.split(';'):
+                conn.execute(statement)
+
+    def _connection(self):
+        conn = getattr(self._local, 'connection', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, isolation_level=None)
+            conn.text_factory = str
+            _enable_wal(conn)
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.create_function('basicdb_like', 2, _like)
+            self._local.connection = conn
+            self._local.depth = 0
+        return conn
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """Run a block in a transaction, or as part of the one already
+        running in this thread"""
+        conn = self._connection()
+        if self._local.depth:
+            self._local.depth += 1
+            try:
+                yield conn
+            finally:
+                self._local.depth -= 1
+            return
+
+        conn.execute('BEGIN IMMEDIATE')
+        self._local.depth = 1
+        try:
+            yield conn
+        except:
+            self._local.depth = 0
+            conn.execute('ROLLBACK')
+            raise
+        self._local.depth = 0
+        conn.execute('COMMIT')
+
+    def _reset(self):
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM attrs')
+            conn.execute('DELETE FROM items')
+            conn.execute('DELETE FROM domains')
+
+    def _domain_id(self, conn, owner, domain_name):
+        row = conn.execute('SELECT id FROM domains WHERE owner = ? AND name = ?',
+                           (owner, domain_name)).fetchone()
+        if row is None:
+            raise KeyError(domain_name)
+        return row[0]
+
+    def _item_id(self, conn, domain_id, item_name, create=False):
+        if create:
+            conn.execute('INSERT OR IGNORE INTO items (domain_id, name) VALUES (?, ?)',
+                         (domain_id, item_name))
+        row = conn.execute('SELECT id FROM items WHERE domain_id = ? AND name = ?',
+                           (domain_id, item_name)).fetchone()
+        return row and row[0]
+
+    def _drop_if_empty(self, conn, item_id):
+        conn.execute('DELETE FROM items WHERE id = ? AND NOT EXISTS '
+                     '(SELECT 1 FROM attrs WHERE item_id = ?)', (item_id, item_id))
+
+    def create_domain(self, owner, domain_name):
+        with self._transaction() as conn:
+            conn.execute('INSERT OR IGNORE INTO domains (owner, name) VALUES (?, ?)',
+                         (owner, domain_name))
+
+    def delete_domain(self, owner, domain_name):
+        with self._transaction() as conn:
+            try:
+                domain_id = self._domain_id(conn, owner, domain_name)
+            except KeyError:
+                return
+            conn.execute('DELETE FROM attrs WHERE domain_id = ?', (domain_id,))
+            conn.execute('DELETE FROM items WHERE domain_id = ?', (domain_id,))
+            conn.execute('DELETE FROM domains WHERE id = ?', (domain_id,))
+
+    def list_domains(self, owner):
+        return [name for name, in self._connection().execute(
+                    'SELECT name FROM domains WHERE owner = ?', (owner,))]
+
+    def put_attributes(self, owner, domain_name, item_name, additions, replacements,
+                       expectations=None):
+        with self._transaction():
+            super(SQLiteBackend, self).put_attributes(owner, domain_name, item_name,
+                                                      additions, replacements, expectations)
+
+    def batch_put_attributes(self, owner, domain_name, additions, replacements):
+        with self._transaction():
+            super(SQLiteBackend, self).batch_put_attributes(owner, domain_name,
+                                                            additions, replacements)
+
+    def delete_attributes(self, owner, domain_name, item_name, deletions):
+        with self._transaction():
+            super(SQLiteBackend, self).delete_attributes(owner, domain_name, item_name,
+                                                         deletions)
+
+    def batch_delete_attributes(self, owner, domain_name, deletions):
+        with self._transaction():
+            super(SQLiteBackend, self).batch_delete_attributes(owner, domain_name, deletions)
+
+    def add_attribute(self, owner, domain_name, item_name, attr_name, attr_values):
+        with self._transaction() as conn:
+            domain_id = self._domain_id(conn, owner, domain_name)
+            item_id = self._item_id(conn, domain_id, item_name, create=True)
+            conn.executemany('INSERT OR IGNORE INTO attrs (domain_id, item_id, name, value) '
+                             'VALUES (?, ?, ?, ?)',
+                             [(domain_id, item_id, attr_name, attr_value)
+                              for attr_value in attr_values])
+            self._drop_if_empty(conn, item_id)
+
+    def add_attribute_value(self, owner, domain_name, item_name, attr_name, attr_value):
+        self.add_attribute(owner, domain_name, item_name, attr_name, [attr_value])
+
+    def delete_attribute_all(self, owner, domain_name, item_name, attr_name):
+        with self._transaction() as conn:
+            try:
+                domain_id = self._domain_id(conn, owner, domain_name)
+            except KeyError:
+                return
+            item_id = self._item_id(conn, domain_id, item_name)
+            if item_id is None:
+                return
+            conn.execute('DELETE FROM attrs WHERE item_id = ? AND name = ?',
+                         (item_id, attr_name))
+            self._drop_if_empty(conn, item_id)
+
+    def delete_attribute_value(self, owner, domain_name, item_name, attr_name, attr_value):
+        with self._transaction() as conn:
+            try:
+                domain_id = self._domain_id(conn, owner, domain_name)
+            except KeyError:
+                return
+            item_id = self._item_id(conn, domain_id, item_name)
+            if item_id is None:
+                return
+            conn.execute('DELETE FROM attrs WHERE item_id = ? AND name = ? AND value = ?',
+                         (item_id, attr_name, attr_value))
+            self._drop_if_empty(conn, item_id)
+
+    def get_attributes(self, owner, domain_name, item_name):
+        retval = {}
+        for attr_name, attr_value in self._connection().execute(
+                'SELECT attrs.name, attrs.value FROM domains '
+                'JOIN items ON items.domain_id = domains.id '
+                'JOIN attrs ON attrs.item_id = items.id '
+                'WHERE domains.owner = ? AND domains.name = ? AND items.name = ?',
+                (owner, domain_name, item_name)):
+            retval.setdefault(attr_name, set()).add(attr_value)
+        return retval
+
+    def _matching_items(self, owner, parsed, params):
+        """SQL for the id and name of the items matching a Select
+        expression as far as SQL can tell, and whether that is exact"""
+        try:
+            params['domain_id'] = self._domain_id(self._connection(), owner, parsed.table)
+        except KeyError:
+            params['domain_id'] = None
+        where, exact = translate_where(parsed.where_expr, params)
+        sql = ('SELECT items.id, items.name FROM items '
+               'WHERE items.domain_id = :domain_id AND %s' % (where,))
+        return sql, exact
+
+    def _projection(self, columns, params):
+        """SQL conditions on an item (the subquery m) and its attributes
+        (the attrs table) for what to return for the given columns"""
+        if columns == ['*']:
+            return '1', '1'
+        names = [col for col in columns if isinstance(col, basestring)]
+        attrs = '(attrs.name IN (%s))' % (', '.join(':c%d' % (i,) for i in range(len(names))),)
+        params.update(('c%d' % (i,), name) for i, name in enumerate(names))
+        if any(isinstance(col, (sqlparser.SqlParser.ItemName, sqlparser.SqlParser.Count))
+               for col in columns):
+            return '1', attrs
+        return ('EXISTS (SELECT 1 FROM attrs WHERE attrs.item_id = m.id AND %s)' % (attrs,),
+                attrs)
+
+    def _items(self, conn, sql, params):
+        """Run a query returning (item name, attribute name, value) rows,
+        grouped by item, and iterate over (item_name, item_attrs) pairs"""
+        cursor = conn.execute(sql, params)
+        for item_name, rows in itertools.groupby(cursor, lambda row: row[0]):
+            item_attrs = {}
+            for _, attr_name, attr_value in rows:
+                if attr_name is not None:
+                    item_attrs.setdefault(attr_name, set()).add(attr_value)
+            yield item_name, item_attrs
+
+    def select_iter(self, owner, parsed):
+        params = {}
+        matching, exact = self._matching_items(owner, parsed, params)
+        if exact:
+            item_condition, attr_condition = self._projection(parsed.columns, params)
+        else:
+            item_condition, attr_condition = '1', '1'
+        sql = ('SELECT m.name, attrs.name, attrs.value FROM (%s) m '
+               'LEFT JOIN attrs ON attrs.item_id = m.id AND %s '
+               'WHERE %s ORDER BY m.id' % (matching, attr_condition, item_condition))
+        items = self._items(self._connection(), sql, params)
+        if exact:
+            return items
+        return self._filter(items, parsed)
+
+    def _filter(self, items, parsed):
+        predicate = parsed.predicate
+        for item_name, item_attrs in items:
+            if predicate(item_name, item_attrs):
+                item_attrs = basicdb.backends.project(item_attrs, parsed.columns)
+                if item_attrs is not None:
+                    yield item_name, item_attrs
+
+    def select(self, owner, parsed):
+        return dict(self.select_iter(owner, parsed))
+
+    def select_stream(self, owner, parsed):
+        basicdb.backends.check_sort_key(parsed)
+        key = parsed.order_by_terms.key
+        params = {}
+        matching, exact = self._matching_items(owner, parsed, params)
+        if not exact:
+            return super(SQLiteBackend, self).select_stream(owner, parsed)
+
+        item_condition, attr_condition = self._projection(parsed.columns, params)
+        if parsed.limit_terms:
+            limit = 'LIMIT %d' % (int(parsed.limit_terms[1]),)
+        else:
+            limit = ''
+        if not key:
+            sql = ('SELECT m.name, attrs.name, attrs.value FROM '
+                   '(SELECT * FROM (%s) m WHERE %s %s) m '
+                   'LEFT JOIN attrs ON attrs.item_id = m.id AND %s '
+                   'ORDER BY m.id' % (matching, item_condition, limit, attr_condition))
+            return self._items(self._connection(), sql, params)
+
+        # Items are sorted by their lowest value of the sort key, or their
+        # highest if sorting in descending order, like sort_items does
+        direction = parsed.order_by_terms.reverse and 'DESC' or 'ASC'
+        if key == 'itemName()':
+            sort_key = 'SELECT m.*, m.name AS sort_key FROM (%s) m WHERE %s' % (matching, item_condition)
+        else:
+            params['sort_attr'] = key
+            sort_key = ('SELECT m.*, %s(k.value) AS sort_key FROM (%s) m '
+                        'JOIN attrs k ON k.item_id = m.id AND k.name = :sort_attr '
+                        'WHERE %s GROUP BY m.id' %
+                        (parsed.order_by_terms.reverse and 'MAX' or 'MIN', matching, item_condition))
+        sql = ('SELECT m.name, attrs.name, attrs.value FROM '
+               '(SELECT * FROM (%s) m ORDER BY sort_key %s, m.name %s %s) m '
+               'LEFT JOIN attrs ON attrs.item_id = m.id AND %s '
+               'ORDER BY m.sort_key %s, m.name %s' %
+               (sort_key, direction, direction, limit, attr_condition, direction, direction))
+        return self._items(self._connection(), sql, params)
+
+    def count(self, owner, parsed):
+        params = {}
+        matching, exact = self._matching_items(owner, parsed, params)
+        if not exact:
+            return super(SQLiteBackend, self).count(owner, parsed)
+        return self._connection().execute('SELECT COUNT(*) FROM (%s)' % (matching,),
+                                          params).fetchone()[0]
+
+    def domain_metadata(self, owner, domain_name):
+        conn = self._connection()
+        domain_id = self._domain_id(conn, owner, domain_name)
+        item_count, item_names_size = conn.execute(
+            'SELECT COUNT(*), COALESCE(SUM(LENGTH(name)), 0) FROM items WHERE domain_id = ?',
+            (domain_id,)).fetchone()
+        return {"ItemCount": item_count,
+                "ItemNamesSizeBytes": item_names_size,
+                "AttributeNameCount": '12',
+                "AttributeNamesSizeBytes": '120',
+                "AttributeValueCount": '120',
+                "AttributeValuesSizeBytes": '100020',
+                "Timestamp": str(int(time.time()))}
+
+# Several server processes can share the data, each through a driver of its
+# own (see basicdb.server)
+MULTIPROCESS = True
+
+driver = SQLiteBackend
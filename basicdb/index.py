@@ -0,0 +1,212 @@
+import bisect
+import sys
+
+# Pseudo attribute under which indexes keep the names of the items themselves,
+# matching the way itemName() is referred to in select expressions.
+ITEM_NAME = 'itemName()'
+
+class InvertedIndex(object):
+    """Maps (attribute name, value) pairs to the set of names of the items
+    that have that value for that attribute
+
+    Lookups return None if the index can't answer them, in which case the
+    caller has to fall back to looking at every item."""
+    def __init__(self):
+        self._items = {}
+
+    def __len__(self):
+        return len(self._items)
+
+    def add(self, item_name, attr_name, attr_value):
+        key = (attr_name, attr_value)
+        if key not in self._items:
+            self._items[key] = set()
+        self._items[key].add(item_name)
+
+    def remove(self, item_name, attr_name, attr_value):
+        key = (attr_name, attr_value)
+        item_names = self._items.get(key)
+        if item_names is None:
+            return
+        item_names.discard(item_name)
+        if not item_names:
+            del self._items[key]
+
+    def add_item(self, item_name):
+        self.add(item_name, ITEM_NAME, item_name)
+
+    def equal(self, attr_name, attr_value):
+        """Names of the items having the given value. The returned set is
+        owned by the index and must not be modified."""
+        return self._items.get((attr_name, attr_value), frozenset())
+
+    def range(self, attr_name, lower=None, upper=None,
+              lower_inclusive=True, upper_inclusive=True):
+        """Names of the items having a value between lower and upper (either
+        of which may be None to leave that end open)"""
+        return None
+
+    def prefix(self, attr_name, prefix):
+        """Names of the items having a value starting with prefix"""
+        return None
+
+    def ordered(self, attr_name, reverse=False):
+        """Iterate over the names of the items having a value for the given
+        attribute in order of those values. An item name is repeated for
+        each of its values."""
+        return None
+
+    def size_bytes(self):
+        """Approximate memory used by the index itself (not counting the
+        strings it shares with the items)"""
+        size = sys.getsizeof(self._items)
+        for key, item_names in self._items.iteritems():
+            size += sys.getsizeof(key) + sys.getsizeof(item_names)
+        return size
+
+
+def _successor(s):
+    """The smallest string sorting after s"""
+    return s + '\0'
+
+# Number of buffered changes to an attribute beyond which they are merged into
+# its sorted array by re-sorting it as a whole rather than one by one.
+_BULK_MERGE_THRESHOLD = 64
+
+# Number of buffered changes to an attribute beyond which they are merged into
+# its sorted array right away, so attributes that are written but never
+# looked up by range or order don't buffer changes without limit.
+_MAX_BUFFERED = _BULK_MERGE_THRESHOLD * 16
+
+class OrderedIndex(InvertedIndex):
+    """An InvertedIndex that additionally keeps a sorted array of
+    (value, item name) pairs per attribute to answer range and prefix
+    lookups and to list items in order
+
+    Inserting into or deleting from the middle of a large array is
+    expensive, so changes are buffered and only merged into the array
+    when the attribute is next looked up or once there are _MAX_BUFFERED
+    of them. An entry removed before it was merged is dropped from the
+    buffer rather than buffered again as a removal. Merging builds a new
+    array, so that what ordered() returns keeps iterating over the array
+    as it was."""
+    def __init__(self):
+        super(OrderedIndex, self).__init__()
+        self._sorted = {}
+        self._added = {}
+        self._removed = {}
+
+    def _is_sorted(self, attr_name, entry):
+        entries = self._sorted.get(attr_name, [])
+        pos = bisect.bisect_left(entries, entry)
+        return pos < len(entries) and entries[pos] == entry
+
+    def _buffered(self, attr_name):
+        """Merge the buffered changes to an attribute right away if there
+        are too many of them"""
+        if (len(self._added.get(attr_name, ())) +
+                len(self._removed.get(attr_name, ())) > _MAX_BUFFERED):
+            self._entries(attr_name)
+
+    # The buffers only hold actual changes to the sorted array: _added
+    # entries that aren't in it and _removed entries that are.
+    def add(self, item_name, attr_name, attr_value):
+        super(OrderedIndex, self).add(item_name, attr_name, attr_value)
+        entry = (attr_value, item_name)
+        removed = self._removed.get(attr_name)
+        if removed and entry in removed:
+            removed.discard(entry)
+        elif not self._is_sorted(attr_name, entry):
+            self._added.setdefault(attr_name, set()).add(entry)
+            self._buffered(attr_name)
+
+    def remove(self, item_name, attr_name, attr_value):
+        super(OrderedIndex, self).remove(item_name, attr_name, attr_value)
+        entry = (attr_value, item_name)
+        added = self._added.get(attr_name)
+        if added and entry in added:
+            added.discard(entry)
+        elif self._is_sorted(attr_name, entry):
+            self._removed.setdefault(attr_name, set()).add(entry)
+            self._buffered(attr_name)
+
+    def _entries(self, attr_name):
+        """The sorted array for the given attribute with any buffered
+        changes merged into it"""
+        entries = self._sorted.get(attr_name, [])
+        added = self._added.pop(attr_name, None)
+        removed = self._removed.pop(attr_name, None)
+        if not added and not removed:
+            return entries
+        entries = list(entries)
+
+        if removed:
+            if len(removed) < _BULK_MERGE_THRESHOLD:
+                for entry in removed:
+                    pos = bisect.bisect_left(entries, entry)
+                    if pos < len(entries) and entries[pos] == entry:
+                        del entries[pos]
+            else:
+                entries = [entry for entry in entries if entry not in removed]
+
+        if added:
+            if len(added) < _BULK_MERGE_THRESHOLD:
+                for entry in added:
+                    bisect.insort(entries, entry)
+            else:
+                entries.extend(added)
+                entries.sort()
+
+        if entries:
+            self._sorted[attr_name] = entries
+        else:
+            self._sorted.pop(attr_name, None)
+        return entries
+
+    def _slice(self, attr_name, lower, upper, lower_inclusive, upper_inclusive):
+        entries = self._entries(attr_name)
+        if lower is None:
+            start = 0
+        elif lower_inclusive:
+            start = bisect.bisect_left(entries, (lower,))
+        else:
+            start = bisect.bisect_left(entries, (_successor(lower),))
+        if upper is None:
+            end = len(entries)
+        elif upper_inclusive:
+            end = bisect.bisect_left(entries, (_successor(upper),))
+        else:
+            end = bisect.bisect_left(entries, (upper,))
+        return entries, start, end
+
+    def range(self, attr_name, lower=None, upper=None,
+              lower_inclusive=True, upper_inclusive=True):
+        entries, start, end = self._slice(attr_name, lower, upper,
+                                          lower_inclusive, upper_inclusive)
+        return set(entries[i][1] for i in xrange(start, end))
+
+    def prefix(self, attr_name, prefix):
+        entries = self._entries(attr_name)
+        item_names = set()
+        for i in xrange(bisect.bisect_left(entries, (prefix,)), len(entries)):
+            attr_value, item_name = entries[i]
+            if not attr_value.startswith(prefix):
+                break
+            item_names.add(item_name)
+        return item_names
+
+    def ordered(self, attr_name, reverse=False):
+        entries = self._entries(attr_name)
+        if reverse:
+            return (item_name for _, item_name in reversed(entries))
+        return (item_name for _, item_name in entries)
+
+    def size_bytes(self):
+        size = super(OrderedIndex, self).size_bytes() + sys.getsizeof(self._sorted)
+        for entries in self._sorted.values() + self._added.values() + self._removed.values():
+            size += sys.getsizeof(entries) + len(entries) * sys.getsizeof((None, None))
+        return size
+
+INDEXES = {'none': None,
+           'inverted': InvertedIndex,
+           'ordered': OrderedIndex}
@@ -0,0 +1,122 @@
+import binascii
+import itertools
+import os
+import time
+
+"""
+Encoding of the XML responses to SimpleDB actions.
+
+Each action's response is its result (if it has one) and the response
+metadata, wrapped in an envelope named after the action:
+
+  <SelectResponse><SelectResult>...</SelectResult>
+  <ResponseMetadata><RequestId>...</RequestId><BoxUsage>...</BoxUsage>
+  </ResponseMetadata></SelectResponse>
+
+The envelopes are prepared once per action, and the result is put together
+from strings, escaped the way etree.tostring() would escape them, rather
+than built as an element tree first.
+"""
+
+# Actions whose responses have a <...Result> element
+RESULT_ACTIONS = ('ListDomains', 'Select', 'DomainMetadata', 'GetAttributes')
+
+# Streamed responses are handed to the server in pieces of about this many
+# bytes
+STREAM_CHUNK_SIZE = 16384
+
+_METADATA = ('<ResponseMetadata><RequestId>%s</RequestId>'
+             '<BoxUsage>%s</BoxUsage></ResponseMetadata>')
+
+def _envelope(root, has_result):
+    """The (head, tail) strings to put around the result of a response with
+    the given root element. tail is a format string taking the RequestId
+    and BoxUsage."""
+    if has_result:
+        action = root[:-len('Response')]
+        return ('<%s><%sResult>' % (root, action),
+                '</%sResult>%s</%s>' % (action, _METADATA, root))
+    return '<%s>' % (root,), '%s</%s>' % (_METADATA, root)
+
+_envelopes = dict(('%sResponse' % (action,), _envelope('%sResponse' % (action,), True))
+                  for action in RESULT_ACTIONS)
+
+def envelope(root):
+    """The (head, tail) strings for a response with the given root
+    element, e.g. "GetAttributesResponse" or an error's root_element"""
+    head_tail = _envelopes.get(root)
+    if head_tail is None:
+        head_tail = _envelopes.setdefault(root, _envelope(root, False))
+    return head_tail
+
+# (pid, prefix, counter) of the process the RequestIds are made for
+_request_ids = (None, None, None)
+
+def request_id():
+    """A new RequestId. RequestIds look like UUIDs, but are made of a
+    random prefix picked once per process and a counter."""
+    global _request_ids
+    pid, prefix, counter = _request_ids
+    if pid != os.getpid():
+        prefix = binascii.hexlify(os.urandom(10))
+        prefix = '%s-%s-%s-%s-' % (prefix[:8], prefix[8:12], prefix[12:16], prefix[16:])
+        counter = itertools.count()
+        _request_ids = (os.getpid(), prefix, counter)
+    return '%s%012x' % (prefix, next(counter))
+
+def escape(text):
+    """text escaped for use in XML character data. Unicode strings are
+    encoded as ASCII with character references, like etree.tostring() does."""
+    text = text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+    if isinstance(text, unicode):
+        text = text.encode('ascii', 'xmlcharrefreplace')
+    return text
+
+def iter_attributes_xml(item_attrs):
+    """Iterate over the <Attribute> elements of an item"""
+    for attr_name, attr_values in item_attrs.iteritems():
+        attr_name = escape(attr_name)
+        for attr_value in attr_values:
+            yield ('<Attribute><Name>%s</Name><Value>%s</Value></Attribute>' %
+                   (attr_name, escape(attr_value)))
+
+def attributes_xml(item_attrs):
+    return ''.join(iter_attributes_xml(item_attrs))
+
+def items_xml(items):
+    """Iterate over the <Item> elements for (item_name, item_attrs) pairs"""
+    for item_name, item_attrs in items:
+        yield '<Item><Name>%s</Name>%s</Item>' % (escape(item_name),
+                                                   attributes_xml(item_attrs))
+
+def domain_names_xml(domain_names):
+    return ''.join('<DomainName>%s</DomainName>' % (escape(domain_name),)
+                   for domain_name in domain_names)
+
+def domain_metadata_xml(metadata):
+    return ''.join('<%s>%s</%s>' % (k, escape(str(v)), k)
+                   for k, v in metadata.iteritems())
+
+def encode(root, result, request_id, box_usage):
+    """The response with the given root element, result (the XML inside
+    the result element, if the response has one), RequestId and BoxUsage"""
+    head, tail = envelope(root)
+    return head + result + tail % (request_id, box_usage)
+
+def stream(root, result, request_id, start_time):
+    """Iterate over the pieces of a response like encode() returns, whose
+    result is made up of the strings result yields, so that large results
+    are sent as they are produced rather than built in memory first.
+    BoxUsage covers the time until the last piece."""
+    head, tail = envelope(root)
+    pieces = [head]
+    size = 0
+    for xml in result:
+        pieces.append(xml)
+        size += len(xml)
+        if size >= STREAM_CHUNK_SIZE:
+            yield ''.join(pieces)
+            pieces = []
+            size = 0
+    pieces.append(tail % (request_id, time.time() - start_time))
+    yield ''.join(pieces)
@@ -0,0 +1,536 @@
+import argparse
+import BaseHTTPServer
+import email.utils
+import errno
+import importlib
+import multiprocessing
+import os
+import random
+import signal
+import socket
+import sys
+import threading
+import time
+import traceback
+import urllib
+
+"""
+A pre-forking HTTP/1.1 server for BasicDB.
+
+The master process binds the listening socket and forks worker processes
+that share it. Each worker loads its own backend (see basicdb.get_backend)
+and runs a pool of threads that accept connections from the socket and
+serve the requests on each of them in turn, keeping connections alive
+between requests. Responses of unknown length (streamed Select results) are
+sent chunked.
+
+The master restarts workers that die, and a worker that has served its
+--max-requests requests stops accepting connections and is replaced.
+SIGHUP replaces all the workers, and SIGTERM or SIGINT stop the server,
+giving the workers --graceful-timeout seconds to finish the requests they
+are serving. Where workers can't share the backend, the old worker is
+stopped before its replacement starts, and the fake backend without
+BASICDB_FAKE_DATA_DIR, whose data would go with the worker, isn't
+replaced at all.
+
+The data of some backends (fake, logstructured) lives in the process, the
+riak backend only makes conditional puts atomic within one process, and
+the item cache (BASICDB_BACKEND_CACHE_SIZE) only knows about changes made
+through it, so these can only be served by a single worker. Backend modules
+whose data several processes can share set MULTIPROCESS = True.
+"""
+
+# Exit status of a worker that failed to load the backend. The master stops
+# rather than starting workers that fail the same way over and over.
+WORKER_BOOT_ERROR = 3
+
+# How often the master checks on its workers and idle worker threads check
+# whether they should stop, in seconds
+POLL_INTERVAL = 0.5
+
+class _Input(object):
+    """wsgi.input: the request body, which mustn't be read past, as the next
+    request on the connection follows it"""
+    def __init__(self, rfile, length):
+        self._rfile = rfile
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self._rfile.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def readline(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self._rfile.readline(size)
+        self.remaining -= len(data)
+        return data
+
+    def readlines(self, hint=-1):
+        return list(iter(self.readline, ''))
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+    def drain(self):
+        while self.remaining and self.read(65536):
+            pass
+
+class ResponseFraming(object):
+    """How a response goes on the wire of an HTTP/1.1 connection: its header
+    block, its body, chunked if its length isn't known, and whether the
+    connection can be kept alive afterwards. Used by both servers."""
+    def __init__(self, request_version, keep_alive):
+        self.request_version = request_version
+        self.keep_alive = keep_alive
+        self.headers_sent = False
+        self.chunked = False
+
+    def header_block(self, status, headers, empty=False):
+        """The status line and headers of a response to be followed by
+        body() of each piece of its body and end(), or by nothing if empty"""
+        lines = ['HTTP/1.1 %s' % (status,), 'Server: BasicDB',
+                 'Date: %s' % (email.utils.formatdate(usegmt=True),)]
+        has_length = False
+        for name, value in headers:
+            lines.append('%s: %s' % (name, value))
+            if name.lower() == 'content-length':
+                has_length = True
+        if not has_length:
+            if empty:
+                lines.append('Content-Length: 0')
+            elif self.request_version == 'HTTP/1.1':
+                lines.append('Transfer-Encoding: chunked')
+                self.chunked = True
+            else:
+                # The end of the body is where the connection closes
+                self.keep_alive = False
+        if not self.keep_alive:
+            lines.append('Connection: close')
+        elif self.request_version == 'HTTP/1.0':
+            lines.append('Connection: keep-alive')
+        self.headers_sent = True
+        return '\r\n'.join(lines) + '\r\n\r\n'
+
+    def body(self, data):
+        if self.chunked:
+            return '%x\r\n%s\r\n' % (len(data), data)
+        return data
+
+    def end(self):
+        if self.chunked:
+            return '0\r\n\r\n'
+        return ''
+
+class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves the requests on a connection through the worker's WSGI app"""
+    protocol_version = 'HTTP/1.1'
+    server_version = 'BasicDB'
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    @property
+    def timeout(self):
+        # How long to wait for the next request on the connection
+        return self.server.keepalive
+
+    def log_request(self, code='-', size='-'):
+        pass
+
+    def handle_one_request(self):
+        try:
+            self.raw_requestline = self.rfile.readline(65537)
+        except socket.error:
+            # Timed out waiting for another request, or the client is gone
+            self.close_connection = 1
+            return
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            return
+        if not self.raw_requestline:
+            self.close_connection = 1
+            return
+        if not self.parse_request():
+            return
+        if not self.server.request_started():
+            self.close_connection = 1
+        self.run_app()
+        self.wfile.flush()
+
+    def run_app(self):
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+        except ValueError:
+            self.send_error(400, 'Bad Content-Length')
+            return
+        body = _Input(self.rfile, length)
+        environ = self.server.base_environ.copy()
+        path, _, query = self.path.partition('?')
+        environ.update({'REQUEST_METHOD': self.command,
+                        'PATH_INFO': urllib.unquote(path),
+                        'QUERY_STRING': query,
+                        'SERVER_PROTOCOL': self.request_version,
+                        'REMOTE_ADDR': self.client_address[0],
+                        'REMOTE_PORT': str(self.client_address[1]),
+                        'wsgi.input': body})
+        for name, value in self.headers.items():
+            name = name.upper().replace('-', '_')
+            if name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                environ[name] = value
+            else:
+                environ['HTTP_' + name] = value
+
+        self._response = None
+        self._framing = ResponseFraming(self.request_version, not self.close_connection)
+        try:
+            result = self.server.app(environ, self._start_response)
+            try:
+                for data in result:
+                    if data:
+                        self._write(data)
+                if not self._framing.headers_sent:
+                    self._send_headers(empty=True)
+                else:
+                    self.wfile.write(self._framing.end())
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+        except socket.error:
+            self.close_connection = 1
+            return
+        except Exception:
+            traceback.print_exc()
+            if self._framing.headers_sent:
+                # Nothing to do but cut the response short
+                self.close_connection = 1
+            else:
+                self.send_error(500)
+            return
+        if not self._framing.keep_alive:
+            self.close_connection = 1
+        body.drain()
+
+    def _start_response(self, status, headers, exc_info=None):
+        if exc_info:
+            try:
+                if self._framing.headers_sent:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+            finally:
+                exc_info = None
+        self._response = (status, headers)
+        return self._write
+
+    def _send_headers(self, empty=False):
+        status, headers = self._response
+        self.wfile.write(self._framing.header_block(status, headers, empty))
+
+    def _write(self, data):
+        if not self._framing.headers_sent:
+            self._send_headers()
+        self.wfile.write(self._framing.body(data))
+        # Send what we have, so that streamed responses are streamed
+        self.wfile.flush()
+
+class Worker(object):
+    """A worker process' pool of threads serving connections from a
+    listening socket through a WSGI app"""
+    def __init__(self, listener, app, threads=8, keepalive=5, max_requests=0,
+                 multiprocess=False):
+        self.listener = listener
+        self.app = app
+        self.threads = threads
+        self.keepalive = keepalive
+        host, port = listener.getsockname()[:2]
+        self.base_environ = {'SERVER_NAME': host,
+                             'SERVER_PORT': str(port),
+                             'SCRIPT_NAME': '',
+                             'wsgi.version': (1, 0),
+                             'wsgi.url_scheme': 'http',
+                             'wsgi.errors': sys.stderr,
+                             'wsgi.multithread': True,
+                             'wsgi.multiprocess': multiprocess,
+                             'wsgi.run_once': False}
+        # Spread the restarts of workers started together
+        if max_requests:
+            max_requests += random.Random().randint(0, max_requests // 10)
+        self.max_requests = max_requests
+        self.requests = 0
+        self.stopping = threading.Event()
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def request_started(self):
+        """Count a request. Returns False if the worker will stop
+        afterwards, so the connection should be closed."""
+        with self._lock:
+            self.requests += 1
+            if self.max_requests and self.requests >= self.max_requests:
+                self.stopping.set()
+        return not self.stopping.is_set()
+
+    def start(self):
+        for i in range(self.threads):
+            thread = threading.Thread(target=self._serve)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        """Stop accepting connections and wait up to timeout seconds for the
+        threads to finish with theirs"""
+        self.stopping.set()
+        deadline = timeout is not None and time.time() + timeout
+        for thread in self._threads:
+            thread.join(deadline and max(deadline - time.time(), 0))
+
+    def _serve(self):
+        while not self.stopping.is_set():
+            try:
+                conn, addr = self.listener.accept()
+            except socket.timeout:
+                continue
+            except socket.error, e:
+                if e.errno in (errno.EAGAIN, errno.EINTR, errno.ECONNABORTED):
+                    continue
+                raise
+            try:
+                conn.settimeout(None)
+                RequestHandler(conn, addr, self)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                conn.close()
+
+    def run(self, init, graceful_timeout):
+        """Run as a worker process: call init() and serve until told to stop
+        by SIGTERM or SIGINT or by reaching max_requests"""
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.stopping.set())
+        signal.signal(signal.SIGINT, lambda signum, frame: self.stopping.set())
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        try:
+            init()
+        except Exception:
+            traceback.print_exc()
+            return WORKER_BOOT_ERROR
+
+        self.start()
+        master = os.getppid()
+        # Waiting with a timeout, so that signals are handled and workers
+        # don't outlive a master that was killed
+        while not self.stopping.is_set() and os.getppid() == master:
+            self.stopping.wait(POLL_INTERVAL)
+        self.stop(graceful_timeout)
+        return 0
+
+class Master(object):
+    """Forks and watches over the workers. Unless multiprocess is set, a
+    worker is only replaced once it has stopped, so that there's never more
+    than one serving the backend. Unless reloadable is set, SIGHUP is
+    ignored."""
+    def __init__(self, host, port, app, init, workers, threads=8, keepalive=5,
+                 max_requests=0, graceful_timeout=30, backlog=1024,
+                 multiprocess=True, reloadable=True):
+        self.app = app
+        self.init = init
+        self.workers = workers
+        self.multiprocess = multiprocess
+        self.reloadable = reloadable
+        self.threads = threads
+        self.keepalive = keepalive
+        self.max_requests = max_requests
+        self.graceful_timeout = graceful_timeout
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((host, port))
+        self.listener.listen(backlog)
+        # Worker threads wait for connections with a timeout, so that they
+        # notice when to stop
+        self.listener.settimeout(POLL_INTERVAL)
+        self.address = self.listener.getsockname()[:2]
+        self._pids = set()
+        self._stopping = False
+        self._reload = False
+        self._worker = None
+
+    def _log(self, msg):
+        print >> sys.stderr, '[%d] %s' % (os.getpid(), msg)
+
+    def _spawn(self):
+        pid = os.fork()
+        if pid:
+            self._pids.add(pid)
+            self._log('Started worker %d' % (pid,))
+            return
+
+        status = 1
+        try:
+            # Until Worker.run() installs its own, this process still has the
+            # master's signal handlers, which pass SIGTERM and SIGINT on to
+            # self._worker, once there is one
+            self._worker = Worker(self.listener, self.app, self.threads, self.keepalive,
+                                  self.max_requests, self.workers > 1)
+            if self._stopping:
+                self._worker.stopping.set()
+            status = self._worker.run(self.init, self.graceful_timeout)
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            sys.stderr.flush()
+            os._exit(status)
+
+    def _reap(self):
+        """Forget workers that exited. Returns False if one of them failed to
+        load the backend."""
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.ECHILD:
+                    return True
+                raise
+            if not pid:
+                return True
+            if pid not in self._pids:
+                continue
+            self._pids.discard(pid)
+            if os.WIFEXITED(status) and os.WEXITSTATUS(status) == WORKER_BOOT_ERROR:
+                self._log('Worker %d failed to start' % (pid,))
+                return False
+            if status and not self._stopping:
+                self._log('Worker %d exited with status %d' % (pid, status))
+            else:
+                self._log('Worker %d stopped' % (pid,))
+
+    def _signal(self, pids, signum):
+        for pid in pids:
+            try:
+                os.kill(pid, signum)
+            except OSError, e:
+                if e.errno != errno.ESRCH:
+                    raise
+
+    def stop(self, signum=None, frame=None):
+        self._stopping = True
+        if self._worker is not None:
+            self._worker.stopping.set()
+
+    def reload(self, signum=None, frame=None):
+        self._reload = True
+
+    def _stop_workers(self):
+        """Stop all the workers, giving them graceful_timeout seconds to
+        finish the requests they are serving before killing them"""
+        deadline = time.time() + self.graceful_timeout
+        signalled = 0
+        while self._pids and time.time() < deadline:
+            # A worker that hasn't got as far as running any Python code
+            # since it was forked drops signals, so keep repeating it
+            if time.time() - signalled >= POLL_INTERVAL:
+                self._signal(self._pids, signal.SIGTERM)
+                signalled = time.time()
+            self._reap()
+            time.sleep(0.05)
+        self._signal(self._pids, signal.SIGKILL)
+        while self._pids:
+            self._reap()
+            time.sleep(0.05)
+
+    def run(self):
+        """Serve until SIGTERM or SIGINT. Returns the exit status."""
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGHUP, self.reload)
+        self._log('Listening on http://%s:%d/ with %d workers of %d threads' %
+                  (self.address + (self.workers, self.threads)))
+        status = 0
+        while not self._stopping:
+            if not self._reap():
+                status = 1
+                break
+            if self._reload and not self.reloadable:
+                self._reload = False
+                self._log('Not replacing workers: they hold all the data')
+            elif self._reload:
+                self._reload = False
+                self._log('Replacing workers')
+                if self.multiprocess:
+                    old_pids = set(self._pids)
+                    for i in range(self.workers):
+                        self._spawn()
+                    self._signal(old_pids, signal.SIGTERM)
+                else:
+                    self._stop_workers()
+            while len(self._pids) < self.workers:
+                self._spawn()
+            time.sleep(POLL_INTERVAL)
+
+        self._stopping = True
+        self._stop_workers()
+        self.listener.close()
+        self._log('Stopped')
+        return status
+
+def multiprocess(driver):
+    """Whether several worker processes can serve the named backend"""
+    if int(os.environ.get('BASICDB_BACKEND_CACHE_SIZE', '0')):
+        return False
+    module = importlib.import_module('basicdb.backends.%s' % (driver,))
+    return getattr(module, 'MULTIPROCESS', False)
+
+def in_memory(driver):
+    """Whether the named backend's data only lives in the worker process, and
+    is lost whenever the worker is replaced"""
+    return driver == 'fake' and not os.environ.get('BASICDB_FAKE_DATA_DIR')
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve BasicDB with several processes '
+                                                 'and threads')
+    parser.add_argument('port', type=int, nargs='?', default=8000)
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--workers', type=int,
+                        help='Worker processes (default: one per CPU if the backend '
+                             'supports it, otherwise 1)')
+    parser.add_argument('--threads', type=int, default=8,
+                        help='Threads per worker, each serving one connection at a time')
+    parser.add_argument('--keepalive', type=float, default=5,
+                        help='Seconds to wait for the next request on a connection')
+    parser.add_argument('--max-requests', type=int, default=0,
+                        help='Replace workers after about this many requests (0: never)')
+    parser.add_argument('--graceful-timeout', type=float, default=30,
+                        help='Seconds workers get to finish their requests when stopping')
+    args = parser.parse_args(argv)
+
+    driver = os.environ.get('BASICDB_BACKEND_DRIVER', 'fake')
+    shareable = multiprocess(driver)
+    workers = args.workers
+    if workers is None:
+        workers = shareable and multiprocessing.cpu_count() or 1
+    if workers > 1 and not shareable:
+        print >> sys.stderr, ("The %s backend (or the item cache) can't be shared by "
+                              "several worker processes (see basicdb.server); use "
+                              "--threads instead" % (driver,))
+        return 1
+    volatile = in_memory(driver)
+    if volatile and args.max_requests:
+        print >> sys.stderr, ("The %s backend keeps its data in the worker process, "
+                              "which --max-requests would throw away; set "
+                              "BASICDB_FAKE_DATA_DIR to keep it" % (driver,))
+        return 1
+
+    import basicdb
+    master = Master(args.host, args.port, basicdb.app, basicdb.get_backend, workers,
+                    args.threads, args.keepalive, args.max_requests,
+                    args.graceful_timeout, multiprocess=shareable,
+                    reloadable=not volatile)
+    return master.run()
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -23,48 +23,58 @@
 # TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
 # SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
+import collections
 import itertools
+import operator
+import os
 import re
-
-from pyparsing import ParserElement, Forward, Suppress, CaselessKeyword, MatchFirst, \
-                      alphas, alphanums, Regex, QuotedString, oneOf, Keyword, \
-                      Word, Optional, delimitedList, operatorPrecedence, opAssoc, \
-                      Group, ParseException
+import threading
 
 from basicdb import exceptions
 
-ParserElement.enablePackrat()
-
 UNARY,BINARY,TERNARY=1,2,3
-LPAR,RPAR,COMMA = map(Suppress,"(),")
-
-# keywords
-(  UNION, ALL, AND, OR, INTERSECT, INTERSECTION, EXCEPT, COLLATE, ASC, DESC, ON,
- NOT, SELECT, DISTINCT, FROM, WHERE, BY, ORDER, BY, LIMIT, EVERY) = map(CaselessKeyword,
-"""UNION, ALL, AND, OR, INTERSECT, INTERSECTION, EXCEPT, COLLATE, ASC, DESC, ON,
- NOT, SELECT, DISTINCT, FROM, WHERE, BY, ORDER, BY, LIMIT, EVERY""".replace(",","").split())
-
-(CAST, ISNULL, NOTNULL, NULL, IS, BETWEEN, ELSE, END, CASE, WHEN, THEN, EXISTS,
- COLLATE, IN, LIKE, GLOB, REGEXP, MATCH, ESCAPE, CURRENT_TIME, CURRENT_DATE,
- CURRENT_TIMESTAMP) = map(CaselessKeyword, """CAST, ISNULL, NOTNULL, NULL, IS, BETWEEN, ELSE,
- END, CASE, WHEN, THEN, EXISTS, COLLATE, IN, LIKE, GLOB, REGEXP, MATCH, ESCAPE,
- CURRENT_TIME, CURRENT_DATE, CURRENT_TIMESTAMP""".replace(",","").split())
-
-keyword = MatchFirst((UNION, ALL, INTERSECT, EXCEPT, COLLATE, ASC, DESC, ON,
- NOT, SELECT, DISTINCT, FROM, WHERE, BY, EVERY,
- ORDER, BY, LIMIT, CAST, ISNULL, NOTNULL, NULL, IS, BETWEEN, ELSE, END, CASE, WHEN, THEN, EXISTS,
- COLLATE, IN, LIKE, GLOB, REGEXP, MATCH, ESCAPE, CURRENT_TIME, CURRENT_DATE,
- CURRENT_TIMESTAMP))
+
+# Reserved words, which can't be used as (unquoted) identifiers
+KEYWORDS = frozenset("""UNION ALL INTERSECT EXCEPT COLLATE ASC DESC ON NOT SELECT
+ DISTINCT FROM WHERE BY EVERY ORDER LIMIT CAST ISNULL NOTNULL NULL IS BETWEEN ELSE
+ END CASE WHEN THEN EXISTS IN LIKE GLOB REGEXP MATCH ESCAPE CURRENT_TIME
+ CURRENT_DATE CURRENT_TIMESTAMP""".split())
+
+class ExpressionError(Exception):
+    """Raised when an expression is malformed or combines operands in a
+    way that isn't allowed"""
+    pass
 
 def regex_from_like(s):
     return str(s).replace('*', '\*').replace('_', '.').replace('%', '.*')
 
 
+# Whitespace outside of quoted strings is insignificant to the grammar, so
+# statements are cached under a key with such runs collapsed. An unterminated
+# quote swallows the rest of the expression so that it is left untouched.
+_WHITESPACE_REGEX = re.compile(r"('[^'\n\r]*'|`[^`\n\r]*`|['`].*)|[ \t\n\r]+", re.DOTALL)
+
+def normalize(sql_expr):
+    return _WHITESPACE_REGEX.sub(lambda m: m.group(1) or ' ', sql_expr).strip()
+
+Statement = collections.namedtuple('Statement', ['columns', 'table', 'where_expr',
+                                                 'order_by_terms', 'limit_terms',
+                                                 'predicate'])
+
+# The attribute lookups the expression tree evaluates identifiers with
+# (see BoolOperator._match), kept per thread so that concurrent matches
+# don't see each other's items
+_lookups = threading.local()
+
 def lookup(id):
-    return
+    current = getattr(_lookups, 'lookup', None)
+    if current is not None:
+        return current(id)
 
 def lookup_every(id):
-    return
+    current = getattr(_lookups, 'lookup_every', None)
+    if current is not None:
+        return current(id)
 
 class SqlParser(object):
     class BoolOperand(object):
@@ -212,7 +222,7 @@ class SqlParser(object):
         def __init__(self, t):
             self.args = t[0][0::2]
             if not all(isinstance(arg, (SqlParser.BinaryComparisonOperator, SqlParser.BoolOperator)) for arg in self.args):
-                raise ParseException("Invalid query")
+                raise ExpressionError("Invalid query")
 
         def __nonzero__(self):
             return self.__bool__()
@@ -234,25 +244,33 @@ class SqlParser(object):
             return "(" + sep.join(map(str,self.args)) + ")"
 
         def match(self, item_name, attrs):
+            try:
+                predicate = self._predicate
+            except AttributeError:
+                predicate = self._predicate = compile_where(self)
+            return predicate(item_name, attrs)
+
+        def cartesian_match(self, item_name, attrs):
+            """Reference matcher evaluating the expression tree once for
+            every combination of values of all of the item's attributes"""
             def set_iter(key, vals):
                 return ((key, v) for v in vals)
 
             return any((self._match(item_name, dict(values), attrs) for values in itertools.product(*[set_iter(key, attrs[key]) for key in attrs.keys()])))
 
         def _match(self, item_name, attrs, raw_attrs):
-            global lookup, lookup_every
             def _lookup(key):
                 if key == 'itemName()':
                     return item_name
                 return attrs.get(key, None)
             def _lookup_every(key):
                 return raw_attrs.get(key, None)
-            saved_lookup, saved_lookup_every = lookup, lookup_every
+            saved = getattr(_lookups, 'lookup', None), getattr(_lookups, 'lookup_every', None)
             try:
-                lookup, lookup_every = _lookup, _lookup_every
+                _lookups.lookup, _lookups.lookup_every = _lookup, _lookup_every
                 return self.__bool__()
             finally:
-                lookup, lookup_every = saved_lookup, saved_lookup_every
+                _lookups.lookup, _lookups.lookup_every = saved
 
         def identifiers(self):
             return sum([arg.identifiers() for arg in self.args], [])
@@ -263,8 +281,8 @@ class SqlParser(object):
         def __init__(self, t):
             self.args = t[0][::2]
 
-        def match(self, item_name, attrs):
-            return all(subexpr.match(item_name, attrs) for subexpr in self.args)
+        def cartesian_match(self, item_name, attrs):
+            return all(subexpr.cartesian_match(item_name, attrs) for subexpr in self.args)
 
         def riak_js_expr(self):
             return [arg.riak_js_expr() for arg in self.args]
@@ -330,7 +348,7 @@ class SqlParser(object):
             self.reprsymbol = t[0][1]
             self.args = t[0][0::2]
             if type(self.args[0]) == type(self.args[1]):
-                raise ParseException("We don't allow comparing two identifiers nor two literals!")
+                raise ExpressionError("We don't allow comparing two identifiers nor two literals!")
 
         def __bool__(self):
             arg0 = self.args[0]
@@ -392,6 +410,30 @@ class SqlParser(object):
             return True
 
     def __init__(self):
+        from pyparsing import ParserElement, Forward, Suppress, CaselessKeyword, MatchFirst, \
+                              alphas, alphanums, Regex, QuotedString, oneOf, Keyword, \
+                              Word, Optional, delimitedList, operatorPrecedence, opAssoc, \
+                              Group, ParseException
+
+        ParserElement.enablePackrat()
+
+        LPAR,RPAR = map(Suppress,"()")
+
+        (AND, OR, INTERSECTION, ASC, DESC, NOT, SELECT, FROM, WHERE, BY, ORDER, LIMIT,
+         EVERY, NULL, IS, BETWEEN, IN, LIKE) = map(CaselessKeyword,
+        """AND OR INTERSECTION ASC DESC NOT SELECT FROM WHERE BY ORDER LIMIT EVERY
+         NULL IS BETWEEN IN LIKE""".split())
+
+        keyword = MatchFirst(map(CaselessKeyword, KEYWORDS))
+
+        def checked(action):
+            def checked_action(s, loc, toks):
+                try:
+                    return action(toks)
+                except ExpressionError, e:
+                    raise ParseException(s, loc, str(e))
+            return checked_action
+
         self.select_stmt = Forward().setName("select statement")
         self.itemName = MatchFirst(Keyword("itemName()")).setParseAction(self.ItemName)
         self.count = MatchFirst(Keyword("count(*)")).setParseAction(self.Count)
@@ -421,13 +463,13 @@ class SqlParser(object):
         self.expr << (operatorPrecedence(self.expr_term,
             [
             (NOT, UNARY, opAssoc.RIGHT, self.BoolNot),
-            (oneOf('< <= > >='), BINARY, opAssoc.LEFT, self.BinaryComparisonOperator),
-            (oneOf('= == != <>') | Group(IS + NOT) | IS | IN | LIKE, BINARY, opAssoc.LEFT, self.BinaryComparisonOperator),
+            (oneOf('< <= > >='), BINARY, opAssoc.LEFT, checked(self.BinaryComparisonOperator)),
+            (oneOf('= == != <>') | Group(IS + NOT) | IS | IN | LIKE, BINARY, opAssoc.LEFT, checked(self.BinaryComparisonOperator)),
             ((BETWEEN,AND), TERNARY, opAssoc.LEFT, self.BetweenXAndY),
-            (OR, BINARY, opAssoc.LEFT, self.BoolOr),
-            (AND, BINARY, opAssoc.LEFT, self.BoolAnd),
+            (OR, BINARY, opAssoc.LEFT, checked(self.BoolOr)),
+            (AND, BINARY, opAssoc.LEFT, checked(self.BoolAnd)),
             (INTERSECTION, BINARY, opAssoc.LEFT, self.Intersection),
-            ])).setParseAction(self.dont_allow_non_comparing_terms)
+            ])).setParseAction(checked(self.dont_allow_non_comparing_terms))
 
         self.ordering_term = (self.itemName | self.identifier) + Optional(ASC | DESC)
 
@@ -440,15 +482,764 @@ class SqlParser(object):
                         Optional(ORDER + BY + Group(delimitedList(self.ordering_term))).setParseAction(self.OrderByTerms)("order_by_terms") +
                         Optional(LIMIT + self.integer)("limit_terms"))
 
-    def dont_allow_non_comparing_terms(self, s, loc, toks):
+    def dont_allow_non_comparing_terms(self, toks):
         if isinstance(toks[0], self.BoolOperand):
-            raise ParseException("Failed")
+            raise ExpressionError("Failed")
         return toks
 
     def parse(self, s):
+        from pyparsing import ParseException
         try:
             ret = self.select_stmt.parseString(s, parseAll=True)
-            ret.columns = ret.columns.asList()
-            return ret
         except ParseException:
             raise exceptions.InvalidQueryExpression()
+        return make_statement(columns=ret.columns.asList(),
+                              table=ret.table,
+                              where_expr=ret.where_expr,
+                              order_by_terms=ret.order_by_terms,
+                              limit_terms=tuple(ret.limit_terms))
+
+
+def make_statement(columns, table, where_expr, order_by_terms, limit_terms):
+    return Statement(columns=columns,
+                     table=table,
+                     where_expr=where_expr,
+                     order_by_terms=order_by_terms,
+                     limit_terms=limit_terms,
+                     predicate=compile_where(where_expr))
+
+
+_TOKEN_REGEX = re.compile(r"""
+    [ \t\n\r]+ |
+    '(?P<string>[^'\n\r]*)' |
+    `(?P<quoted>[^`\n\r]*)` |
+    (?P<special>itemName\(\)|count\(\*\))(?![A-Za-z0-9_$]) |
+    (?P<integer>[+-]?\d+) |
+    (?P<word>[A-Za-z][A-Za-z0-9_]*) |
+    (?P<op><=|>=|<>|!=|==|[<>=(),*])
+    """, re.VERBOSE)
+
+def tokenize(s):
+    """Split a Select expression into a list of (kind, text) tuples
+
+    kind is one of 'string', 'quoted' (a backquoted identifier),
+    'special' (itemName() or count(*)), 'integer', 'word' or 'op'. The
+    list is terminated by an ('end', None) token."""
+    tokens = []
+    pos = 0
+    while pos < len(s):
+        match = _TOKEN_REGEX.match(s, pos)
+        if not match:
+            raise ExpressionError("Unexpected character at %d" % (pos,))
+        if match.lastgroup:
+            tokens.append((match.lastgroup, match.group(match.lastgroup)))
+        pos = match.end()
+    tokens.append(('end', None))
+    return tokens
+
+
+class NativeSqlParser(object):
+    """Parser for the same language as SqlParser that doesn't need pyparsing
+
+    A regex tokenizer feeds a recursive descent parser, which handles the
+    operators by precedence climbing and builds the same expression nodes
+    as the pyparsing grammar. From loosest to tightest binding, the levels
+    are INTERSECTION, AND, OR, BETWEEN, the equality operators (= == != <>
+    IS [NOT] IN LIKE), the relational operators (< <= > >=) and NOT."""
+
+    def parse(self, s):
+        try:
+            return _SelectParser(tokenize(s)).select_stmt()
+        except ExpressionError:
+            raise exceptions.InvalidQueryExpression()
+
+
+class _SelectParser(object):
+    """Parser state for a single expression"""
+    EQUALITY_OPERATORS = ('=', '==', '!=', '<>')
+    RELATIONAL_OPERATORS = ('<', '<=', '>', '>=')
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.pos = 0
+
+    def peek(self, offset=0):
+        return self.tokens[self.pos + offset]
+
+    def take(self):
+        token = self.tokens[self.pos]
+        self.pos += 1
+        return token
+
+    def expect(self, kind, text=None):
+        token_kind, token_text = self.take()
+        if token_kind != kind or (text is not None and token_text != text):
+            raise ExpressionError("Expected %s, got %s" % (text or kind, token_text))
+        return token_text
+
+    def is_keyword(self, keyword, offset=0):
+        kind, text = self.peek(offset)
+        return kind == 'word' and text.upper() == keyword
+
+    def accept_keyword(self, keyword):
+        if self.is_keyword(keyword):
+            self.pos += 1
+            return True
+        return False
+
+    def expect_keyword(self, keyword):
+        if not self.accept_keyword(keyword):
+            raise ExpressionError("Expected %s" % (keyword,))
+
+    def accept_op(self, op):
+        if self.peek() == ('op', op):
+            self.pos += 1
+            return True
+        return False
+
+    def is_identifier(self):
+        kind, text = self.peek()
+        return kind == 'quoted' or (kind == 'word' and text.upper() not in KEYWORDS)
+
+    def identifier(self):
+        if not self.is_identifier():
+            raise ExpressionError("Expected identifier, got %s" % (self.peek()[1],))
+        return self.take()[1]
+
+    def select_stmt(self):
+        self.expect_keyword('SELECT')
+        columns = self.result_column()
+        self.expect_keyword('FROM')
+        table = self.identifier()
+
+        where_expr = ''
+        if self.accept_keyword('WHERE'):
+            where_expr = self.expr()
+
+        order_by_terms = self.order_by_terms()
+
+        limit_terms = ()
+        if self.accept_keyword('LIMIT'):
+            limit_terms = ('LIMIT', self.expect('integer'))
+
+        self.expect('end')
+        return make_statement(columns=columns,
+                              table=table,
+                              where_expr=where_expr,
+                              order_by_terms=order_by_terms,
+                              limit_terms=limit_terms)
+
+    def result_column(self):
+        if self.accept_op('*'):
+            return ['*']
+        elif self.peek() == ('special', 'count(*)'):
+            return [SqlParser.Count([self.take()[1]])]
+
+        columns = [self.column_name()]
+        while self.accept_op(','):
+            columns.append(self.column_name())
+        return columns
+
+    def column_name(self):
+        if self.peek() == ('special', 'itemName()'):
+            return SqlParser.ItemName([self.take()[1]])
+        return self.identifier()
+
+    def order_by_terms(self):
+        if not self.accept_keyword('ORDER'):
+            return SqlParser.OrderByTerms([])
+        self.expect_keyword('BY')
+
+        terms = []
+        while True:
+            if self.peek() == ('special', 'itemName()'):
+                terms.append(SqlParser.ItemName([self.take()[1]]))
+            else:
+                terms.append(SqlParser.Identifier([self.identifier()]))
+            for direction in ('ASC', 'DESC'):
+                if self.accept_keyword(direction):
+                    terms.append(direction)
+                    break
+            if not self.accept_op(','):
+                break
+        return SqlParser.OrderByTerms(['ORDER', 'BY', terms])
+
+    def expr(self):
+        expr = self.binary_operation(self.conjunction, 'INTERSECTION', SqlParser.Intersection)
+        if isinstance(expr, SqlParser.BoolOperand):
+            raise ExpressionError("Expression does not compare anything")
+        return expr
+
+    def conjunction(self):
+        return self.binary_operation(self.disjunction, 'AND', SqlParser.BoolAnd)
+
+    def disjunction(self):
+        return self.binary_operation(self.between, 'OR', SqlParser.BoolOr)
+
+    def binary_operation(self, operand, keyword, node_class):
+        tokens = [operand()]
+        while self.accept_keyword(keyword):
+            tokens += [keyword, operand()]
+        if len(tokens) == 1:
+            return tokens[0]
+        return node_class([tokens])
+
+    def between(self):
+        expr = self.equality()
+        if self.accept_keyword('BETWEEN'):
+            lower = self.equality()
+            self.expect_keyword('AND')
+            upper = self.equality()
+            expr = SqlParser.BetweenXAndY([[expr, 'BETWEEN', lower, 'AND', upper]])
+        return expr
+
+    def equality_operator(self):
+        kind, text = self.peek()
+        if kind == 'op' and text in self.EQUALITY_OPERATORS:
+            self.pos += 1
+            return text
+        elif self.is_keyword('IS'):
+            self.pos += 1
+            if self.accept_keyword('NOT'):
+                return ['IS', 'NOT']
+            return 'IS'
+        for keyword in ('IN', 'LIKE'):
+            if self.accept_keyword(keyword):
+                return keyword
+
+    def relational_operator(self):
+        kind, text = self.peek()
+        if kind == 'op' and text in self.RELATIONAL_OPERATORS:
+            self.pos += 1
+            return text
+
+    def equality(self):
+        return self.comparison(self.relational, self.equality_operator)
+
+    def relational(self):
+        return self.comparison(self.negation, self.relational_operator)
+
+    def comparison(self, operand, operator):
+        left = operand()
+        symbol = operator()
+        if symbol is None:
+            return left
+        expr = SqlParser.BinaryComparisonOperator([[left, symbol, operand()]])
+        if operator() is not None:
+            raise ExpressionError("Comparisons can not be chained")
+        return expr
+
+    def negation(self):
+        if self.accept_keyword('NOT'):
+            return SqlParser.BoolNot([['NOT', self.negation()]])
+        return self.term()
+
+    def term(self):
+        kind, text = self.peek()
+        if kind == 'special' and text == 'itemName()':
+            self.pos += 1
+            return SqlParser.ItemName([text])
+        elif kind == 'string':
+            self.pos += 1
+            return SqlParser.Literal([text])
+        elif self.accept_keyword('NULL'):
+            return SqlParser.Null()
+        elif self.accept_keyword('EVERY'):
+            self.expect('op', '(')
+            identifier = SqlParser.Identifier([self.identifier()])
+            self.expect('op', ')')
+            return SqlParser.EveryIdentifier(['EVERY', identifier])
+        elif self.is_identifier():
+            if self.peek(1) == ('op', '('):
+                raise ExpressionError("Unknown function %s" % (text,))
+            return SqlParser.Identifier([self.identifier()])
+        elif (kind, text) == ('op', '('):
+            if self.peek(1) == ('op', ')') or (self.peek(1)[0] == 'string' and
+                                                self.peek(2) in (('op', ','), ('op', ')'))):
+                return self.value_list()
+            self.pos += 1
+            expr = self.expr()
+            self.expect('op', ')')
+            return expr
+        raise ExpressionError("Unexpected %s" % (text,))
+
+    def value_list(self):
+        self.expect('op', '(')
+        values = []
+        if not self.accept_op(')'):
+            values.append(SqlParser.Literal([self.expect('string')]))
+            while self.accept_op(','):
+                values.append(SqlParser.Literal([self.expect('string')]))
+            self.expect('op', ')')
+        return SqlParser.ValueList(values)
+
+
+_COMPARISONS = {'<': operator.lt,
+                '<=': operator.le,
+                '>': operator.gt,
+                '>=': operator.ge,
+                '=': operator.eq,
+                '==': operator.eq,
+                '!=': operator.ne,
+                '<>': operator.ne}
+
+_MISSING = (None,)
+
+def compile_where(where_expr):
+    """Compile a parsed WHERE expression into a predicate
+
+    The returned function takes an item name and a dict of the item's
+    attributes (mapping names to sets of values) and tells whether the
+    item matches. Literals are folded and attribute lookups are bound up
+    front, so the expression tree and the module level lookup hooks aren't
+    involved when it runs.
+
+    An item matches if some combination of its values (one per attribute)
+    satisfies the expression. Rather than trying every combination, each
+    comparison is checked against the values of its own attribute, and
+    attributes are only enumerated together where an AND ties them to the
+    same combination, e.g. "a > '1' and a < '5'" needs a single value of a
+    to satisfy both. For the common queries this is linear in the number
+    of values on the item."""
+    if where_expr == '':
+        return lambda item_name, attrs: True
+    return _exists(where_expr)
+
+def _all(predicates):
+    if len(predicates) == 1:
+        return predicates[0]
+    def all_match(item_name, attrs):
+        for predicate in predicates:
+            if not predicate(item_name, attrs):
+                return False
+        return True
+    return all_match
+
+def _any(predicates):
+    if len(predicates) == 1:
+        return predicates[0]
+    def any_match(item_name, attrs):
+        for predicate in predicates:
+            if predicate(item_name, attrs):
+                return True
+        return False
+    return any_match
+
+def _exists(node):
+    """Predicate telling if any combination of values satisfies node"""
+    if isinstance(node, SqlParser.Intersection):
+        # Each side may be satisfied by different values
+        return _all([_exists(arg) for arg in node.args])
+    elif isinstance(node, SqlParser.BoolOr):
+        return _any([_exists(arg) for arg in node.args])
+    elif isinstance(node, SqlParser.BoolAnd):
+        # Conjuncts that share no attributes can be satisfied independently
+        predicates = []
+        for group in _connected(node.args):
+            if len(group) == 1:
+                predicates.append(_exists(group[0]))
+            else:
+                predicates.append(_enumerate(group))
+        return _all(predicates)
+    return _enumerate([node])
+
+def _connected(nodes):
+    """Group nodes that (transitively) refer to the same attributes"""
+    groups = []
+    for node in nodes:
+        names = set(_bound_names(node))
+        group = [node]
+        unrelated = []
+        for other_names, other_group in groups:
+            if names & other_names:
+                names |= other_names
+                group = other_group + group
+            else:
+                unrelated.append((other_names, other_group))
+        groups = unrelated + [(names, group)]
+    return [group for names, group in groups]
+
+def _enumerate(nodes):
+    """Predicate trying each combination of the values the nodes refer to
+    until one satisfies all of them"""
+    names = []
+    for node in nodes:
+        _bound_names(node, names)
+    slots = dict((name, idx) for idx, name in enumerate(names))
+    evaluators = [_compile(node, slots) for node in nodes]
+    evaluate = evaluators[0]
+    if len(evaluators) > 1:
+        def evaluate(item_name, row, attrs):
+            for evaluator in evaluators:
+                if not evaluator(item_name, row, attrs):
+                    return False
+            return True
+
+    if not names:
+        return lambda item_name, attrs: evaluate(item_name, (), attrs)
+    elif len(names) == 1:
+        name = names[0]
+        def predicate(item_name, attrs):
+            for value in attrs.get(name, _MISSING):
+                if evaluate(item_name, (value,), attrs):
+                    return True
+            return False
+        return predicate
+
+    def predicate(item_name, attrs):
+        rows = itertools.product(*[attrs.get(name, _MISSING) for name in names])
+        for row in rows:
+            if evaluate(item_name, row, attrs):
+                return True
+        return False
+    return predicate
+
+def _bound_names(node, names=None):
+    """Names of the attributes that take a single value per row"""
+    if names is None:
+        names = []
+    if isinstance(node, SqlParser.BoolOperator):
+        for arg in node.args:
+            _bound_names(arg, names)
+    elif (type(node) is SqlParser.Identifier and
+          node.reference not in names):
+        names.append(node.reference)
+    return names
+
+def _operand(node, slots):
+    """Returns a (kind, value) pair describing a comparison operand
+
+    kind is 'const' for literals (value is the literal itself), 'list' for
+    value lists (value is a frozenset), 'null' for NULL and 'single' or
+    'every' for identifiers, in which case value is a function of
+    (item_name, row, attrs) returning a single value or a set of values,
+    respectively, or None if the attribute is missing."""
+    if isinstance(node, SqlParser.Literal):
+        return 'const', node.get_single_value_or_raise()
+    elif isinstance(node, SqlParser.ValueList):
+        return 'list', frozenset(v.get_single_value_or_raise() for v in node._value)
+    elif isinstance(node, SqlParser.Null):
+        return 'null', None
+    elif isinstance(node, SqlParser.ItemName):
+        return 'single', lambda item_name, row, attrs: item_name
+    elif isinstance(node, SqlParser.EveryIdentifier):
+        name = node.reference
+        return 'every', lambda item_name, row, attrs: attrs.get(name)
+    elif isinstance(node, SqlParser.Identifier):
+        idx = slots[node.reference]
+        return 'single', lambda item_name, row, attrs: row[idx]
+    raise exceptions.InvalidQueryExpression()
+
+def _constant(value):
+    return lambda item_name, row, attrs: value
+
+def _compile(node, slots):
+    if isinstance(node, (SqlParser.BoolAnd, SqlParser.Intersection)):
+        evaluators = [_compile(arg, slots) for arg in node.args]
+        def evaluate_and(item_name, row, attrs):
+            for evaluate in evaluators:
+                if not evaluate(item_name, row, attrs):
+                    return False
+            return True
+        return evaluate_and
+    elif isinstance(node, SqlParser.BoolOr):
+        evaluators = [_compile(arg, slots) for arg in node.args]
+        def evaluate_or(item_name, row, attrs):
+            for evaluate in evaluators:
+                if evaluate(item_name, row, attrs):
+                    return True
+            return False
+        return evaluate_or
+    elif isinstance(node, SqlParser.BoolNot):
+        evaluate = _compile(node.args[0], slots)
+        return lambda item_name, row, attrs: not evaluate(item_name, row, attrs)
+    elif isinstance(node, SqlParser.BetweenXAndY):
+        return _compile_between(node, slots)
+    elif isinstance(node, SqlParser.BinaryComparisonOperator):
+        return _compile_comparison(node, slots)
+    raise exceptions.InvalidQueryExpression()
+
+def _compile_test(kind, value, test, negate=False):
+    """Evaluator applying test() to an operand's value(s)
+
+    A missing attribute never matches, and every() requires all of the
+    attribute's values to pass. If negate is set, the outcome is inverted
+    for operands that are present."""
+    if kind == 'const':
+        return _constant(bool(test(value)) != negate)
+    elif kind == 'single':
+        def evaluate_single(item_name, row, attrs):
+            v = value(item_name, row, attrs)
+            return v is not None and bool(test(v)) != negate
+        return evaluate_single
+    elif kind == 'every':
+        def evaluate_every(item_name, row, attrs):
+            vals = value(item_name, row, attrs)
+            if vals is None:
+                return False
+            for v in vals:
+                if not test(v):
+                    return negate
+            return not negate
+        return evaluate_every
+    raise exceptions.InvalidQueryExpression()
+
+def _compile_comparison(node, slots):
+    symbol = node.reprsymbol
+    left_kind, left = _operand(node.args[0], slots)
+    right_kind, right = _operand(node.args[1], slots)
+
+    if not isinstance(symbol, basestring):
+        # IS NOT NULL
+        if right_kind != 'null':
+            raise exceptions.InvalidQueryExpression()
+        return _compile_test(left_kind, left, lambda v: True)
+    elif symbol == 'IS':
+        return _constant(False)
+    elif symbol == 'IN':
+        if right_kind != 'list':
+            raise exceptions.InvalidQueryExpression()
+        return _compile_test(left_kind, left, right.__contains__)
+    elif symbol == 'LIKE':
+        if right_kind != 'const':
+            raise exceptions.InvalidQueryExpression()
+        return _compile_test(left_kind, left, re.compile(regex_from_like(right)).match)
+
+    compare = _COMPARISONS[symbol]
+    # a != b is evaluated as not (a = b), which matters for every()
+    negate = compare is operator.ne
+    if negate:
+        compare = operator.eq
+
+    if right_kind == 'const' and left_kind in ('const', 'single', 'every'):
+        return _compile_test(left_kind, left, lambda v: compare(v, right), negate)
+    elif left_kind == 'const' and right_kind in ('single', 'every'):
+        return _compile_test(right_kind, right, lambda v: compare(left, v), negate)
+    elif left_kind not in ('single', 'every') or right_kind not in ('single', 'every'):
+        raise exceptions.InvalidQueryExpression()
+
+    def values(kind, value, item_name, row, attrs):
+        v = value(item_name, row, attrs)
+        if kind == 'single' and v is not None:
+            return (v,)
+        return v
+
+    def evaluate(item_name, row, attrs):
+        lvals = values(left_kind, left, item_name, row, attrs)
+        rvals = values(right_kind, right, item_name, row, attrs)
+        if lvals is None or rvals is None:
+            return False
+        for lval, rval in itertools.product(lvals, rvals):
+            if not compare(lval, rval):
+                return negate
+        return not negate
+    return evaluate
+
+def _compile_between(node, slots):
+    bounds = [_operand(arg, slots) for arg in node.args[1:]]
+    if any(kind != 'const' for kind, _ in bounds):
+        raise exceptions.InvalidQueryExpression()
+    lower = min(value for _, value in bounds)
+    upper = max(value for _, value in bounds)
+    kind, value = _operand(node.args[0], slots)
+    return _compile_test(kind, value, lambda v: lower < v < upper)
+
+
+def candidate_items(where_expr, index):
+    """Use an index to narrow down the items that may match where_expr
+
+    index is an index from basicdb.index (or anything with the same lookup
+    methods). Returns a set of item names containing at least every matching
+    item, or None if the index can't narrow down the search."""
+    if isinstance(where_expr, (SqlParser.BoolAnd, SqlParser.Intersection)):
+        candidates = None
+        for arg in where_expr.args:
+            arg_candidates = candidate_items(arg, index)
+            if arg_candidates is None:
+                continue
+            if candidates is None:
+                candidates = arg_candidates
+            else:
+                candidates = candidates & arg_candidates
+        return candidates
+    elif isinstance(where_expr, SqlParser.BoolOr):
+        candidates = set()
+        for arg in where_expr.args:
+            arg_candidates = candidate_items(arg, index)
+            if arg_candidates is None:
+                return None
+            candidates |= arg_candidates
+        return candidates
+    elif isinstance(where_expr, SqlParser.BetweenXAndY):
+        return _between_candidates(where_expr, index)
+    elif isinstance(where_expr, SqlParser.BinaryComparisonOperator):
+        return _comparison_candidates(where_expr, index)
+    return None
+
+# Characters that end the literal prefix of a LIKE pattern once it has been
+# turned into a regular expression by regex_from_like.
+_LIKE_SPECIAL = frozenset('%_.^$[]()\\|')
+_LIKE_QUANTIFIERS = frozenset('?+{')
+
+def like_prefix(s):
+    """The literal prefix of every value matching the LIKE pattern s"""
+    s = str(s)
+    if '|' in s:
+        return ''
+    prefix = []
+    for c in s:
+        if c in _LIKE_QUANTIFIERS:
+            # The quantifier may make the preceding character optional
+            return ''.join(prefix[:-1])
+        if c in _LIKE_SPECIAL:
+            break
+        prefix.append(c)
+    return ''.join(prefix)
+
+def _indexed_attribute(node):
+    if (isinstance(node, SqlParser.Identifier) and
+        not isinstance(node, SqlParser.Count)):
+        return node.reference
+
+def _attribute_and_operand(node):
+    """Split a comparison into the attribute it applies to and the other
+    operand, or return (None, None) if it doesn't compare an attribute (or
+    itemName()). The third element tells whether the operands were swapped
+    relative to the expression."""
+    for attr, other, swapped in ((node.args[0], node.args[1], False),
+                                 (node.args[1], node.args[0], True)):
+        attr_name = _indexed_attribute(attr)
+        if attr_name is not None:
+            return attr_name, other, swapped
+    return None, None, False
+
+_SWAPPED = {'<': '>', '<=': '>=', '>': '<', '>=': '<='}
+
+def _comparison_candidates(node, index):
+    attr_name, operand, swapped = _attribute_and_operand(node)
+    if attr_name is None:
+        return None
+    symbol = node.reprsymbol
+    if swapped:
+        symbol = _SWAPPED.get(symbol, symbol)
+    if symbol == 'IN' and isinstance(operand, SqlParser.ValueList):
+        candidates = set()
+        for value in operand._value:
+            value_candidates = index.equal(attr_name, value.get_single_value_or_raise())
+            if value_candidates is None:
+                return None
+            candidates |= value_candidates
+        return candidates
+    if not isinstance(operand, SqlParser.Literal):
+        return None
+    value = operand.get_single_value_or_raise()
+    if symbol in ('=', '=='):
+        return index.equal(attr_name, value)
+    elif symbol == '<':
+        return index.range(attr_name, upper=value, upper_inclusive=False)
+    elif symbol == '<=':
+        return index.range(attr_name, upper=value)
+    elif symbol == '>':
+        return index.range(attr_name, lower=value, lower_inclusive=False)
+    elif symbol == '>=':
+        return index.range(attr_name, lower=value)
+    elif symbol == 'LIKE' and not swapped:
+        prefix = like_prefix(value)
+        if prefix:
+            return index.prefix(attr_name, prefix)
+    return None
+
+def _between_candidates(node, index):
+    attr_name = _indexed_attribute(node.args[0])
+    bounds = node.args[1:]
+    if (attr_name is None or
+        not all(isinstance(bound, SqlParser.Literal) for bound in bounds)):
+        return None
+    bounds = [bound.get_single_value_or_raise() for bound in bounds]
+    return index.range(attr_name, min(bounds), max(bounds),
+                       lower_inclusive=False, upper_inclusive=False)
+
+class _ItemNameLookup(object):
+    """Answers the candidate_items lookups that constrain itemName() to
+    given names with those names, without looking at any items"""
+    def equal(self, attr_name, attr_value):
+        if attr_name == 'itemName()':
+            return set([attr_value])
+        return None
+
+    def range(self, *args, **kwargs):
+        return None
+
+    def prefix(self, *args, **kwargs):
+        return None
+
+def item_names(where_expr):
+    """The set of item names where_expr restricts itemName() to, through
+    equality, IN and conjunctions (or disjunctions) of those, or None if it
+    doesn't restrict them to a known set"""
+    return candidate_items(where_expr, _ItemNameLookup())
+
+class StatementCache(object):
+    """Bounded LRU cache of parsed statements
+
+    Statements are keyed by their normalized text and are shared between
+    requests, so they must not be modified by the caller."""
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._statements = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._parse_lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._statements)
+
+    def clear(self):
+        with self._lock:
+            self._statements.clear()
+            self.hits = self.misses = 0
+
+    def parse(self, sql_expr):
+        key = normalize(sql_expr)
+        with self._lock:
+            if key in self._statements:
+                self.hits += 1
+                statement = self._statements.pop(key)
+                self._statements[key] = statement
+                return statement
+            self.misses += 1
+
+        # The packrat cache in pyparsing is global, so parse one at a time
+        with self._parse_lock:
+            statement = get_parser().parse(key)
+
+        if self.maxsize > 0:
+            with self._lock:
+                self._statements[key] = statement
+                while len(self._statements) > self.maxsize:
+                    self._statements.popitem(last=False)
+        return statement
+
+
+PARSERS = {'pyparsing': SqlParser,
+           'native': NativeSqlParser}
+
+_parser = None
+
+def load_parser(name):
+    """Select the parser used for Select expressions (see PARSERS)"""
+    global _parser
+    _parser = PARSERS[name]()
+    statement_cache.clear()
+
+def get_parser():
+    """Return the process wide parser, building it on first use"""
+    if _parser is None:
+        load_parser(os.environ.get('BASICDB_SQL_PARSER', 'pyparsing'))
+    return _parser
+
+statement_cache = StatementCache(int(os.environ.get('BASICDB_STATEMENT_CACHE_SIZE', 1024)))
+
+def parse(sql_expr):
+    return statement_cache.parse(sql_expr)
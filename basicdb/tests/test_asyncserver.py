@@ -0,0 +1,125 @@
+import httplib
+import socket
+import StringIO
+import sys
+import threading
+import time
+
+import testtools as unittest
+
+from basicdb import asyncserver
+
+class AsyncServerTest(unittest.TestCase):
+    def setUp(self):
+        super(AsyncServerTest, self).setUp()
+        self.started = []
+        self.release = threading.Event()
+
+    def app(self, environ, start_response):
+        path = environ['PATH_INFO']
+        self.started.append(path)
+        if path == '/stream':
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return (piece for piece in ['a' * 10, 'b' * 20])
+        if path == '/big':
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return ('x' * 65536 for i in range(32))
+        if path == '/block':
+            self.release.wait(5)
+        if path == '/fail':
+            raise Exception('Failed')
+        body = '%s %s %s %s' % (environ['REQUEST_METHOD'], path, environ['QUERY_STRING'],
+                                environ['wsgi.input'].read())
+        start_response('200 OK', [('Content-Type', 'text/plain'),
+                                  ('Content-Length', str(len(body)))])
+        return [body]
+
+    def start_server(self, **kwargs):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(5)
+        self.server = asyncserver.AsyncServer(listener, self.app, **kwargs)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.start()
+        self.addCleanup(thread.join, 5)
+        self.addCleanup(self.server.stop)
+        self.addCleanup(self.release.set)
+        self.port = self.server.address[1]
+
+    def connect(self):
+        conn = httplib.HTTPConnection('127.0.0.1', self.port, timeout=5)
+        self.addCleanup(conn.close)
+        return conn
+
+    def get(self, conn, path, method='GET', body=None):
+        conn.request(method, path, body)
+        response = conn.getresponse()
+        return response, response.read()
+
+    def test_connections_are_kept_alive(self):
+        self.start_server()
+        conn = self.connect()
+        response, body = self.get(conn, '/?Action=ListDomains')
+        self.assertEquals(body, 'GET / Action=ListDomains ')
+        sock = conn.sock
+        response, body = self.get(conn, '/', 'POST', 'a body')
+        self.assertEquals(body, 'POST /  a body')
+        self.assertIs(conn.sock, sock)
+
+    def test_pipelined_requests(self):
+        self.start_server()
+        sock = socket.create_connection(('127.0.0.1', self.port), 5)
+        self.addCleanup(sock.close)
+        sock.sendall('GET /1 HTTP/1.1\r\n\r\nGET /2 HTTP/1.1\r\nConnection: close\r\n\r\n')
+        data = ''
+        while True:
+            received = sock.recv(4096)
+            if not received:
+                break
+            data += received
+        self.assertEquals(data.count('HTTP/1.1 200 OK'), 2)
+        self.assertTrue(data.index('GET /1') < data.index('GET /2'))
+
+    def test_responses_of_unknown_length_are_chunked(self):
+        self.start_server()
+        conn = self.connect()
+        response, body = self.get(conn, '/stream')
+        self.assertEquals(response.getheader('Transfer-Encoding'), 'chunked')
+        self.assertEquals(body, 'a' * 10 + 'b' * 20)
+        response, body = self.get(conn, '/big')
+        self.assertEquals(len(body), 65536 * 32)
+        self.assertEquals(self.get(conn, '/')[1], 'GET /  ')
+
+    def test_failing_app(self):
+        self.patch(sys, 'stderr', StringIO.StringIO())
+        self.start_server()
+        self.assertEquals(self.get(self.connect(), '/fail')[0].status, 500)
+        self.assertEquals(self.get(self.connect(), '/')[1], 'GET /  ')
+
+    def test_requests_wait_for_a_thread(self):
+        self.start_server(threads=1, queue=0)
+        blocked = self.connect()
+        blocked.request('GET', '/block')
+        waiting = self.connect()
+        waiting.request('GET', '/waiting')
+        for i in range(100):
+            if len(self.server.waiting) == 1:
+                break
+            time.sleep(0.01)
+        self.assertEquals(len(self.server.waiting), 1)
+        self.assertEquals(self.started, ['/block'])
+
+        self.release.set()
+        self.assertEquals(waiting.getresponse().read(), 'GET /waiting  ')
+        self.assertEquals(blocked.getresponse().read(), 'GET /block  ')
+        self.assertEquals(self.started, ['/block', '/waiting'])
+
+    def test_idle_connections_are_closed(self):
+        self.start_server(keepalive=0.1)
+        conn = self.connect()
+        self.get(conn, '/')
+        for i in range(300):
+            if not self.server.connections():
+                break
+            time.sleep(0.01)
+        self.assertEquals(self.server.connections(), 0)
@@ -1,7 +1,17 @@
+import hashlib
+import os
+import shutil
+import StringIO
+import sys
+import tempfile
+import threading
+import time
+
 import testtools as unittest
 
 import basicdb.backends
 import basicdb.exceptions as exc
+import basicdb.sqlparser
 
 class BaseStorageBackendTests(unittest.TestCase):
     def test_create_domain_raises_not_implemented(self):
@@ -235,17 +245,127 @@ class BaseStorageBackendTests(unittest.TestCase):
                           backend.check_expectation, "owner", 'domain', 'item', ('foo', 'bar'))
 
     def test_check_expectations(self):
-        self.check_expectation_call_args = []
+        self.get_attributes_call_args = []
+        class TestStoreBackend(basicdb.backends.StorageBackend):
+            def get_attributes(self2, *args):
+                self.get_attributes_call_args += [args]
+                return {"attr1": set(["val1"]), "attr2": set(["val3"])}
+
+        backend = TestStoreBackend()
+        self.assertTrue(backend.check_expectations("owner", "domain", "item",
+                                                   [("attr1", "val1"), ("attr2", True),
+                                                    ("attr3", False)]))
+        self.assertEquals(self.get_attributes_call_args, [("owner", "domain", "item")])
+        self.assertRaises(exc.WrongValueFound,
+                          backend.check_expectations, "owner", "domain", "item",
+                          [("attr1", "val1"), ("attr2", "val2")])
+
+
+class SortItemsTest(unittest.TestCase):
+    items = {"item1": {"a": set(["b", "e"])},
+             "item2": {"a": set(["c"])},
+             "item3": {"a": set(["d", "a"])},
+             "item4": {"f": set(["g"])}}
+
+    def sort_items(self, key, *args, **kwargs):
+        return [item_name for item_name, _ in
+                basicdb.backends.sort_items(self.items.iteritems(), key, *args, **kwargs)]
+
+    def test_items_are_sorted_by_lowest_value(self):
+        self.assertEquals(self.sort_items("a"), ["item3", "item1", "item2"])
+
+    def test_items_are_sorted_by_highest_value_when_reversed(self):
+        self.assertEquals(self.sort_items("a", reverse=True), ["item1", "item3", "item2"])
+
+    def test_limit(self):
+        self.assertEquals(self.sort_items("a", limit=2), ["item3", "item1"])
+        self.assertEquals(self.sort_items("a", reverse=True, limit=1), ["item1"])
+
+    def test_item_name(self):
+        self.assertEquals(self.sort_items("itemName()", reverse=True, limit=3),
+                          ["item4", "item3", "item2"])
+
+    def test_ties_are_broken_by_item_name(self):
+        items = {"item2": {"a": set(["b"])}, "item1": {"a": set(["b"])}}
+        self.assertEquals(basicdb.backends.sort_items(items.iteritems(), "a"),
+                          [("item1", {"a": set(["b"])}), ("item2", {"a": set(["b"])})])
+
+class ApplyChangesTest(unittest.TestCase):
+    def test_additions_then_replacements(self):
+        item_attrs = {"a": set(["b"]), "c": set(["d"])}
+        basicdb.backends.apply_changes(item_attrs, {"a": set(["e"]), "c": set(["f"])},
+                                       {"c": set(["g"]), "h": set(["i"])})
+        self.assertEquals(item_attrs, {"a": set(["b", "e"]), "c": set(["g"]), "h": set(["i"])})
+
+    def test_deletions_drop_empty_attributes(self):
+        item_attrs = {"a": set(["b", "c"]), "d": set(["e"]), "f": set(["g"])}
+        basicdb.backends.apply_changes(item_attrs, deletions={"a": set(["b"]),
+                                                              "d": set([basicdb.AllAttributes]),
+                                                              "f": set(["g"]),
+                                                              "h": set(["i"])})
+        self.assertEquals(item_attrs, {"a": set(["c"])})
+
+class SelectStreamTest(unittest.TestCase):
+    def test_select_returning_a_dict_is_supported(self):
+        class TestStoreBackend(basicdb.backends.StorageBackend):
+            def select(self2, owner, parsed):
+                return {"item1": {"a": set(["b"])}, "item2": {"a": set(["a"])}}
+
+        backend = TestStoreBackend()
+        self.assertEquals(backend.select_wrapper("owner", "select * from domain1 where a > '0' order by a"),
+                          (["item2", "item1"], {"item1": {"a": set(["b"])}, "item2": {"a": set(["a"])}}))
+
+    def test_limit_stops_pulling_items(self):
+        pulled = []
+        class TestStoreBackend(basicdb.backends.StorageBackend):
+            def select_iter(self2, owner, parsed):
+                for i in range(100):
+                    pulled.append(i)
+                    yield "item%d" % (i,), {}
+
+        backend = TestStoreBackend()
+        order, _ = backend.select_wrapper("owner", "select itemName() from domain1 limit 3")
+        self.assertEquals(order, ["item0", "item1", "item2"])
+        self.assertEquals(pulled, [0, 1, 2])
+
+    def test_count_falls_back_to_select_iter(self):
+        class TestStoreBackend(basicdb.backends.StorageBackend):
+            def select_iter(self2, owner, parsed):
+                return iter([("item%d" % (i,), {}) for i in range(5)])
+
+        backend = TestStoreBackend()
+        self.assertEquals(backend.select_wrapper("owner", "select count(*) from domain1 limit 3"),
+                          (["domain1"], {"domain1": {"count": set(["3"])}}))
+        self.assertEquals(backend.count("owner", basicdb.sqlparser.parse("select count(*) from domain1")), 5)
+
+    def test_item_name_constraints_are_looked_up_directly(self):
+        looked_up = []
         class TestStoreBackend(basicdb.backends.StorageBackend):
-            def check_expectation(self2, *args):
-                self.check_expectation_call_args += [args]
+            def select_iter(self2, owner, parsed):
+                self.fail("select_iter shouldn't be used")
+
+            def get_attributes(self2, owner, domain_name, item_name):
+                looked_up.append(item_name)
+                if item_name == "item3":
+                    return {}
+                return {"a": set([item_name])}
 
         backend = TestStoreBackend()
-        backend.check_expectations("owner", "domain", "item", [("attr1", "val1"), ("attr1", "val2"), ("attr2", "val3")])
-        self.assertIn(("owner", "domain", "item", ("attr1", "val1")), self.check_expectation_call_args)
-        self.assertIn(("owner", "domain", "item", ("attr1", "val2")), self.check_expectation_call_args)
-        self.assertIn(("owner", "domain", "item", ("attr2", "val3")), self.check_expectation_call_args)
+        self.assertEquals(backend.select_wrapper("owner", "select * from domain1 where itemName() in ('item1', 'item2', 'item3') and a != 'item2'"),
+                          (["item1"], {"item1": {"a": set(["item1"])}}))
+        self.assertEquals(looked_up, ["item1", "item2", "item3"])
+
+    def test_sort_key_outside_projection(self):
+        class TestStoreBackend(basicdb.backends.StorageBackend):
+            def select_iter(self2, owner, parsed):
+                self.assertEquals(parsed.columns, ["*"])
+                return iter([("item1", {"a": set(["2"]), "b": set(["x"])}),
+                             ("item2", {"a": set(["1"]), "b": set(["y"])}),
+                             ("item3", {"a": set(["0"])})])
 
+        backend = TestStoreBackend()
+        self.assertEquals(backend.select_wrapper("owner", "select b from domain1 where a > '0' order by a"),
+                          (["item2", "item1"], {"item1": {"b": set(["x"])}, "item2": {"b": set(["y"])}}))
 
 class _GenericBackendDriverTest(object):
     def test_create_list_delete_domain(self):
@@ -304,6 +424,17 @@ class _GenericBackendDriverTest(object):
         self.assertEquals(self.backend.get_attributes("owner", "domain1", "item1"),
                           {"a": set(["h"]), "d": set(["e", "f", "g"])})
 
+    def test_put_attributes_replaces_after_adding(self):
+        self.backend.create_domain("owner", "domain1")
+        self.backend.put_attributes("owner", "domain1", "item1",
+                                    {"a": set(["b"]), "c": set(["d"])}, {})
+        self.backend.put_attributes("owner", "domain1", "item1",
+                                    {"a": set(["e"]), "c": set(["f"])},
+                                    {"c": set(["d", "g"])})
+
+        self.assertEquals(self.backend.get_attributes("owner", "domain1", "item1"),
+                          {"a": set(["b", "e"]), "c": set(["d", "g"])})
+
     def test_delete_attributes_non_existant_item(self):
         self.backend.create_domain("owner", "domain1")
         self.backend.delete_attributes("owner", "domain1", "item1",
@@ -358,6 +489,38 @@ class _GenericBackendDriverTest(object):
         self.assertEquals(self.backend.get_attributes("owner", "domain1", "item2"),
                           {"h": set(["i"])})
 
+    def test_concurrent_conditional_puts(self):
+        self.backend.create_domain("owner", "domain1")
+        self.backend.put_attributes("owner", "domain1", "counter", {}, {"value": set(["0"])})
+        successes = []
+
+        def increment():
+            for i in range(10):
+                while True:
+                    values = self.backend.get_attributes("owner", "domain1", "counter").get("value")
+                    if not values or len(values) != 1:
+                        continue
+                    value = iter(values).next()
+                    try:
+                        self.backend.put_attributes("owner", "domain1", "counter",
+                                                    {}, {"value": set([str(int(value) + 1)])},
+                                                    [("value", value)])
+                    except (exc.ConditionalCheckFailed, exc.AttributeDoesNotExist,
+                            exc.MultiValuedAttribute):
+                        continue
+                    successes.append(value)
+                    break
+
+        threads = [threading.Thread(target=increment) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEquals(self.backend.get_attributes("owner", "domain1", "counter"),
+                          {"value": set(["40"])})
+        self.assertEquals(sorted(successes, key=int), [str(i) for i in range(40)])
+
     def _load_sample_query_data_set(self):
         self.backend.create_domain('owner', 'mydomain')
         self.backend.put_attributes('owner', 'mydomain', "0385333498",
@@ -476,6 +639,20 @@ class _GenericBackendDriverTest(object):
         f("select itemName() from mydomain where itemName() like 'B000%' order by itemName()",
           ["B00005JPLW", "B000SF3NGK", "B000T9886K"])
 
+        f("select * from mydomain where Keyword is not null order by Keyword limit 3",
+          ["B00005JPLW", "1579124585", "0385333498"], ordered=True)
+
+        f("select * from mydomain where Keyword is not null order by Keyword desc",
+          ["B000T9886K", "0385333498", "1579124585", "B00005JPLW", "0802131786"], ordered=True)
+
+        f("select * from mydomain where Keyword > 'B' order by Keyword desc limit 2",
+          ["B000T9886K", "0385333498"], ordered=True)
+
+        f("select Title from mydomain where Year < '1980' order by Year",
+          ["0802131786", "0385333498", "1579124585"], ordered=True)
+
+        self.assertEquals(len(self.backend.select_wrapper("owner", "select * from mydomain limit 2")[0]), 2)
+
         def g(expr, expected):
             order, results = self.backend.select_wrapper("owner", expr)
             self.assertEquals(order, ['mydomain'])
@@ -486,6 +663,34 @@ class _GenericBackendDriverTest(object):
         g("select count(*) from mydomain limit 500", "6")
         g("select count(*) from mydomain limit 4", "4")
 
+    def test_select_by_item_name(self):
+        self._load_sample_query_data_set()
+        def f(expr):
+            return set(self.backend.select_wrapper("owner", expr)[0])
+
+        self.assertEquals(f("select * from mydomain where itemName() = '0802131786'"),
+                          set(["0802131786"]))
+        self.assertEquals(f("select * from mydomain where itemName() in ('0802131786', 'B000SF3NGK', 'nonexistent')"),
+                          set(["0802131786", "B000SF3NGK"]))
+        self.assertEquals(f("select * from mydomain where itemName() in ('0802131786', 'B000SF3NGK') and Year > '2000'"),
+                          set(["B000SF3NGK"]))
+        self.assertEquals(f("select Pages from mydomain where itemName() in ('0802131786', 'B000SF3NGK')"),
+                          set(["0802131786"]))
+        self.assertEquals(self.backend.select_wrapper("owner", "select count(*) from mydomain where itemName() in ('0802131786', 'nonexistent')"),
+                          (["mydomain"], {"mydomain": {"count": set(["1"])}}))
+
+    def test_count(self):
+        self._load_sample_query_data_set()
+        def count(expr):
+            return self.backend.count("owner", basicdb.sqlparser.parse(expr))
+
+        self.assertEquals(count("select count(*) from mydomain"), 6)
+        self.assertEquals(count("select count(*) from mydomain limit 2"), 6)
+        self.assertEquals(count("select count(*) from mydomain where Year > '1985'"), 3)
+        self.assertEquals(count("select count(*) from mydomain where Keyword = 'Book' and Rating = '****'"), 2)
+        self.assertEquals(count("select count(*) from mydomain where itemName() like 'B000%' and Year = '2007'"), 2)
+        self.assertEquals(count("select count(*) from mydomain where Author = 'Nobody'"), 0)
+
     def test_select(self):
         self.backend.create_domain("owner", "domain1")
         self.backend.put_attributes("owner", "domain1", "item1",
@@ -571,16 +776,779 @@ class FakeBackendDriverTest(_GenericBackendDriverTest, unittest.TestCase):
         super(FakeBackendDriverTest, self).tearDown()
         self.backend._reset()
 
+class UnindexedFakeBackendDriverTest(FakeBackendDriverTest):
+    def setUp(self):
+        super(UnindexedFakeBackendDriverTest, self).setUp()
+        self.backend = basicdb.backends.fake.driver(index='none')
+
+class InvertedIndexFakeBackendDriverTest(FakeBackendDriverTest):
+    def setUp(self):
+        super(InvertedIndexFakeBackendDriverTest, self).setUp()
+        self.backend = basicdb.backends.fake.driver(index='inverted')
+
+class CompactFakeBackendDriverTest(FakeBackendDriverTest):
+    def setUp(self):
+        super(CompactFakeBackendDriverTest, self).setUp()
+        self.backend = basicdb.backends.fake.driver(storage='compact')
+
+class CompactDomainTest(unittest.TestCase):
+    def setUp(self):
+        super(CompactDomainTest, self).setUp()
+        self.domain = basicdb.backends.fake.CompactDomain()
+
+    def test_single_values_are_not_wrapped(self):
+        self.assertTrue(self.domain.add("item1", "a", "b"))
+        self.assertFalse(self.domain.add("item1", "c", "d"))
+        self.assertEquals(self.domain.items["item1"], (0, "b", 1, "d"))
+        self.assertEquals(self.domain.attributes("item1"), {"a": set(["b"]), "c": set(["d"])})
+
+    def test_multiple_values(self):
+        self.domain.add("item1", "a", "b")
+        self.domain.add("item1", "a", "c")
+        self.domain.add("item1", "a", "c")
+        self.assertEquals(self.domain.items["item1"], (0, ("b", "c")))
+        self.assertEquals(self.domain.get("item1").get("a"), ("b", "c"))
+        self.assertTrue(self.domain.remove("item1", "a", "b"))
+        self.assertFalse(self.domain.remove("item1", "a", "b"))
+        self.assertEquals(self.domain.items["item1"], (0, "c"))
+        self.assertEquals(self.domain.get("item1").get("a"), ("c",))
+
+    def test_remove_all(self):
+        self.domain.add("item1", "a", "b")
+        self.domain.add("item1", "a", "c")
+        self.domain.add("item1", "d", "e")
+        self.assertEquals(sorted(self.domain.remove_all("item1", "a")), ["b", "c"])
+        self.assertEquals(self.domain.remove_all("item1", "a"), ())
+        self.assertEquals(self.domain.attributes("item1"), {"d": set(["e"])})
+        self.assertIsNone(self.domain.get("item1").get("a"))
+
+    def test_strings_are_shared(self):
+        self.domain.add("item1", "a" * 10, "b" * 10)
+        self.domain.add("item2", "a" * 10, "b" * 10)
+        self.assertIs(self.domain.items["item1"][1], self.domain.items["item2"][1])
+        self.assertEquals(len(self.domain._attr_names), 1)
+
+class DurableFakeBackendDriverTest(FakeBackendDriverTest):
+    def setUp(self):
+        super(DurableFakeBackendDriverTest, self).setUp()
+        data_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, data_dir)
+        self.backend = basicdb.backends.fake.driver(data_dir=data_dir)
+        self.addCleanup(self.backend.close)
+
+class DurableFakeBackendTest(unittest.TestCase):
+    def setUp(self):
+        super(DurableFakeBackendTest, self).setUp()
+        self.data_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.data_dir)
+        self.backend = self.open_backend()
+        self.backend.create_domain("owner", "domain1")
+        self.backend.put_attributes("owner", "domain1", "item1", {"a": set(["b", "c"])}, {})
+        self.backend.put_attributes("owner", "domain1", "item2", {"a": set(["d"])}, {})
+
+    def open_backend(self):
+        backend = basicdb.backends.fake.driver(data_dir=self.data_dir, snapshot_interval=3600)
+        self.addCleanup(backend.close)
+        return backend
+
+    def assertRecovered(self):
+        self.backend.close()
+        backend = self.open_backend()
+        self.assertEquals(backend.list_domains("owner"), ["domain1"])
+        self.assertEquals(backend.get_attributes("owner", "domain1", "item1"), {"a": set(["e"])})
+        self.assertFalse(backend.select_wrapper("owner", "select * from domain1 where a = 'd'")[0])
+        self.assertEquals(backend.select_wrapper("owner", "select * from domain1 where a = 'e'")[0],
+                          ["item1"])
+
+    def test_changes_are_replayed(self):
+        self.backend.put_attributes("owner", "domain1", "item1", {}, {"a": set(["e"])})
+        self.backend.delete_attributes("owner", "domain1", "item2", {"a": set(["d"])})
+        self.assertRecovered()
+
+    def test_changes_after_snapshot_are_replayed(self):
+        self.backend.put_attributes("owner", "domain1", "item1", {}, {"a": set(["e"])})
+        self.backend.snapshot()
+        self.backend.delete_attributes("owner", "domain1", "item2", {"a": set(["d"])})
+        self.assertRecovered()
+        self.assertEquals(len([f for f in os.listdir(self.data_dir) if f.startswith("snapshot.")]), 1)
+
+    def test_snapshot_failures_are_reported(self):
+        self.backend.close()
+        self.patch(sys, "stderr", StringIO.StringIO())
+        backend = basicdb.backends.fake.driver(data_dir=self.data_dir, snapshot_interval=0.01)
+        self.addCleanup(backend.close)
+        def snapshot():
+            raise IOError("Disk full")
+        self.patch(backend, "snapshot", snapshot)
+        backend.put_attributes("owner", "domain1", "item3", {"a": set(["b"])}, {})
+        for _ in range(100):
+            if "IOError: Disk full" in sys.stderr.getvalue():
+                break
+            time.sleep(0.01)
+        self.assertIn("Writing snapshot failed:\nTraceback", sys.stderr.getvalue())
+        self.assertIn("IOError: Disk full", sys.stderr.getvalue())
+
+    def test_put_attributes_syncs_once(self):
+        syncs = []
+        original = self.backend._wal.sync
+        self.patch(self.backend._wal, "sync", lambda seq: (syncs.append(seq), original(seq)))
+        self.backend.put_attributes("owner", "domain1", "item3",
+                                    {"a": set(["b", "c"])}, {"d": set(["e"])})
+        self.backend.batch_put_attributes("owner", "domain1",
+                                          {"item4": {"a": set(["b"])}, "item5": {"a": set(["c"])}}, {})
+        self.assertEquals(len(syncs), 2)
+
+    def test_each_call_logs_one_record(self):
+        records = []
+        original = self.backend._wal.append
+        self.patch(self.backend._wal, "append", lambda record: (records.append(record[0]),
+                                                                original(record))[1])
+        self.backend.put_attributes("owner", "domain1", "item3",
+                                    {"a": set(["b", "c"])}, {"d": set(["e"])})
+        self.backend.batch_put_attributes("owner", "domain1",
+                                          {"item4": {"a": set(["b", "c"])}},
+                                          {"item5": {"a": set(["c"])}})
+        self.backend.batch_delete_attributes("owner", "domain1",
+                                             {"item3": {"a": set([basicdb.AllAttributes])},
+                                              "item4": {"a": set(["b"])}})
+        self.assertEquals(records, ["_update_items"] * 3)
+
+        self.backend.close()
+        backend = self.open_backend()
+        self.assertEquals(backend.get_attributes("owner", "domain1", "item3"), {"d": set(["e"])})
+        self.assertEquals(backend.get_attributes("owner", "domain1", "item4"), {"a": set(["c"])})
+        self.assertEquals(backend.get_attributes("owner", "domain1", "item5"), {"a": set(["c"])})
+
+    def test_compact_storage_is_recovered(self):
+        self.backend.close()
+        backend = basicdb.backends.fake.driver(data_dir=self.data_dir, storage='compact')
+        self.addCleanup(backend.close)
+        backend.snapshot()
+        backend.close()
+        backend = basicdb.backends.fake.driver(data_dir=self.data_dir, storage='compact')
+        self.addCleanup(backend.close)
+        self.assertEquals(backend.get_attributes("owner", "domain1", "item1"), {"a": set(["b", "c"])})
+        self.assertEquals(backend.select_wrapper("owner", "select * from domain1 where a = 'd'")[0],
+                          ["item2"])
+
+    def test_compact_snapshots_keep_the_records(self):
+        self.backend.close()
+        backend = basicdb.backends.fake.driver(data_dir=self.data_dir, storage='compact')
+        self.addCleanup(backend.close)
+        attr_names, records = backend._export()["owner"]["domain1"]
+        self.assertEquals(attr_names, ["a"])
+        self.assertEquals(records["item1"][0], 0)
+        self.assertEquals(sorted(records["item1"][1]), ["b", "c"])
+        self.assertEquals(records["item2"], (0, "d"))
+        backend.snapshot()
+        backend.close()
+        backend = self.open_backend()
+        self.assertEquals(backend.get_attributes("owner", "domain1", "item1"), {"a": set(["b", "c"])})
+        self.assertEquals(backend.get_attributes("owner", "domain1", "item2"), {"a": set(["d"])})
+
+    def test_snapshot_is_of_the_state_when_started(self):
+        written = []
+        write_snapshot = self.backend._wal.write_snapshot
+        def change_then_write(snapshot):
+            self.backend.put_attributes("owner", "domain1", "item1", {}, {"a": set(["e"])})
+            written.append(snapshot[1]["owner"]["domain1"]["item1"])
+            write_snapshot(snapshot)
+        self.patch(self.backend._wal, "write_snapshot", change_then_write)
+        self.backend.snapshot()
+        self.assertEquals(written, [{"a": set(["b", "c"])}])
+        self.backend.delete_attributes("owner", "domain1", "item2", {"a": set(["d"])})
+        self.assertRecovered()
+
+    def test_failed_changes_are_not_logged(self):
+        self.assertRaises(KeyError, self.backend.add_attribute_value,
+                          "owner", "domain2", "item1", "a", "b")
+        self.backend.close()
+        self.open_backend()
+
+class FakeBackendIndexTest(unittest.TestCase):
+    def setUp(self):
+        super(FakeBackendIndexTest, self).setUp()
+        self.backend = basicdb.backends.fake.driver()
+        self.backend.create_domain("owner", "domain1")
+        self.backend.add_attribute_value("owner", "domain1", "item1", "a", "b")
+        self.backend.add_attribute_value("owner", "domain1", "item1", "a", "c")
+        self.backend.add_attribute_value("owner", "domain1", "item2", "a", "c")
+
+    def select(self, where):
+        parsed = basicdb.sqlparser.parse("SELECT * FROM domain1 WHERE %s" % (where,))
+        return set(self.backend.select("owner", parsed))
+
+    def test_index_follows_deletes(self):
+        self.backend.delete_attribute_value("owner", "domain1", "item1", "a", "c")
+        self.assertEquals(self.select("a = 'c'"), set(["item2"]))
+        self.backend.delete_attribute_all("owner", "domain1", "item2", "a")
+        self.assertEquals(self.select("a = 'c'"), set())
+        self.assertEquals(self.select("a in ('b', 'c')"), set(["item1"]))
+
+    def test_index_is_dropped_with_domain(self):
+        self.backend.delete_domain("owner", "domain1")
+        self.backend.create_domain("owner", "domain1")
+        self.assertEquals(self.select("a = 'c'"), set())
+
+    def test_only_candidates_are_evaluated(self):
+        for i in range(100):
+            self.backend.add_attribute_value("owner", "domain1", "other%d" % (i,), "a", "x")
+        parsed = basicdb.sqlparser.parse("SELECT * FROM domain1 WHERE a = 'c'")
+        evaluated = []
+        def predicate(item_name, item_attrs):
+            evaluated.append(item_name)
+            return parsed.predicate(item_name, item_attrs)
+        result = self.backend.select("owner", parsed._replace(predicate=predicate))
+        self.assertEquals(set(result), set(["item1", "item2"]))
+        self.assertEquals(set(evaluated), set(["item1", "item2"]))
+
+    def test_range_and_prefix_queries(self):
+        self.backend.add_attribute_value("owner", "domain1", "item3", "a", "ca")
+        self.assertEquals(self.select("a > 'b'"), set(["item1", "item2", "item3"]))
+        self.assertEquals(self.select("a >= 'c'"), set(["item1", "item2", "item3"]))
+        self.assertEquals(self.select("a < 'c'"), set(["item1"]))
+        self.assertEquals(self.select("a between 'b' and 'cb'"), set(["item1", "item2", "item3"]))
+        self.assertEquals(self.select("a between 'c' and 'cb'"), set(["item3"]))
+        self.assertEquals(self.select("a like 'c%'"), set(["item1", "item2", "item3"]))
+        self.assertEquals(self.select("a like 'ca'"), set(["item3"]))
+        self.assertEquals(self.select("itemName() > 'item1'"), set(["item2", "item3"]))
+
+    def test_order_by_with_limit_stops_early(self):
+        for i in range(100):
+            self.backend.add_attribute_value("owner", "domain1", "other%02d" % (i,), "a", "x%02d" % (i,))
+        parsed = basicdb.sqlparser.parse("SELECT * FROM domain1 WHERE a > 'a' ORDER BY a DESC LIMIT 3")
+        evaluated = []
+        def predicate(item_name, item_attrs):
+            evaluated.append(item_name)
+            return parsed.predicate(item_name, item_attrs)
+        self.backend.select("owner", parsed._replace(predicate=predicate))
+        self.assertEquals(evaluated, ["other99", "other98", "other97"])
+
+        order, _ = self.backend.select_wrapper("owner", "SELECT * FROM domain1 WHERE a > 'a' ORDER BY a DESC LIMIT 3")
+        self.assertEquals(order, ["other99", "other98", "other97"])
+
+    def test_order_by_a_column_not_selected_with_limit(self):
+        for index in ('none', 'inverted', 'ordered'):
+            backend = basicdb.backends.fake.driver(index=index)
+            backend.create_domain("owner", "domain1")
+            for i in range(1, 9):
+                backend.add_attribute_value("owner", "domain1", "item%d" % (i,), "b", "%02d" % (i,))
+                if i % 2 == 0:
+                    backend.add_attribute_value("owner", "domain1", "item%d" % (i,), "a", "x")
+            order, _ = backend.select_wrapper(
+                "owner", "select a from domain1 where b > '00' order by b limit 3")
+            self.assertEquals(order, ["item2", "item4", "item6"], index)
+
+    def test_domain_metadata_reports_index_size(self):
+        metadata = self.backend.domain_metadata("owner", "domain1")
+        self.assertEquals(metadata["IndexEntryCount"], 4)
+        self.assertGreater(metadata["IndexSizeBytes"], 0)
+
+    def test_unindexed_domain_metadata(self):
+        backend = basicdb.backends.fake.driver(index='none')
+        backend.create_domain("owner", "domain1")
+        self.assertNotIn("IndexEntryCount", backend.domain_metadata("owner", "domain1"))
+
+class FakeBackendConcurrencyTest(unittest.TestCase):
+    """Changes and Selects from several threads at once, checking that
+    readers only ever see whole changes and writers don't lose any"""
+    writers = 4
+    items_per_writer = 10
+    rounds = 30
+
+    def setUp(self):
+        super(FakeBackendConcurrencyTest, self).setUp()
+        import basicdb.backends.fake
+        # Switch threads as often as possible
+        self.addCleanup(sys.setcheckinterval, sys.getcheckinterval())
+        sys.setcheckinterval(10)
+
+    def write(self, backend, writer):
+        item_names = ["item%d-%d" % (writer, i) for i in range(self.items_per_writer)]
+        for n in range(self.rounds):
+            value = "%03d" % (n,)
+            backend.batch_put_attributes("owner", "domain1", {},
+                                         dict((item_name, {"a": set([value]), "b": set([value]),
+                                                           "tmp": set(["x", value])})
+                                              for item_name in item_names))
+            backend.batch_delete_attributes("owner", "domain1",
+                                            dict((item_name, {"tmp": set([basicdb.AllAttributes])})
+                                                 for item_name in item_names[::2]))
+
+    def read(self, backend, done, errors):
+        queries = ["select * from domain1 where a >= '000' order by a desc limit 5",
+                   "select * from domain1 where b > '010'",
+                   "select * from domain1 where b like '01%'",
+                   "select count(*) from domain1 where tmp = 'x'"]
+        while not done.is_set():
+            for query in queries:
+                try:
+                    item_names, items = backend.select_wrapper("owner", query)
+                    for item_name in item_names:
+                        item_attrs = items[item_name]
+                        if "a" in item_attrs and item_attrs["a"] != item_attrs["b"]:
+                            errors.append("%s: %r" % (item_name, item_attrs))
+                except Exception, e:
+                    errors.append(repr(e))
+
+    def run_threads(self, backend):
+        backend.create_domain("owner", "domain1")
+        done = threading.Event()
+        errors = []
+        readers = [threading.Thread(target=self.read, args=(backend, done, errors))
+                   for i in range(2)]
+        writers = [threading.Thread(target=self.write, args=(backend, i))
+                   for i in range(self.writers)]
+        for thread in readers + writers:
+            thread.start()
+        for thread in writers:
+            thread.join()
+        done.set()
+        for thread in readers:
+            thread.join()
+        self.assertEquals(errors, [])
+
+        last = "%03d" % (self.rounds - 1,)
+        for writer in range(self.writers):
+            for i in range(self.items_per_writer):
+                expected = {"a": set([last]), "b": set([last])}
+                if i % 2:
+                    expected["tmp"] = set(["x", last])
+                self.assertEquals(backend.get_attributes("owner", "domain1",
+                                                         "item%d-%d" % (writer, i)),
+                                  expected)
+        self.assertEquals(backend.select_wrapper("owner", "select count(*) from domain1 "
+                                                          "where tmp = 'x'")[1],
+                          {"domain1": {"count": set([str(self.writers * self.items_per_writer // 2)])}})
+
+    def test_dicts(self):
+        for index in ('none', 'inverted', 'ordered'):
+            self.run_threads(basicdb.backends.fake.driver(index=index, storage='dicts'))
+
+    def test_compact(self):
+        for index in ('none', 'inverted', 'ordered'):
+            self.run_threads(basicdb.backends.fake.driver(index=index, storage='compact'))
+
+class CachingBackendDriverTest(_GenericBackendDriverTest, unittest.TestCase):
+    def setUp(self):
+        super(CachingBackendDriverTest, self).setUp()
+        import basicdb.backends.caching
+        import basicdb.backends.fake
+        self.backend = basicdb.backends.caching.CachingBackend(basicdb.backends.fake.driver(),
+                                                               1024 * 1024)
+
+    def tearDown(self):
+        super(CachingBackendDriverTest, self).tearDown()
+        self.backend._reset()
+
+    def test_expectations_on_a_missing_item(self):
+        self.backend.create_domain("owner", "domain1")
+        for expectations in ([("a", False)], [("a", "b")]):
+            self.assertRaises(exc.ConditionalCheckFailed,
+                              self.backend.put_attributes, "owner", "domain1", "item1",
+                              {"a": set(["b"])}, {}, expectations)
+
+class CachingBackendTest(unittest.TestCase):
+    def setUp(self):
+        super(CachingBackendTest, self).setUp()
+        import basicdb.backends.caching
+        import basicdb.backends.fake
+        self.module = basicdb.backends.caching
+        self.wrapped = basicdb.backends.fake.driver()
+        self.addCleanup(self.wrapped._reset)
+        self.calls = []
+        original = self.wrapped.get_attributes
+        def get_attributes(*args):
+            self.calls.append(args)
+            return original(*args)
+        self.patch(self.wrapped, 'get_attributes', get_attributes)
+        self.backend = self.module.CachingBackend(self.wrapped, 1024 * 1024)
+        self.backend.create_domain("owner", "domain1")
+        self.backend.put_attributes("owner", "domain1", "item1", {"a": set(["b"])}, {})
+
+    def test_repeated_reads_are_cached(self):
+        for i in range(3):
+            self.assertEquals(self.backend.get_attributes("owner", "domain1", "item1"),
+                              {"a": set(["b"])})
+        self.assertEquals(len(self.calls), 1)
+        stats = self.backend.stats()
+        self.assertEquals((stats["hits"], stats["misses"], stats["entries"]), (2, 1, 1))
+
+    def test_cached_attributes_are_copies(self):
+        self.backend.get_attributes("owner", "domain1", "item1")["a"].add("c")
+        self.assertEquals(self.backend.get_attributes("owner", "domain1", "item1"),
+                          {"a": set(["b"])})
+
+    def test_writes_invalidate(self):
+        self.backend.get_attributes("owner", "domain1", "item1")
+        self.backend.put_attributes("owner", "domain1", "item1", {"a": set(["c"])}, {})
+        self.assertEquals(self.backend.get_attributes("owner", "domain1", "item1"),
+                          {"a": set(["b", "c"])})
+        self.backend.delete_attribute_value("owner", "domain1", "item1", "a", "b")
+        self.assertEquals(self.backend.get_attributes("owner", "domain1", "item1"),
+                          {"a": set(["c"])})
+        self.assertEquals(self.backend.stats()["invalidations"], 2)
+
+    def test_delete_domain_invalidates_its_items(self):
+        self.backend.put_attributes("owner", "domain1", "item2", {"a": set(["c"])}, {})
+        self.backend.get_attributes("owner", "domain1", "item1")
+        self.backend.get_attributes("owner", "domain1", "item2")
+        self.backend.delete_domain("owner", "domain1")
+        self.assertEquals(self.backend.stats()["entries"], 0)
+        self.backend.create_domain("owner", "domain1")
+        self.wrapped.put_attributes("owner", "domain1", "item1", {"a": set(["d"])}, {})
+        self.assertEquals(self.backend.get_attributes("owner", "domain1", "item1"),
+                          {"a": set(["d"])})
+
+    def test_least_recently_used_items_are_evicted(self):
+        for i in range(2, 5):
+            self.backend.put_attributes("owner", "domain1", "item%d" % (i,), {"a": set(["b"])}, {})
+        size = self.module._estimate_size(("owner", "domain1", "item1"), {"a": set(["b"])})
+        self.backend.max_size = size * 2
+        self.backend.get_attributes("owner", "domain1", "item1")
+        self.backend.get_attributes("owner", "domain1", "item2")
+        self.backend.get_attributes("owner", "domain1", "item1")
+        self.backend.get_attributes("owner", "domain1", "item3")
+        stats = self.backend.stats()
+        self.assertEquals((stats["evictions"], stats["entries"]), (1, 2))
+        self.assertLessEqual(stats["size_bytes"], size * 2)
+        del self.calls[:]
+        self.backend.get_attributes("owner", "domain1", "item1")
+        self.assertEquals(self.calls, [])
+        self.backend.get_attributes("owner", "domain1", "item2")
+        self.assertEquals(len(self.calls), 1)
+
+    def test_get_items_fetches_only_missing_items(self):
+        self.backend.put_attributes("owner", "domain1", "item2", {"a": set(["c"])}, {})
+        self.backend.get_attributes("owner", "domain1", "item1")
+        fetched = []
+        original = self.wrapped.get_items
+        def get_items(owner, domain_name, item_names):
+            fetched.append(list(item_names))
+            return original(owner, domain_name, item_names)
+        self.patch(self.wrapped, 'get_items', get_items)
+        self.assertEquals(list(self.backend.get_items("owner", "domain1",
+                                                      ["item1", "item2", "item3"])),
+                          [("item1", {"a": set(["b"])}), ("item2", {"a": set(["c"])})])
+        self.assertEquals(fetched, [["item2", "item3"]])
+        self.assertEquals(len(list(self.backend.get_items("owner", "domain1",
+                                                          ["item1", "item2", "item3"]))), 2)
+        self.assertEquals(len(fetched), 1)
+
+    def test_missing_items_are_not_answered_by_get_attributes(self):
+        self.assertEquals(list(self.backend.get_items("owner", "domain1", ["item3"])), [])
+        self.assertRaises(KeyError, self.backend.get_attributes, "owner", "domain1", "item3")
+        self.assertEquals(list(self.backend.get_items("owner", "domain1", ["item3"])), [])
+        stats = self.backend.stats()
+        self.assertEquals((stats["hits"], stats["misses"]), (1, 2))
+
+    def test_selects_by_item_name_are_cached(self):
+        for expr in ["select * from domain1 where itemName() = 'item1'",
+                     "select a from domain1 where itemName() in ('item1', 'item2') order by itemName()",
+                     "select count(*) from domain1 where itemName() = 'item1'"]:
+            self.backend.select_wrapper("owner", expr)
+        self.assertEquals(self.backend.select_wrapper(
+            "owner", "select * from domain1 where itemName() = 'item1'"),
+            (["item1"], {"item1": {"a": set(["b"])}}))
+        stats = self.backend.stats()
+        self.assertEquals((stats["hits"], stats["misses"]), (3, 2))
+
+    def test_expectations_fetch_the_item_once(self):
+        fetched = []
+        original = self.wrapped.get_items
+        def get_items(owner, domain_name, item_names):
+            item_names = list(item_names)
+            fetched.extend(item_names)
+            return original(owner, domain_name, item_names)
+        self.patch(self.wrapped, 'get_items', get_items)
+        self.backend._reset_cache()
+        self.backend.put_attributes("owner", "domain1", "item1", {"c": set(["d"])}, {},
+                                    [("a", "b"), ("c", False)])
+        self.assertEquals(fetched, ["item1"])
+        self.assertRaises(exc.ConditionalCheckFailed,
+                          self.backend.put_attributes, "owner", "domain1", "item1",
+                          {}, {}, [("c", False)])
+
 class FilesystemBackendDriverTest(_GenericBackendDriverTest, unittest.TestCase):
     def setUp(self):
         super(FilesystemBackendDriverTest, self).setUp()
         import basicdb.backends.filesystem
-        self.backend = basicdb.backends.filesystem.driver()
+        self.backend = basicdb.backends.filesystem.driver(layout='directories')
 
     def tearDown(self):
         super(FilesystemBackendDriverTest, self).tearDown()
         self.backend._reset()
 
+class FilesystemBackendCountTest(unittest.TestCase):
+    def setUp(self):
+        super(FilesystemBackendCountTest, self).setUp()
+        import basicdb.backends.filesystem
+        self.backend = basicdb.backends.filesystem.driver(layout='directories')
+        self.addCleanup(self.backend._reset)
+        self.backend.create_domain("owner", "domain1")
+        for i in range(10):
+            self.backend.put_attributes("owner", "domain1", "item%d" % (i,),
+                                        {"a": set([str(i)]), "b": set(["x", "y"])}, {})
+
+    def test_count_reads_only_referenced_attributes(self):
+        read = []
+        original = self.backend._read_attr_values
+        def _read_attr_values(attr_dir):
+            read.append(attr_dir.split('/')[-1])
+            return original(attr_dir)
+        self.backend._read_attr_values = _read_attr_values
+
+        parsed = basicdb.sqlparser.parse("select count(*) from domain1 where a > '4'")
+        self.assertEquals(self.backend.count("owner", parsed), 5)
+        self.assertEquals(set(read), set(["a"]))
+
+        del read[:]
+        parsed = basicdb.sqlparser.parse("select count(*) from domain1")
+        self.assertEquals(self.backend.count("owner", parsed), 10)
+        self.assertEquals(read, [])
+
+class FilesystemBackendUpdateTest(unittest.TestCase):
+    def setUp(self):
+        super(FilesystemBackendUpdateTest, self).setUp()
+        import basicdb.backends.filesystem
+        base_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, base_dir)
+        self.backend = basicdb.backends.filesystem.driver(base_dir=base_dir,
+                                                          layout='directories', fanout=0)
+        self.backend.create_domain("owner", "domain1")
+        self.backend.put_attributes("owner", "domain1", "item1",
+                                    {"a": set(["b", "c"]), "d": set(["e"])}, {})
+
+    def test_only_changed_values_are_written(self):
+        written = []
+        self.patch(basicdb.backends.filesystem, 'file',
+                   lambda path, mode: (written.append(path), open(path, mode))[1])
+        self.backend.put_attributes("owner", "domain1", "item1",
+                                    {"a": set(["b", "f"])}, {"d": set(["e", "g"])})
+        self.assertEquals(len(written), 2)
+        self.assertEquals(self.backend.get_attributes("owner", "domain1", "item1"),
+                          {"a": set(["b", "c", "f"]), "d": set(["e", "g"])})
+
+    def test_emptied_attributes_are_removed(self):
+        self.backend.put_attributes("owner", "domain1", "item1", {}, {"d": set()})
+        self.backend.delete_attributes("owner", "domain1", "item1", {"a": set(["b", "c"])})
+        self.assertEquals(os.listdir(self.backend._item_dir("owner", "domain1", "item1")), [])
+
+class PackedFilesystemBackendDriverTest(_GenericBackendDriverTest, unittest.TestCase):
+    def setUp(self):
+        super(PackedFilesystemBackendDriverTest, self).setUp()
+        import basicdb.backends.filesystem
+        base_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, base_dir)
+        self.backend = basicdb.backends.filesystem.driver(base_dir=base_dir, layout='packed')
+
+class PackedFilesystemBackendTest(unittest.TestCase):
+    def setUp(self):
+        super(PackedFilesystemBackendTest, self).setUp()
+        import basicdb.backends.filesystem
+        self.module = basicdb.backends.filesystem
+        self.base_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.base_dir)
+        self.backend = self.module.driver(base_dir=self.base_dir, layout='packed', fanout=0)
+        self.backend.create_domain("owner", "domain1")
+
+    def domain_dir(self):
+        return os.path.join(self.base_dir, "owner", "domain1")
+
+    def test_item_is_a_single_file(self):
+        self.backend.put_attributes("owner", "domain1", "item1",
+                                    {"a": set(["b", "c"]), "d": set(["e"])}, {})
+        self.assertEquals(os.listdir(self.domain_dir()), ["item1"])
+        self.assertTrue(os.path.isfile(os.path.join(self.domain_dir(), "item1")))
+
+    def test_put_attributes_reads_and_writes_once(self):
+        self.backend.put_attributes("owner", "domain1", "item1", {"a": set(["b"])}, {})
+        calls = []
+        def record(name):
+            original = getattr(self.backend, name)
+            def wrapper(*args):
+                calls.append(name)
+                return original(*args)
+            setattr(self.backend, name, wrapper)
+        record("_read_item")
+        record("_write_item")
+
+        self.backend.put_attributes("owner", "domain1", "item1",
+                                    {"a": set(["c"]), "d": set(["e"])}, {"f": set(["g", "h"])})
+        self.assertEquals(calls, ["_read_item", "_write_item"])
+        self.assertEquals(self.backend.get_attributes("owner", "domain1", "item1"),
+                          {"a": set(["b", "c"]), "d": set(["e"]), "f": set(["g", "h"])})
+
+    def test_deleting_all_attributes_removes_the_file(self):
+        self.backend.put_attributes("owner", "domain1", "item1", {"a": set(["b"])}, {})
+        self.backend.delete_attributes("owner", "domain1", "item1", {"a": set(["b"])})
+        self.assertEquals(os.listdir(self.domain_dir()), [])
+
+    def test_migrate(self):
+        old = self.module.driver(base_dir=self.base_dir, layout='directories', fanout=0)
+        old.put_attributes("owner", "domain1", "item1", {"a": set(["b", "c"])}, {})
+        old.put_attributes("owner", "domain1", "item2", {"a": set(["d"]), "e": set(["f"])}, {})
+        # An interrupted earlier run
+        old.put_attributes("owner", "domain1", "item3", {"a": set(["g"])}, {})
+        os.rename(os.path.join(self.domain_dir(), "item3"),
+                  os.path.join(self.domain_dir(), ".item3.old"))
+
+        self.assertEquals(self.module.migrate(self.base_dir, fanout=0), 3)
+        self.assertEquals(sorted(os.listdir(self.domain_dir())), ["item1", "item2", "item3"])
+        self.assertEquals(self.backend.get_attributes("owner", "domain1", "item1"),
+                          {"a": set(["b", "c"])})
+        self.assertEquals(self.backend.get_attributes("owner", "domain1", "item2"),
+                          {"a": set(["d"]), "e": set(["f"])})
+        self.assertEquals(self.backend.get_attributes("owner", "domain1", "item3"),
+                          {"a": set(["g"])})
+        self.assertEquals(self.module.migrate(self.base_dir, fanout=0), 0)
+
+class FanoutFilesystemBackendDriverTest(_GenericBackendDriverTest, unittest.TestCase):
+    def setUp(self):
+        super(FanoutFilesystemBackendDriverTest, self).setUp()
+        import basicdb.backends.filesystem
+        base_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, base_dir)
+        self.backend = basicdb.backends.filesystem.driver(base_dir=base_dir, layout='packed',
+                                                          fanout=2)
+
+class FanoutFilesystemBackendTest(unittest.TestCase):
+    def setUp(self):
+        super(FanoutFilesystemBackendTest, self).setUp()
+        import basicdb.backends.filesystem
+        self.module = basicdb.backends.filesystem
+        self.base_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.base_dir)
+
+    def test_items_are_spread_over_hashed_directories(self):
+        backend = self.module.driver(base_dir=self.base_dir, layout='packed', fanout=2)
+        backend.create_domain("owner", "domain1")
+        backend.put_attributes("owner", "domain1", "item1", {"a": set(["b"])}, {})
+        digest = hashlib.md5("item1").hexdigest()
+        self.assertTrue(os.path.isfile(os.path.join(self.base_dir, "owner", "domain1",
+                                                    digest[0:2], digest[2:4], "item1")))
+
+    def test_listing_walks_every_level(self):
+        for layout in ("directories", "packed"):
+            backend = self.module.driver(base_dir=os.path.join(self.base_dir, layout),
+                                         layout=layout, fanout=2)
+            backend.create_domain("owner", "domain1")
+            for i in range(20):
+                backend.put_attributes("owner", "domain1", "item%d" % (i,), {"a": set([str(i)])}, {})
+            self.assertEquals(sorted(backend._iter_items_names("owner", "domain1")),
+                              sorted("item%d" % (i,) for i in range(20)))
+            self.assertEquals(backend.list_domains("owner"), ["domain1"])
+            parsed = basicdb.sqlparser.parse("select count(*) from domain1")
+            self.assertEquals(backend.count("owner", parsed), 20)
+
+    def test_migrate(self):
+        old = self.module.driver(base_dir=self.base_dir, layout='directories', fanout=2)
+        old.create_domain("owner", "domain1")
+        old.put_attributes("owner", "domain1", "item1", {"a": set(["b", "c"])}, {})
+        self.assertEquals(self.module.migrate(self.base_dir, fanout=2), 1)
+        new = self.module.driver(base_dir=self.base_dir, layout='packed', fanout=2)
+        self.assertEquals(new.get_attributes("owner", "domain1", "item1"), {"a": set(["b", "c"])})
+
+class LogStructuredBackendDriverTest(_GenericBackendDriverTest, unittest.TestCase):
+    def setUp(self):
+        super(LogStructuredBackendDriverTest, self).setUp()
+        import basicdb.backends.logstructured
+        self.backend = basicdb.backends.logstructured.driver()
+
+    def tearDown(self):
+        super(LogStructuredBackendDriverTest, self).tearDown()
+        self.backend._reset()
+        self.backend.close()
+
+class LogStructuredBackendTest(unittest.TestCase):
+    def setUp(self):
+        super(LogStructuredBackendTest, self).setUp()
+        import basicdb.backends.logstructured
+        self.module = basicdb.backends.logstructured
+        self.base_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.base_dir)
+        self.backend = self.open_backend()
+        self.backend.create_domain("owner", "domain1")
+
+    def open_backend(self):
+        backend = self.module.driver(base_dir=self.base_dir)
+        self.addCleanup(backend.close)
+        return backend
+
+    def log_path(self):
+        return os.path.join(self.base_dir, "owner", "domain1.log")
+
+    def test_data_survives_reopening(self):
+        self.backend.put_attributes("owner", "domain1", "item1", {"a": set(["b", "c"])}, {})
+        self.backend.put_attributes("owner", "domain1", "item2", {"a": set(["d"])}, {})
+        self.backend.delete_attribute_all("owner", "domain1", "item2", "a")
+        self.backend.put_attributes("owner", "domain1", "item1", {}, {"a": set(["e"])})
+        self.backend.close()
+
+        backend = self.open_backend()
+        self.assertEquals(backend.list_domains("owner"), ["domain1"])
+        self.assertEquals(backend.get_attributes("owner", "domain1", "item1"), {"a": set(["e"])})
+        self.assertEquals(backend.get_attributes("owner", "domain1", "item2"), {})
+        self.assertEquals(backend.select_wrapper("owner", "select * from domain1")[0], ["item1"])
+
+    def test_torn_record_is_discarded(self):
+        self.backend.put_attributes("owner", "domain1", "item1", {"a": set(["b"])}, {})
+        self.backend.put_attributes("owner", "domain1", "item2", {"a": set(["c"])}, {})
+        self.backend.close()
+        size = os.path.getsize(self.log_path())
+        with open(self.log_path(), "r+b") as fp:
+            fp.truncate(size - 3)
+
+        backend = self.open_backend()
+        self.assertEquals(backend.select_wrapper("owner", "select * from domain1")[0], ["item1"])
+        backend.put_attributes("owner", "domain1", "item3", {"a": set(["d"])}, {})
+        self.assertEquals(backend.get_attributes("owner", "domain1", "item3"), {"a": set(["d"])})
+
+    def test_compaction_keeps_only_live_records(self):
+        for i in range(50):
+            self.backend.put_attributes("owner", "domain1", "item%d" % (i % 5,), {}, {"a": set([str(i)])})
+        size = os.path.getsize(self.log_path())
+        self.backend.compact("owner", "domain1")
+        self.assertLess(os.path.getsize(self.log_path()) * 5, size)
+        for i in range(5):
+            self.assertEquals(self.backend.get_attributes("owner", "domain1", "item%d" % (i,)),
+                              {"a": set([str(45 + i)])})
+        self.backend.put_attributes("owner", "domain1", "item5", {"a": set(["x"])}, {})
+        self.assertEquals(self.backend.count("owner", basicdb.sqlparser.parse("select count(*) from domain1")), 6)
+
+    def test_compaction_runs_in_the_background(self):
+        self.patch(self.module, "COMPACTION_MIN_GARBAGE", 1000)
+        for i in range(200):
+            self.backend.put_attributes("owner", "domain1", "item1", {}, {"a": set([str(i)])})
+        # Less than COMPACTION_MIN_GARBAGE of garbage may be left next to the
+        # live record after the last compaction. Uncompacted, the log would
+        # be several times larger.
+        live_size = self.backend._domain("owner", "domain1").index["item1"][1]
+        bound = self.module.COMPACTION_MIN_GARBAGE + live_size
+        self.assertGreater(200 * live_size, 2 * bound)
+        for _ in range(100):
+            if os.path.getsize(self.log_path()) < bound:
+                break
+            time.sleep(0.01)
+        self.assertLess(os.path.getsize(self.log_path()), bound)
+        self.assertEquals(self.backend.get_attributes("owner", "domain1", "item1"), {"a": set(["199"])})
+
+    def test_compaction_failures_are_reported(self):
+        self.patch(self.module, "COMPACTION_MIN_GARBAGE", 1000)
+        self.patch(sys, "stderr", StringIO.StringIO())
+        def compact(domain):
+            raise IOError("Disk full")
+        self.patch(self.module._LogDomain, "compact", compact)
+        for i in range(200):
+            self.backend.put_attributes("owner", "domain1", "item1", {}, {"a": set([str(i)])})
+        for _ in range(100):
+            if "IOError: Disk full" in sys.stderr.getvalue():
+                break
+            time.sleep(0.01)
+        self.assertIn("Compacting %s failed:\nTraceback" % (self.log_path(),),
+                      sys.stderr.getvalue())
+        self.assertIn("IOError: Disk full", sys.stderr.getvalue())
+
 class RiakBackendDriverTest(_GenericBackendDriverTest, unittest.TestCase):
     def setUp(self):
         import os
@@ -595,3 +1563,103 @@ class RiakBackendDriverTest(_GenericBackendDriverTest, unittest.TestCase):
     def tearDown(self):
         super(RiakBackendDriverTest, self).tearDown()
         self.backend._reset()
+
+class SQLiteBackendDriverTest(_GenericBackendDriverTest, unittest.TestCase):
+    def setUp(self):
+        super(SQLiteBackendDriverTest, self).setUp()
+        import basicdb.backends.sqlite
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        self.backend = basicdb.backends.sqlite.driver(path=os.path.join(tmp_dir, "basicdb.sqlite"))
+
+class SQLiteBackendTest(unittest.TestCase):
+    items = {"item1": {"a": set(["1", "5"]), "b": set(["x"])},
+             "item2": {"a": set(["3"]), "b": set(["xy", "z"]), "c": set(["q"])},
+             "item3": {"a": set(["7"])},
+             "item4": {"b": set(["y"]), "c": set(["q", "r"])},
+             "item5": {"a": set(["2", "4", "9"]), "c": set(["s"])}}
+
+    expressions = ["a = '3'",
+                   "a != '3'",
+                   "not (a = '3')",
+                   "not (a > '1' and a < '5')",
+                   "a > '1' and a < '5'",
+                   "a > '4' and b like 'x%'",
+                   "a > '4' or b like 'x%'",
+                   "(a < '2' or b = 'y') and a > '0'",
+                   "a in ('1', '7') intersection b is not null",
+                   "a between '2' and '6'",
+                   "a is not null",
+                   "a is null",
+                   "every(a) > '1'",
+                   "every(a) != '3'",
+                   "not (every(a) < '5')",
+                   "every(c) = 'q'",
+                   "itemName() like 'item%' and a = '7'",
+                   "itemName() in ('item1', 'item4') or c = 's'",
+                   "'4' < a and '8' > a",
+                   "a = itemName()",
+                   "a = itemName() and c = 'q'"]
+
+    def setUp(self):
+        super(SQLiteBackendTest, self).setUp()
+        import basicdb.backends.sqlite
+        self.module = basicdb.backends.sqlite
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        self.path = os.path.join(tmp_dir, "basicdb.sqlite")
+        self.backend = self.module.driver(path=self.path)
+        self.backend.create_domain("owner", "domain1")
+        self.backend.batch_put_attributes("owner", "domain1", self.items, {})
+
+    def test_where_expressions_match_the_predicate(self):
+        for expr in self.expressions:
+            parsed = basicdb.sqlparser.parse("select * from domain1 where " + expr)
+            expected = sorted(item_name for item_name, item_attrs in self.items.iteritems()
+                              if parsed.predicate(item_name, item_attrs))
+            self.assertEquals(sorted(self.backend.select("owner", parsed)), expected, expr)
+            self.assertEquals(self.backend.count("owner", parsed), len(expected), expr)
+
+    def test_untranslatable_conditions_narrow_down_the_search(self):
+        params = {}
+        where, exact = self.module.translate_where(
+            basicdb.sqlparser.parse("select * from domain1 where a = itemName() and c = 'q'").where_expr,
+            params)
+        self.assertFalse(exact)
+        self.assertIn("attrs", where)
+
+    def test_order_by_and_limit(self):
+        select = lambda expr: self.backend.select_wrapper("owner", expr)[0]
+        self.assertEquals(select("select * from domain1 where a > '0' order by a"),
+                          ["item1", "item5", "item2", "item3"])
+        self.assertEquals(select("select * from domain1 where a > '0' order by a desc limit 2"),
+                          ["item5", "item3"])
+        self.assertEquals(select("select c from domain1 where a > '0' order by a limit 3"),
+                          ["item5", "item2"])
+        self.assertEquals(select("select * from domain1 where itemName() > 'item2' order by itemName() desc"),
+                          ["item5", "item4", "item3"])
+
+    def test_data_survives_reopening(self):
+        backend = self.module.driver(path=self.path)
+        self.assertEquals(backend.get_attributes("owner", "domain1", "item2"), self.items["item2"])
+        self.assertEquals(backend.list_domains("owner"), ["domain1"])
+
+    def test_enabling_wal_is_retried_while_locked(self):
+        import sqlite3
+        self.patch(time, "sleep", lambda seconds: None)
+        class Connection(object):
+            failures = [sqlite3.OperationalError("database is locked")] * 2
+            def execute(self, sql):
+                if self.failures:
+                    raise self.failures.pop()
+        conn = Connection()
+        self.module._enable_wal(conn)
+        self.assertEquals(conn.failures, [])
+        conn.failures = [sqlite3.OperationalError("disk I/O error")]
+        self.assertRaises(sqlite3.OperationalError, self.module._enable_wal, conn)
+        conn.failures = [sqlite3.OperationalError("database is locked")] * 3
+        self.assertRaises(sqlite3.OperationalError, self.module._enable_wal, conn, attempts=2)
+
+    def test_empty_items_are_removed(self):
+        self.backend.delete_attributes("owner", "domain1", "item3", {"a": set(["7"])})
+        self.assertEquals(self.backend.domain_metadata("owner", "domain1")["ItemCount"], 4)
@@ -0,0 +1,112 @@
+import testtools as unittest
+
+from basicdb import index
+
+class InvertedIndexTest(unittest.TestCase):
+    def setUp(self):
+        super(InvertedIndexTest, self).setUp()
+        self.index = index.InvertedIndex()
+
+    def test_equal_finds_added_items(self):
+        self.index.add('item1', 'a', 'b')
+        self.index.add('item2', 'a', 'b')
+        self.index.add('item2', 'a', 'c')
+        self.assertEquals(self.index.equal('a', 'b'), set(['item1', 'item2']))
+        self.assertEquals(self.index.equal('a', 'c'), set(['item2']))
+        self.assertEquals(self.index.equal('a', 'd'), set())
+        self.assertEquals(len(self.index), 2)
+
+    def test_remove_drops_empty_entries(self):
+        self.index.add('item1', 'a', 'b')
+        self.index.add('item2', 'a', 'b')
+        self.index.remove('item1', 'a', 'b')
+        self.assertEquals(self.index.equal('a', 'b'), set(['item2']))
+        self.index.remove('item2', 'a', 'b')
+        self.assertEquals(self.index.equal('a', 'b'), set())
+        self.assertEquals(len(self.index), 0)
+
+    def test_remove_unknown_entry_is_ignored(self):
+        self.index.remove('item1', 'a', 'b')
+        self.index.add('item1', 'a', 'b')
+        self.index.remove('item2', 'a', 'b')
+        self.assertEquals(self.index.equal('a', 'b'), set(['item1']))
+
+    def test_size_grows_with_entries(self):
+        empty_size = self.index.size_bytes()
+        for i in range(100):
+            self.index.add('item%d' % (i,), 'a', 'val%d' % (i,))
+        self.assertGreater(self.index.size_bytes(), empty_size)
+
+
+class OrderedIndexTest(unittest.TestCase):
+    def setUp(self):
+        super(OrderedIndexTest, self).setUp()
+        self.index = index.OrderedIndex()
+        for item_name, value in [('item1', 'b'), ('item2', 'ba'), ('item3', 'c'),
+                                 ('item4', 'd'), ('item1', 'e')]:
+            self.index.add(item_name, 'a', value)
+
+    def test_range(self):
+        self.assertEquals(self.index.range('a', 'b', 'c'), set(['item1', 'item2', 'item3']))
+        self.assertEquals(self.index.range('a', 'b', 'c', lower_inclusive=False,
+                                           upper_inclusive=False), set(['item2']))
+        self.assertEquals(self.index.range('a', lower='c'), set(['item1', 'item3', 'item4']))
+        self.assertEquals(self.index.range('a', upper='b'), set(['item1']))
+        self.assertEquals(self.index.range('x', upper='b'), set())
+
+    def test_prefix(self):
+        self.assertEquals(self.index.prefix('a', 'b'), set(['item1', 'item2']))
+        self.assertEquals(self.index.prefix('a', 'ba'), set(['item2']))
+        self.assertEquals(self.index.prefix('a', 'x'), set())
+
+    def test_ordered(self):
+        self.assertEquals(list(self.index.ordered('a')),
+                          ['item1', 'item2', 'item3', 'item4', 'item1'])
+        self.assertEquals(list(self.index.ordered('a', reverse=True)),
+                          ['item1', 'item4', 'item3', 'item2', 'item1'])
+
+    def test_remove(self):
+        self.index.remove('item1', 'a', 'b')
+        self.index.remove('item1', 'a', 'b')
+        self.assertEquals(list(self.index.ordered('a')),
+                          ['item2', 'item3', 'item4', 'item1'])
+        self.assertEquals(self.index.equal('a', 'b'), set())
+
+    def test_duplicate_add_is_ignored(self):
+        self.index.add('item2', 'a', 'ba')
+        self.assertEquals(list(self.index.ordered('a')),
+                          ['item1', 'item2', 'item3', 'item4', 'item1'])
+
+    def test_item_names(self):
+        self.index.add_item('item2')
+        self.index.add_item('item1')
+        self.assertEquals(list(self.index.ordered(index.ITEM_NAME)), ['item1', 'item2'])
+        self.assertEquals(self.index.equal(index.ITEM_NAME, 'item1'), set(['item1']))
+
+    def test_bulk_changes(self):
+        for i in range(200):
+            self.index.add('other%03d' % (i,), 'a', 'x%03d' % (199 - i,))
+        for i in range(0, 200, 2):
+            self.index.remove('other%03d' % (i,), 'a', 'x%03d' % (199 - i,))
+        self.index.add('other000', 'a', 'x199')
+        ordered = list(self.index.ordered('a'))
+        self.assertEquals(ordered[:5], ['item1', 'item2', 'item3', 'item4', 'item1'])
+        self.assertEquals(ordered[5:], ['other%03d' % (i,) for i in range(199, 0, -2)] + ['other000'])
+        self.assertEquals(self.index.range('a', 'x198', 'x199'), set(['other000', 'other001']))
+
+    def test_replacing_a_value_does_not_buffer_changes(self):
+        self.index.ordered('a')
+        for i in range(1000):
+            self.index.remove('item1', 'a', 'e' if i == 0 else 'v%d' % (i - 1,))
+            self.index.add('item1', 'a', 'v%d' % (i,))
+        self.assertEquals(len(self.index._added['a']), 1)
+        self.assertEquals(len(self.index._removed['a']), 1)
+        self.assertEquals(list(self.index.ordered('a')),
+                          ['item1', 'item2', 'item3', 'item4', 'item1'])
+
+    def test_changes_are_merged_without_lookups(self):
+        for i in range(index._MAX_BUFFERED * 3):
+            self.index.add('other%d' % (i,), 'b', str(i))
+            self.assertLessEqual(len(self.index._added.get('b', ())), index._MAX_BUFFERED)
+        self.assertEquals(self.index.range('b', '0', '0'), set(['other0']))
+        self.assertEquals(len(list(self.index.ordered('b'))), index._MAX_BUFFERED * 3)
@@ -0,0 +1,89 @@
+import os
+import uuid
+import xml.etree.cElementTree as etree
+
+import testtools as unittest
+
+from basicdb import responses
+
+class ResponsesTests(unittest.TestCase):
+    def test_select_response(self):
+        items = [('item1', {'a': set(['<&>']), 'b': set([u'caf\xe9'])}),
+                 (u'it\u20acm2', {})]
+        body = ''.join(responses.stream('SelectResponse', responses.items_xml(items),
+                                        'req1', 0))
+        dom = etree.fromstring(body)
+        self.assertEquals(dom.tag, 'SelectResponse')
+        result = [(item.findtext('Name'),
+                   sorted((attr.findtext('Name'), attr.findtext('Value'))
+                          for attr in item.findall('Attribute')))
+                  for item in dom.find('SelectResult')]
+        self.assertEquals(result, [('item1', [('a', '<&>'), ('b', u'caf\xe9')]),
+                                   (u'it\u20acm2', [])])
+        self.assertEquals(dom.findtext('ResponseMetadata/RequestId'), 'req1')
+        self.assertTrue(float(dom.findtext('ResponseMetadata/BoxUsage')) > 0)
+
+    def test_same_as_element_tree(self):
+        dom = etree.Element("GetAttributesResponse")
+        result = etree.SubElement(dom, "GetAttributesResult")
+        attr_elem = etree.SubElement(result, "Attribute")
+        etree.SubElement(attr_elem, "Name").text = 'a'
+        etree.SubElement(attr_elem, "Value").text = u'x & y \u20ac'
+        metadata = etree.SubElement(dom, "ResponseMetadata")
+        etree.SubElement(metadata, "RequestId").text = 'req1'
+        etree.SubElement(metadata, "BoxUsage").text = str(0.25)
+
+        self.assertEquals(responses.encode('GetAttributesResponse',
+                                           responses.attributes_xml({'a': set([u'x & y \u20ac'])}),
+                                           'req1', 0.25),
+                          etree.tostring(dom))
+
+    def test_large_items_are_streamed_in_pieces(self):
+        self.patch(responses, 'STREAM_CHUNK_SIZE', 100)
+        item_attrs = {'a': set(['x%d' % (i,) for i in range(20)])}
+        pieces = list(responses.stream('GetAttributesResponse',
+                                       responses.iter_attributes_xml(item_attrs), 'req1', 0))
+        self.assertTrue(len(pieces) > 5)
+        dom = etree.fromstring(''.join(pieces))
+        self.assertEquals(sorted(attr.findtext('Value')
+                                 for attr in dom.findall('GetAttributesResult/Attribute')),
+                          sorted(item_attrs['a']))
+
+    def test_response_without_result(self):
+        dom = etree.fromstring(responses.encode('ConditionalCheckFailed', '', 'req1', 0.25))
+        self.assertEquals([elem.tag for elem in dom.iter()],
+                          ['ConditionalCheckFailed', 'ResponseMetadata', 'RequestId', 'BoxUsage'])
+
+    def test_domain_metadata(self):
+        dom = etree.fromstring(responses.encode(
+                'DomainMetadataResponse',
+                responses.domain_metadata_xml({'ItemCount': 3, 'Timestamp': 10}),
+                'req1', 0.25))
+        self.assertEquals(dom.findtext('DomainMetadataResult/ItemCount'), '3')
+        self.assertEquals(dom.findtext('DomainMetadataResult/Timestamp'), '10')
+
+    def test_request_ids(self):
+        request_ids = [responses.request_id() for i in range(3)]
+        self.assertEquals(len(set(request_ids)), 3)
+        for request_id in request_ids:
+            self.assertEquals(str(uuid.UUID(request_id)), request_id)
+
+    def test_request_ids_of_other_processes_have_other_prefixes(self):
+        request_id = responses.request_id()
+        getpid = os.getpid
+        self.patch(os, 'getpid', lambda: getpid() + 1)
+        self.assertNotEquals(responses.request_id()[:24], request_id[:24])
+
+    def test_pieces_are_sent_as_items_are_produced(self):
+        self.patch(responses, 'STREAM_CHUNK_SIZE', 100)
+        produced = []
+        def items():
+            for i in range(10):
+                produced.append(i)
+                yield 'item%d' % (i,), {'a': set(['x' * 50])}
+
+        pieces = responses.stream('SelectResponse', responses.items_xml(items()), 'req1', 0)
+        self.assertEquals(produced, [])
+        self.assertIn('<Name>item0</Name>', pieces.next())
+        self.assertEquals(produced, [0])
+        self.assertEquals(len(list(pieces)), 10)
@@ -0,0 +1,227 @@
+import httplib
+import os
+import re
+import select
+import shutil
+import signal
+import socket
+import StringIO
+import subprocess
+import sys
+import tempfile
+import time
+
+import testtools as unittest
+
+from basicdb import server
+
+def app(environ, start_response):
+    path = environ['PATH_INFO']
+    if path == '/stream':
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return (piece for piece in ['a' * 10, 'b' * 20])
+    if path == '/fail':
+        raise Exception('Failed')
+    body = '%s %s %s' % (environ['REQUEST_METHOD'], path, environ['QUERY_STRING'])
+    start_response('200 OK', [('Content-Type', 'text/plain'),
+                              ('Content-Length', str(len(body)))])
+    return [body]
+
+class ResponseFramingTest(unittest.TestCase):
+    def test_unknown_length_is_chunked(self):
+        framing = server.ResponseFraming('HTTP/1.1', True)
+        block = framing.header_block('200 OK', [('Content-Type', 'text/xml')])
+        self.assertIn('\r\nTransfer-Encoding: chunked\r\n', block)
+        self.assertNotIn('Connection:', block)
+        self.assertEquals(framing.body('abc') + framing.end(), '3\r\nabc\r\n0\r\n\r\n')
+        self.assertTrue(framing.keep_alive)
+
+    def test_unknown_length_closes_http_1_0_connections(self):
+        framing = server.ResponseFraming('HTTP/1.0', True)
+        block = framing.header_block('200 OK', [])
+        self.assertTrue(block.endswith('\r\nConnection: close\r\n\r\n'))
+        self.assertEquals(framing.body('abc') + framing.end(), 'abc')
+        self.assertFalse(framing.keep_alive)
+
+    def test_known_length(self):
+        framing = server.ResponseFraming('HTTP/1.0', True)
+        block = framing.header_block('200 OK', [('Content-Length', '3')])
+        self.assertTrue(block.startswith('HTTP/1.1 200 OK\r\n'))
+        self.assertTrue(block.endswith('\r\nConnection: keep-alive\r\n\r\n'))
+        self.assertEquals(framing.body('abc') + framing.end(), 'abc')
+
+    def test_empty(self):
+        framing = server.ResponseFraming('HTTP/1.1', False)
+        block = framing.header_block('204 No Content', [], empty=True)
+        self.assertTrue(block.endswith('\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'))
+
+class WorkerTest(unittest.TestCase):
+    def start_worker(self, **kwargs):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(5)
+        listener.settimeout(0.05)
+        self.addCleanup(listener.close)
+        worker = server.Worker(listener, app, threads=2, **kwargs)
+        worker.start()
+        self.addCleanup(worker.stop, 5)
+        self.port = listener.getsockname()[1]
+        return worker
+
+    def connect(self):
+        conn = httplib.HTTPConnection('127.0.0.1', self.port, timeout=5)
+        self.addCleanup(conn.close)
+        return conn
+
+    def get(self, conn, path, method='GET', body=None):
+        conn.request(method, path, body)
+        response = conn.getresponse()
+        return response, response.read()
+
+    def test_connections_are_kept_alive(self):
+        self.start_worker()
+        conn = self.connect()
+        response, body = self.get(conn, '/?Action=ListDomains')
+        self.assertEquals(body, 'GET / Action=ListDomains')
+        sock = conn.sock
+        response, body = self.get(conn, '/', 'POST', 'unread body')
+        self.assertEquals(body, 'POST / ')
+        self.assertIs(conn.sock, sock)
+        response, body = self.get(conn, '/again')
+        self.assertEquals(body, 'GET /again ')
+        self.assertIs(conn.sock, sock)
+
+    def test_responses_of_unknown_length_are_chunked(self):
+        self.start_worker()
+        conn = self.connect()
+        response, body = self.get(conn, '/stream')
+        self.assertEquals(response.getheader('Transfer-Encoding'), 'chunked')
+        self.assertEquals(body, 'a' * 10 + 'b' * 20)
+        self.assertEquals(self.get(conn, '/')[1], 'GET / ')
+
+    def test_failing_app(self):
+        self.patch(sys, 'stderr', StringIO.StringIO())
+        self.start_worker()
+        conn = self.connect()
+        self.assertEquals(self.get(conn, '/fail')[0].status, 500)
+        self.assertEquals(self.get(self.connect(), '/')[1], 'GET / ')
+
+    def test_max_requests(self):
+        worker = self.start_worker(max_requests=2)
+        conn = self.connect()
+        self.assertEquals(self.get(conn, '/')[0].getheader('Connection'), None)
+        self.assertEquals(self.get(conn, '/')[0].getheader('Connection'), 'close')
+        self.assertTrue(worker.stopping.is_set())
+
+class MasterTest(unittest.TestCase):
+    def setUp(self):
+        super(MasterTest, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+
+    def start(self, workers, **env):
+        env = dict(os.environ,
+                   REMOTE_USER='owner',
+                   PYTHONPATH=os.path.dirname(os.path.dirname(os.path.dirname(
+                       os.path.abspath(__file__)))),
+                   **env)
+        self.proc = subprocess.Popen([sys.executable, '-m', 'basicdb.server', '--host',
+                                      '127.0.0.1', '--workers', str(workers),
+                                      '--threads', '2', '0'],
+                                     env=env, stderr=subprocess.PIPE)
+        self.addCleanup(self.kill)
+        self.output = ''
+        self.master_pid, self.port = self.wait_for(
+            r'\[(\d+)\] Listening on http://127.0.0.1:(\d+)/')
+        self.workers = set([self.wait_for(r'Started worker (\d+)')[0]
+                            for i in range(workers)])
+
+    def kill(self):
+        if self.proc.poll() is None:
+            self.proc.kill()
+            self.proc.wait()
+
+    def wait_for(self, pattern, timeout=10):
+        """The groups (as ints) of the next line the server logs that matches
+        pattern"""
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            while '\n' not in self.output:
+                if not select.select([self.proc.stderr], [], [], max(deadline - time.time(), 0))[0]:
+                    self.fail('The server never logged %r' % (pattern,))
+                data = os.read(self.proc.stderr.fileno(), 4096)
+                if not data:
+                    self.fail('The server never logged %r' % (pattern,))
+                self.output += data
+            line, self.output = self.output.split('\n', 1)
+            match = re.search(pattern, line)
+            if match:
+                return tuple(group and int(group) for group in match.groups())
+        self.fail('The server never logged %r' % (pattern,))
+
+    def request(self, query):
+        conn = httplib.HTTPConnection('127.0.0.1', self.port, timeout=10)
+        try:
+            conn.request('GET', '/?' + query)
+            response = conn.getresponse()
+            return response.status, response.read()
+        finally:
+            conn.close()
+
+    def test_serve_restart_and_stop(self):
+        self.start(2, BASICDB_BACKEND_DRIVER='sqlite',
+                   BASICDB_SQLITE_PATH=os.path.join(self.tmp_dir, 'basicdb.sqlite'))
+        self.assertEquals(self.request('Action=CreateDomain&DomainName=domain1')[0], 200)
+
+        os.kill(self.workers.pop(), signal.SIGKILL)
+        new_worker = self.wait_for(r'Started worker (\d+)')[0]
+        self.assertNotIn(new_worker, self.workers)
+        for i in range(10):
+            status, body = self.request('Action=ListDomains')
+            self.assertIn('<DomainName>domain1</DomainName>', body)
+
+        os.kill(self.master_pid, signal.SIGHUP)
+        self.wait_for(r'Started worker (\d+)')
+        self.wait_for(r'Started worker (\d+)')
+
+        os.kill(self.master_pid, signal.SIGTERM)
+        self.wait_for(r'Stopped')
+        self.assertEquals(self.proc.wait(), 0)
+
+    def test_single_worker_is_stopped_before_it_is_replaced(self):
+        self.start(1, BASICDB_BACKEND_DRIVER='fake', BASICDB_FAKE_DATA_DIR=self.tmp_dir)
+        self.assertEquals(self.request('Action=CreateDomain&DomainName=domain1')[0], 200)
+
+        os.kill(self.master_pid, signal.SIGHUP)
+        stopped, started = self.wait_for(r'Worker (\d+) stopped|Started worker (\d+)')
+        self.assertEquals((stopped, started), (self.workers.pop(), None))
+        self.wait_for(r'Started worker (\d+)')
+        status, body = self.request('Action=ListDomains')
+        self.assertIn('<DomainName>domain1</DomainName>', body)
+
+        os.kill(self.master_pid, signal.SIGTERM)
+        self.wait_for(r'Stopped')
+        self.assertEquals(self.proc.wait(), 0)
+
+    def test_in_memory_workers_are_not_replaced(self):
+        self.start(1, BASICDB_BACKEND_DRIVER='fake')
+        os.kill(self.master_pid, signal.SIGHUP)
+        self.wait_for(r'Not replacing workers')
+        os.kill(self.master_pid, signal.SIGTERM)
+        stopped, started = self.wait_for(r'Worker (\d+) stopped|Started worker (\d+)')
+        self.assertEquals((stopped, started), (self.workers.pop(), None))
+        self.assertEquals(self.proc.wait(), 0)
+
+class MainTest(unittest.TestCase):
+    def test_backend_that_cannot_be_shared(self):
+        self.patch(os, 'environ', dict(os.environ, BASICDB_BACKEND_DRIVER='fake'))
+        self.patch(sys, 'stderr', StringIO.StringIO())
+        self.assertEquals(server.main(['--workers', '2']), 1)
+
+    def test_max_requests_with_in_memory_backend(self):
+        environ = dict(os.environ, BASICDB_BACKEND_DRIVER='fake')
+        environ.pop('BASICDB_FAKE_DATA_DIR', None)
+        self.patch(os, 'environ', environ)
+        self.patch(sys, 'stderr', StringIO.StringIO())
+        self.assertEquals(server.main(['--max-requests', '1000']), 1)
+        self.assertIn('BASICDB_FAKE_DATA_DIR', sys.stderr.getvalue())
@@ -1,12 +1,12 @@
-import testtools as unittest
+import random
+import threading
+import time
 
-from basicdb import sqlparser, exceptions
+import testtools as unittest
 
-class SQLParserTest(unittest.TestCase):
-    def setUp(self):
-        super(SQLParserTest, self).setUp()
-        self.sqlparser = sqlparser.SqlParser()
+from basicdb import exceptions, index, sqlparser
 
+class _SQLParserTests(object):
     def test_simple_select_asterisk(self):
         expr = self.sqlparser.parse("SELECT * FROM foobar")
         self.assertEquals(expr.columns[0], "*")
@@ -147,3 +147,409 @@ class SQLParserTest(unittest.TestCase):
 
     def test_nonsense_throws_exception(self):
         self.assertRaises(Exception, self.sqlparser.parse, "NOT a vAlID SQL expression")
+
+
+class SQLParserTest(_SQLParserTests, unittest.TestCase):
+    def setUp(self):
+        super(SQLParserTest, self).setUp()
+        self.sqlparser = sqlparser.SqlParser()
+
+
+class NativeSQLParserTest(_SQLParserTests, unittest.TestCase):
+    def setUp(self):
+        super(NativeSQLParserTest, self).setUp()
+        self.sqlparser = sqlparser.NativeSqlParser()
+
+
+class ParserEquivalenceTest(unittest.TestCase):
+    expressions = ["select * from foobar",
+                   "SELECT a, `b c`, itemName() FROM `foo-bar`",
+                   "select count(*) from foobar where a = 'b' limit 10",
+                   "select itemName() from foobar where itemName() like 'B000%' order by itemName()",
+                   "select * from foobar where a = 'b' and c = 'd' and e = 'f'",
+                   "select * from foobar where a = 'b' or c = 'd' and e = 'f'",
+                   "select * from foobar where a = 'b' and (c = 'd' or e = 'f')",
+                   "select * from foobar where (a > '1' and a < '5') or a like '9%' or a == '7'",
+                   "select * from foobar where a between 'b' and 'f' and c <> 'd'",
+                   "select * from foobar where every(a) in ('b', 'c') intersection c is not null",
+                   "select * from foobar where a in () or a in ('b')",
+                   "select * from foobar where not (a = 'b') order by a desc limit 3",
+                   "select * from foobar where 'b' <= a order by a asc",
+                   "select * from foobar where a is null",
+                   "select * from foobar where a != 'b' intersection c = 'd' intersection e = 'f'",
+                   "SeLeCt * FrOm foobar WhErE a = 'b' OrDeR bY a",
+                   "select * from foobar where ((a = 'b'))",
+                   "select * from foobar limit +4",
+                   # Invalid ones
+                   "select * from foobar where a",
+                   "select * from foobar where (a) = 'b'",
+                   "select * from foobar where a = b",
+                   "select * from foobar where 'a' = 'b'",
+                   "select * from foobar where a = 10",
+                   "select * from foobar where a = 'b' and c",
+                   "select * from foobar where a = 'b",
+                   "select * from foobar where foo('b') = 'c'",
+                   "select * from select",
+                   "select * from foobar where a = 'b' limit",
+                   "select * from foobar where a = 'b' order a",
+                   "select count(*), a from foobar",
+                   "select * from foobar where not a = 'b'",
+                   "select * from foobar where a = 'b' c = 'd'",
+                   "NOT a vAlID SQL expression"]
+
+    def dump(self, node):
+        if isinstance(node, list):
+            return [self.dump(n) for n in node]
+        elif isinstance(node, sqlparser.SqlParser.ValueList):
+            return ('ValueList', self.dump(node._value))
+        elif isinstance(node, sqlparser.SqlParser.Literal):
+            return ('Literal', node.get_single_value_or_raise())
+        elif isinstance(node, sqlparser.SqlParser.Identifier):
+            return (type(node).__name__, node.reference)
+        elif isinstance(node, sqlparser.SqlParser.OrderByTerms):
+            return ('OrderByTerms', node.key, getattr(node, 'reverse', None))
+        elif isinstance(node, sqlparser.SqlParser.BoolOperator):
+            return (type(node).__name__, str(getattr(node, 'reprsymbol', '')),
+                    self.dump(list(node.args)))
+        elif isinstance(node, sqlparser.SqlParser.Null):
+            return ('Null',)
+        return node
+
+    def parse(self, parser, expr):
+        try:
+            stmt = parser.parse(expr)
+        except exceptions.InvalidQueryExpression:
+            return 'invalid'
+        return (self.dump(stmt.columns), stmt.table, self.dump(stmt.where_expr),
+                self.dump(stmt.order_by_terms), stmt.limit_terms)
+
+    def test_parsers_agree(self):
+        pyparsing_parser = sqlparser.SqlParser()
+        native_parser = sqlparser.NativeSqlParser()
+        for expr in self.expressions:
+            self.assertEquals(self.parse(native_parser, expr),
+                              self.parse(pyparsing_parser, expr), expr)
+
+    def test_load_parser(self):
+        self.addCleanup(sqlparser.load_parser, 'pyparsing')
+        sqlparser.load_parser('native')
+        self.assertIsInstance(sqlparser.get_parser(), sqlparser.NativeSqlParser)
+        self.assertEquals(sqlparser.parse("select * from foobar").table, 'foobar')
+
+class StatementCacheTest(unittest.TestCase):
+    def setUp(self):
+        super(StatementCacheTest, self).setUp()
+        self.cache = sqlparser.StatementCache(2)
+
+    def test_repeated_expression_is_a_hit(self):
+        stmt1 = self.cache.parse("SELECT * FROM foobar WHERE a = 'b'")
+        stmt2 = self.cache.parse("SELECT * FROM foobar WHERE a = 'b'")
+        self.assertIs(stmt1, stmt2)
+        self.assertEquals((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_whitespace_outside_quotes_is_normalized(self):
+        stmt1 = self.cache.parse("SELECT * FROM foobar WHERE a = 'b  c'")
+        stmt2 = self.cache.parse("  SELECT *\n FROM   foobar\tWHERE a = 'b  c' ")
+        self.assertIs(stmt1, stmt2)
+
+    def test_whitespace_inside_quotes_is_significant(self):
+        stmt1 = self.cache.parse("SELECT * FROM foobar WHERE a = 'b c'")
+        stmt2 = self.cache.parse("SELECT * FROM foobar WHERE a = 'b  c'")
+        self.assertIsNot(stmt1, stmt2)
+        self.assertTrue(stmt2.where_expr.match('item1', {'a': set(['b  c'])}))
+
+    def test_least_recently_used_is_evicted(self):
+        stmt1 = self.cache.parse("SELECT * FROM foo")
+        self.cache.parse("SELECT * FROM bar")
+        self.cache.parse("SELECT * FROM foo")
+        self.cache.parse("SELECT * FROM baz")
+        self.assertEquals(len(self.cache), 2)
+        self.assertIs(self.cache.parse("SELECT * FROM foo"), stmt1)
+        self.cache.parse("SELECT * FROM bar")
+        self.assertEquals((self.cache.hits, self.cache.misses), (2, 4))
+
+    def test_invalid_expression_is_not_cached(self):
+        self.assertRaises(exceptions.InvalidQueryExpression,
+                          self.cache.parse, "SELECT * FROM foobar WHERE a = b")
+        self.assertEquals(len(self.cache), 0)
+
+    def test_statement_is_immutable(self):
+        stmt = self.cache.parse("SELECT * FROM foobar")
+        self.assertRaises(AttributeError, setattr, stmt, 'table', 'other')
+
+    def test_zero_size_disables_caching(self):
+        cache = sqlparser.StatementCache(0)
+        cache.parse("SELECT * FROM foobar")
+        cache.parse("SELECT * FROM foobar")
+        self.assertEquals(len(cache), 0)
+        self.assertEquals(cache.misses, 2)
+
+
+class CompileWhereTest(unittest.TestCase):
+    cases = [("a = 'b'", {'a': set(['b'])}, True),
+             ("a = 'b'", {'a': set(['c'])}, False),
+             ("a = 'b'", {'c': set(['b'])}, False),
+             ("'b' = a", {'a': set(['c', 'b'])}, True),
+             ("a != 'b'", {'a': set(['b'])}, False),
+             ("a != 'b'", {'a': set(['b', 'c'])}, True),
+             ("a != 'b'", {}, False),
+             ("'b' < a", {'a': set(['c'])}, True),
+             ("a < 'b'", {'a': set(['c'])}, False),
+             ("a >= 'b' and a <= 'b'", {'a': set(['b'])}, True),
+             ("a > 'd' and a < 'd'", {'a': set(['c', 'e'])}, False),
+             ("a = 'b' and c = 'd'", {'a': set(['b', 'x']), 'c': set(['d'])}, True),
+             ("a = 'b' or c = 'd'", {'c': set(['d'])}, True),
+             ("not (a = 'b')", {'a': set(['b'])}, False),
+             ("not (a = 'b')", {'a': set(['b', 'c'])}, True),
+             ("a between 'b' and 'f'", {'a': set(['d'])}, True),
+             ("a between 'f' and 'b'", {'a': set(['a', 'g'])}, False),
+             ("a in ('b', 'c')", {'a': set(['c'])}, True),
+             ("a in ('b', 'c')", {'a': set(['d'])}, False),
+             ("every(a) in ('b', 'c')", {'a': set(['b', 'c'])}, True),
+             ("every(a) in ('b', 'c')", {'a': set(['b', 'd'])}, False),
+             ("every(a) = 'b'", {'a': set(['b', 'c'])}, False),
+             ("every(a) != 'b'", {'a': set(['b', 'c'])}, True),
+             ("a like 'b%'", {'a': set(['x', 'bar'])}, True),
+             ("a like 'b_r'", {'a': set(['x', 'bxx'])}, False),
+             ("a is not null", {'a': set(['b'])}, True),
+             ("a is not null", {'b': set(['b'])}, False),
+             ("itemName() = 'item1'", {}, True),
+             ("itemName() like 'item%' and a = 'b'", {'a': set(['b'])}, True),
+             ("a = 'b' intersection a = 'c'", {'a': set(['b', 'c'])}, True),
+             ("a = 'b' and a = 'c'", {'a': set(['b', 'c'])}, False)]
+
+    def test_compiled_predicate_agrees_with_cartesian_match(self):
+        parser = sqlparser.SqlParser()
+        for where, attrs, expected in self.cases:
+            stmt = parser.parse("SELECT * FROM foobar WHERE %s" % (where,))
+            predicate = sqlparser.compile_where(stmt.where_expr)
+            self.assertEquals(predicate('item1', attrs), expected, where)
+            self.assertEquals(stmt.where_expr.cartesian_match('item1', attrs), expected, where)
+
+    def _random_comparison(self, rnd):
+        attr = rnd.choice(['x', 'y', 'z'])
+        value = "'%s'" % (rnd.choice('abcde'),)
+        kind = rnd.random()
+        if kind < 0.1:
+            return "%s like '%s%%'" % (attr, rnd.choice('abcde'))
+        if rnd.random() < 0.2:
+            attr = 'every(%s)' % (attr,)
+        if kind < 0.6:
+            return '%s %s %s' % (attr, rnd.choice(['=', '!=', '<', '<=', '>', '>=']), value)
+        elif kind < 0.8:
+            values = rnd.sample('abcde', rnd.randint(1, 3))
+            return '%s in (%s)' % (attr, ', '.join("'%s'" % (v,) for v in values))
+        else:
+            return '%s is not null' % (attr,)
+
+    def _random_expression(self, rnd, depth=0):
+        kind = rnd.random()
+        if depth > 2 or kind < 0.4:
+            return self._random_comparison(rnd)
+        elif kind < 0.5:
+            return 'not (%s)' % (self._random_expression(rnd, depth + 1),)
+        return '(%s %s %s)' % (self._random_expression(rnd, depth + 1),
+                               rnd.choice(['and', 'or']),
+                               self._random_expression(rnd, depth + 1))
+
+    def _random_item(self, rnd):
+        return dict((attr, set(rnd.sample('abcde', rnd.randint(1, 3))))
+                    for attr in rnd.sample(['x', 'y', 'z'], rnd.randint(0, 3)))
+
+    def test_random_expressions_agree_with_cartesian_match(self):
+        rnd = random.Random(1234)
+        parser = sqlparser.SqlParser()
+        items = [self._random_item(rnd) for _ in range(20)]
+        for _ in range(150):
+            where = self._random_expression(rnd)
+            if rnd.random() < 0.2:
+                where += ' intersection ' + self._random_expression(rnd)
+            stmt = parser.parse("SELECT * FROM foobar WHERE %s" % (where,))
+            for attrs in items:
+                self.assertEquals(stmt.predicate('item1', attrs),
+                                  stmt.where_expr.cartesian_match('item1', attrs),
+                                  '%s on %r' % (where, attrs))
+
+    def test_cost_is_linear_in_number_of_values(self):
+        attrs = dict(('attr%d' % (i,), set('val%d' % (j,) for j in range(10)))
+                     for i in range(20))
+        where = ' and '.join("attr%d = 'val9'" % (i,) for i in range(20))
+        stmt = sqlparser.SqlParser().parse("SELECT * FROM foobar WHERE %s" % (where,))
+        start = time.time()
+        self.assertTrue(stmt.predicate('item1', attrs))
+        self.assertFalse(stmt.predicate('item1', dict(attrs, attr19=set(['val0']))))
+        self.assertLess(time.time() - start, 1)
+
+    def test_statement_carries_predicate(self):
+        stmt = sqlparser.SqlParser().parse("SELECT * FROM foobar WHERE a = 'b'")
+        self.assertTrue(stmt.predicate('item1', {'a': set(['b'])}))
+        self.assertFalse(stmt.predicate('item1', {'a': set(['c'])}))
+
+    def test_no_where_clause_matches_everything(self):
+        stmt = sqlparser.SqlParser().parse("SELECT * FROM foobar")
+        self.assertTrue(stmt.predicate('item1', {}))
+
+    def test_compiled_predicate_does_not_touch_lookup_hooks(self):
+        saved = sqlparser.lookup, sqlparser.lookup_every
+        def fail(key):
+            self.fail("lookup hook used")
+        sqlparser.lookup = sqlparser.lookup_every = fail
+        try:
+            stmt = sqlparser.SqlParser().parse("SELECT * FROM foobar WHERE every(a) = 'b' or c > 'd'")
+            self.assertTrue(stmt.predicate('item1', {'a': set(['b'])}))
+        finally:
+            sqlparser.lookup, sqlparser.lookup_every = saved
+
+
+    def test_lookups_are_per_thread(self):
+        where_expr = sqlparser.SqlParser().parse(
+            "SELECT * FROM foobar WHERE every(a) = 'b' and every(c) = 'd'").where_expr
+
+        class BlockingAttrs(dict):
+            """Attributes that stop the thread matching against them at the
+            first lookup until released"""
+            def __init__(self, *args):
+                super(BlockingAttrs, self).__init__(*args)
+                self.entered = threading.Event()
+                self.release = threading.Event()
+
+            def get(self, key, default=None):
+                if not self.release.is_set():
+                    self.entered.set()
+                    self.release.wait(5)
+                return super(BlockingAttrs, self).get(key, default)
+
+        items = [BlockingAttrs({'a': set(['b']), 'c': set(['d'])}),
+                 BlockingAttrs({'a': set(['x']), 'c': set(['y'])})]
+        results = {}
+        def match(i):
+            results[i] = where_expr.cartesian_match('item%d' % (i,), items[i])
+        threads = [threading.Thread(target=match, args=(i,)) for i in range(2)]
+        # Both threads are in the middle of matching at the same time
+        for thread, item_attrs in zip(threads, items):
+            thread.start()
+            item_attrs.entered.wait(5)
+        for thread, item_attrs in zip(threads, items):
+            item_attrs.release.set()
+            thread.join()
+        self.assertEquals(results, {0: True, 1: False})
+
+class CandidateItemsTest(unittest.TestCase):
+    items = {'item1': {'a': set(['b', 'c']), 'd': set(['e'])},
+             'item2': {'a': set(['c'])},
+             'item3': {'d': set(['e', 'f'])}}
+
+    def setUp(self):
+        super(CandidateItemsTest, self).setUp()
+        self.index = index.OrderedIndex()
+        for item_name, attrs in self.items.iteritems():
+            for attr_name, values in attrs.iteritems():
+                for value in values:
+                    self.index.add(item_name, attr_name, value)
+            self.index.add_item(item_name)
+
+    def candidates(self, where):
+        stmt = sqlparser.SqlParser().parse("SELECT * FROM foobar WHERE %s" % (where,))
+        return sqlparser.candidate_items(stmt.where_expr, self.index)
+
+    def test_equality(self):
+        self.assertEquals(self.candidates("a = 'c'"), set(['item1', 'item2']))
+        self.assertEquals(self.candidates("'b' = a"), set(['item1']))
+        self.assertEquals(self.candidates("every(a) = 'c'"), set(['item1', 'item2']))
+        self.assertEquals(self.candidates("a = 'x'"), set())
+
+    def test_in(self):
+        self.assertEquals(self.candidates("a in ('b', 'x')"), set(['item1']))
+        self.assertEquals(self.candidates("d in ('f', 'e')"), set(['item1', 'item3']))
+
+    def test_and_and_intersection_narrow_down(self):
+        self.assertEquals(self.candidates("a = 'c' and d = 'e'"), set(['item1']))
+        self.assertEquals(self.candidates("a = 'c' intersection d = 'e'"), set(['item1']))
+        self.assertEquals(self.candidates("a = 'c' and d != 'a'"), set(['item1', 'item2']))
+
+    def test_or_needs_every_side(self):
+        self.assertEquals(self.candidates("a = 'b' or d = 'f'"), set(['item1', 'item3']))
+        self.assertIsNone(self.candidates("a = 'b' or d != 'a'"))
+
+    def test_ranges(self):
+        self.assertEquals(self.candidates("a > 'b'"), set(['item1', 'item2']))
+        self.assertEquals(self.candidates("'c' > a"), set(['item1']))
+        self.assertEquals(self.candidates("a <= 'b'"), set(['item1']))
+        self.assertEquals(self.candidates("d >= 'f'"), set(['item3']))
+        self.assertEquals(self.candidates("a between 'b' and 'c'"), set())
+        self.assertEquals(self.candidates("a between 'd' and 'a'"), set(['item1', 'item2']))
+
+    def test_prefix_like(self):
+        self.assertEquals(self.candidates("a like 'c%'"), set(['item1', 'item2']))
+        self.assertEquals(self.candidates("d like 'e_'"), set(['item1', 'item3']))
+        self.assertIsNone(self.candidates("a like '%c'"))
+
+    def test_item_name(self):
+        self.assertEquals(self.candidates("itemName() = 'item1'"), set(['item1']))
+        self.assertEquals(self.candidates("itemName() in ('item1', 'item4')"), set(['item1']))
+        self.assertEquals(self.candidates("itemName() like 'item%'"), set(['item1', 'item2', 'item3']))
+        self.assertEquals(self.candidates("itemName() > 'item1'"), set(['item2', 'item3']))
+
+    def test_unsupported_comparisons(self):
+        self.assertIsNone(self.candidates("a != 'b'"))
+        self.assertIsNone(self.candidates("not (a = 'b')"))
+        self.assertIsNone(self.candidates("a is not null"))
+
+    def test_inverted_index_only_answers_equality(self):
+        self.index = index.InvertedIndex()
+        self.index.add('item1', 'a', 'b')
+        self.assertEquals(self.candidates("a = 'b'"), set(['item1']))
+        self.assertIsNone(self.candidates("a > 'b'"))
+        self.assertIsNone(self.candidates("a like 'b%'"))
+
+    def test_like_prefix(self):
+        self.assertEquals(sqlparser.like_prefix('abc%'), 'abc')
+        self.assertEquals(sqlparser.like_prefix('ab_d'), 'ab')
+        self.assertEquals(sqlparser.like_prefix('a*b%'), 'a*b')
+        self.assertEquals(sqlparser.like_prefix('ab.c'), 'ab')
+        self.assertEquals(sqlparser.like_prefix('abc?'), 'ab')
+        self.assertEquals(sqlparser.like_prefix('ab|cd'), '')
+
+    def test_candidates_include_every_match(self):
+        rnd = random.Random(4321)
+        generator = CompileWhereTest('test_statement_carries_predicate')
+        items = dict(('item%d' % (i,), generator._random_item(rnd)) for i in range(20))
+        idx = index.OrderedIndex()
+        for item_name, attrs in items.iteritems():
+            idx.add_item(item_name)
+            for attr_name, values in attrs.iteritems():
+                for value in values:
+                    idx.add(item_name, attr_name, value)
+
+        for _ in range(150):
+            where = generator._random_expression(rnd)
+            if rnd.random() < 0.2:
+                where += " and x between '%s' and '%s'" % tuple(rnd.sample('abcde', 2))
+            stmt = sqlparser.SqlParser().parse("SELECT * FROM foobar WHERE %s" % (where,))
+            candidates = sqlparser.candidate_items(stmt.where_expr, idx)
+            if candidates is None:
+                continue
+            for item_name, attrs in items.iteritems():
+                if stmt.predicate(item_name, attrs):
+                    self.assertIn(item_name, candidates, where)
+
+
+class ItemNamesTest(unittest.TestCase):
+    def item_names(self, where):
+        stmt = sqlparser.SqlParser().parse("SELECT * FROM foobar WHERE %s" % (where,))
+        return sqlparser.item_names(stmt.where_expr)
+
+    def test_item_name_constraints(self):
+        self.assertEquals(self.item_names("itemName() = 'a'"), set(['a']))
+        self.assertEquals(self.item_names("'a' = itemName()"), set(['a']))
+        self.assertEquals(self.item_names("itemName() in ('a', 'b', 'c')"), set(['a', 'b', 'c']))
+        self.assertEquals(self.item_names("itemName() in ('a', 'b') and x > 'y'"), set(['a', 'b']))
+        self.assertEquals(self.item_names("itemName() in ('a', 'b') and itemName() = 'b'"), set(['b']))
+        self.assertEquals(self.item_names("itemName() = 'a' or itemName() = 'b'"), set(['a', 'b']))
+
+    def test_other_constraints(self):
+        self.assertIsNone(self.item_names("x = 'a'"))
+        self.assertIsNone(self.item_names("itemName() like 'a%'"))
+        self.assertIsNone(self.item_names("itemName() > 'a'"))
+        self.assertIsNone(self.item_names("itemName() = 'a' or x = 'b'"))
+        self.assertIsNone(self.item_names("not (itemName() = 'a')"))
@@ -4,119 +4,145 @@ import basicdb
 from basicdb import utils
 
 class UtilsTests(unittest.TestCase):
-    def _create_request(self, params):
-        class Request(object):
-            def __init__(self, params):
-                self._params = params
-
-        return Request(params)
-
-    def test_extract_numbered_args(self):
-        query_params = {'Attribute.1.Name': 'attr1',
-                        'Attribute.1.Value': 'attr1val1',
-                        'Attribute.3.Name': 'attr3',
-                        'Attribute.3.Value': 'attr3val1',
-                        'Attribute.6.Name': 'attr6',
-                        'Attribute.7.Value': 'attr7val1',
-                        'Attribute.7.Replace': 'attr7replace',
-                        'Attribute.8.Foobar': 'blah'}
-
-        args = utils.extract_numbered_args(utils.PUT_ATTRIBUTE_QUERY_REGEX,
-                                           query_params)
-
-        self.assertEquals(args, {'1': {'Name': 'attr1',
-                                       'Value': 'attr1val1'},
-                                 '3': {'Name': 'attr3',
-                                       'Value': 'attr3val1'},
-                                 '6': {'Name': 'attr6'},
-                                 '7': {'Value': 'attr7val1',
-                                       'Replace': 'attr7replace'}})
-
-    def test_extract_batch_deletions_from_query_params(self):
-        request = self._create_request({'Item.1.ItemName': 'item1',
-                                        'Item.1.Attribute.1.Name': 'attr1',
-                                        'Item.1.Attribute.1.Value': 'attr1val1',
-                                        'Item.3.ItemName': 'item3',
-                                        'Item.3.Attribute.3.Name': 'attr3',
-                                        'Item.3.Attribute.3.Value': 'attr3val1',
-                                        'Item.1.Attribute.6.Name': 'attr6',
-                                        'Item.1.Attribute.7.Name': 'attr7',
-                                        'Item.1.Attribute.7.Value': 'attr7val1',
-                                        'Item.1.Attribute.7.Replace': 'true',
-                                        'Item.1.Attribute.8.Foobar': 'blah'})
-
-        deletions = utils.extract_batch_deletions_from_query_params(request)
+    def test_decode_batch_deletions(self):
+        params = {'Item.1.ItemName': 'item1',
+                  'Item.1.Attribute.1.Name': 'attr1',
+                  'Item.1.Attribute.1.Value': 'attr1val1',
+                  'Item.3.ItemName': 'item3',
+                  'Item.3.Attribute.3.Name': 'attr3',
+                  'Item.3.Attribute.3.Value': 'attr3val1',
+                  'Item.1.Attribute.6.Name': 'attr6',
+                  'Item.1.Attribute.7.Name': 'attr7',
+                  'Item.1.Attribute.7.Value': 'attr7val1',
+                  'Item.1.Attribute.7.Replace': 'true',
+                  'Item.1.Attribute.8.Foobar': 'blah'}
+
+        deletions = utils.decode_params(params, deletions=True, batch=True).deletions
 
         self.assertEquals(deletions, {'item1': {'attr1': set(['attr1val1']),
                                                 'attr6': set([basicdb.AllAttributes]),
                                                 'attr7': set(["attr7val1"])},
                                       'item3': {'attr3': set(['attr3val1'])}})
 
-    def test_extract_batch_additions_and_replacements_from_query_params(self):
-        request = self._create_request({'Item.1.ItemName': 'item1',
-                                        'Item.1.Attribute.1.Name': 'attr1',
-                                        'Item.1.Attribute.1.Value': 'attr1val1',
-                                        'Item.3.ItemName': 'item3',
-                                        'Item.3.Attribute.3.Name': 'attr3',
-                                        'Item.3.Attribute.3.Value': 'attr3val1',
-                                        'Item.1.Attribute.6.Name': 'attr6',
-                                        'Item.1.Attribute.7.Name': 'attr7',
-                                        'Item.1.Attribute.7.Value': 'attr7val1',
-                                        'Item.1.Attribute.7.Replace': 'true',
-                                        'Item.1.Attribute.8.Foobar': 'blah'})
-
-        additions, replacements = utils.extract_batch_additions_and_replacements_from_query_params(request)
-
-        self.assertEquals(additions, {'item1': {'attr1': set(['attr1val1'])},
-                                      'item3': {'attr3': set(['attr3val1'])}})
-        self.assertEquals(replacements, {'item1': {'attr7': set(['attr7val1'])}})
-
-    def test_extract_additions_and_replacements_from_query_params(self):
-        request = self._create_request({'Attribute.1.Name': 'attr1',
-                                        'Attribute.1.Value': 'attr1val1',
-                                        'Attribute.3.Name': 'attr3',
-                                        'Attribute.3.Value': 'attr3val1',
-                                        'Attribute.6.Name': 'attr6',
-                                        'Attribute.7.Name': 'attr7',
-                                        'Attribute.7.Value': 'attr7val1',
-                                        'Attribute.7.Replace': 'true',
-                                        'Attribute.8.Foobar': 'blah'})
-
-        additions, replacements = utils.extract_additions_and_replacements_from_query_params(request)
-
-        self.assertEquals(additions, {'attr1': set(['attr1val1']),
-                                       'attr3': set(['attr3val1'])})
-        self.assertEquals(replacements, {'attr7': set(['attr7val1'])})
-
-    def test_extract_deletions_from_query_params(self):
-        request = self._create_request({'Attribute.1.Name': 'attr1',
-                                        'Attribute.1.Value': 'attr1val1',
-                                        'Attribute.3.Name': 'attr3',
-                                        'Attribute.3.Value': 'attr3val1',
-                                        'Attribute.6.Name': 'attr6',
-                                        'Attribute.12.Value': 'attr12val1',
-                                        'Attribute.7.Name': 'attr7',
-                                        'Attribute.7.Value': 'attr7val1',
-                                        'Attribute.7.Replace': 'true',
-                                        'Attribute.8.Foobar': 'blah'})
-
-        deletions = utils.extract_deletions_from_query_params(request)
+    def test_decode_batch_additions_and_replacements(self):
+        params = {'Item.1.ItemName': 'item1',
+                  'Item.1.Attribute.1.Name': 'attr1',
+                  'Item.1.Attribute.1.Value': 'attr1val1',
+                  'Item.3.ItemName': 'item3',
+                  'Item.3.Attribute.3.Name': 'attr3',
+                  'Item.3.Attribute.3.Value': 'attr3val1',
+                  'Item.1.Attribute.6.Name': 'attr6',
+                  'Item.1.Attribute.7.Name': 'attr7',
+                  'Item.1.Attribute.7.Value': 'attr7val1',
+                  'Item.1.Attribute.7.Replace': 'true',
+                  'Item.1.Attribute.8.Foobar': 'blah'}
+
+        decoded = utils.decode_params(params, batch=True)
+
+        self.assertEquals(decoded.additions, {'item1': {'attr1': set(['attr1val1'])},
+                                              'item3': {'attr3': set(['attr3val1'])}})
+        self.assertEquals(decoded.replacements, {'item1': {'attr7': set(['attr7val1'])}})
+
+    def test_decode_additions_and_replacements(self):
+        params = {'Attribute.1.Name': 'attr1',
+                  'Attribute.1.Value': 'attr1val1',
+                  'Attribute.3.Name': 'attr3',
+                  'Attribute.3.Value': 'attr3val1',
+                  'Attribute.6.Name': 'attr6',
+                  'Attribute.7.Name': 'attr7',
+                  'Attribute.7.Value': 'attr7val1',
+                  'Attribute.7.Replace': 'true',
+                  'Attribute.8.Foobar': 'blah'}
+
+        decoded = utils.decode_params(params)
+
+        self.assertEquals(decoded.additions, {'attr1': set(['attr1val1']),
+                                              'attr3': set(['attr3val1'])})
+        self.assertEquals(decoded.replacements, {'attr7': set(['attr7val1'])})
+
+    def test_decode_deletions(self):
+        params = {'Attribute.1.Name': 'attr1',
+                  'Attribute.1.Value': 'attr1val1',
+                  'Attribute.3.Name': 'attr3',
+                  'Attribute.3.Value': 'attr3val1',
+                  'Attribute.6.Name': 'attr6',
+                  'Attribute.12.Value': 'attr12val1',
+                  'Attribute.7.Name': 'attr7',
+                  'Attribute.7.Value': 'attr7val1',
+                  'Attribute.7.Replace': 'true',
+                  'Attribute.8.Foobar': 'blah'}
+
+        deletions = utils.decode_params(params, deletions=True).deletions
 
         self.assertEquals(deletions, {'attr1': set(['attr1val1']),
                                       'attr3': set(['attr3val1']),
                                       'attr6': set([basicdb.AllAttributes]),
                                       'attr7': set(['attr7val1'])})
 
-    def test_extract_expectations_from_query_params(self):
-        request = self._create_request({'Expected.1.Name': 'attr1',
-                                        'Expected.1.Value': 'attr1val1',
-                                        'Expected.3.Name': 'attr3',
-                                        'Expected.3.Exists': 'true',
-                                        'Expected.6.Name': 'attr6',
-                                        'Expected.6.Exists': 'false'})
+    def test_decode_expectations(self):
+        params = {'Expected.1.Name': 'attr1',
+                  'Expected.1.Value': 'attr1val1',
+                  'Expected.3.Name': 'attr3',
+                  'Expected.3.Exists': 'true',
+                  'Expected.6.Name': 'attr6',
+                  'Expected.6.Exists': 'false'}
 
-        expectations = utils.extract_expectations_from_query_params(request)
+        expectations = utils.decode_params(params).expectations
 
         self.assertEquals(expectations, set([('attr1', 'attr1val1'),
                                              ('attr3', True),
                                              ('attr6', False)]))
+
+    def test_decode_params(self):
+        params = {'Attribute.1.Name': 'attr1',
+                  'Attribute.1.Value': 'attr1val1',
+                  'Attribute.6.Name': 'attr6',
+                  'Attribute.7.Name': 'attr7',
+                  'Attribute.7.Value': 'attr7val1',
+                  'Attribute.7.Replace': 'true',
+                  'Attribute.8.Foobar': 'blah',
+                  'Attribute.x.Name': 'attrx',
+                  'Expected.1.Name': 'attr1',
+                  'Expected.1.Value': 'attr1val1',
+                  'Expected.6.Name': 'attr6',
+                  'Expected.6.Exists': 'false',
+                  'Item.1.ItemName': 'item1',
+                  'Item.1.Attribute.1.Name': 'attr2',
+                  'Item.1.Attribute.1.Value': 'attr2val1'}
+
+        self.assertEquals(utils.decode_params(params),
+                          ({'attr1': set(['attr1val1'])},
+                           {'attr7': set(['attr7val1'])},
+                           {},
+                           set([('attr1', 'attr1val1'), ('attr6', False)])))
+        self.assertEquals(utils.decode_params(params, deletions=True).deletions,
+                          {'attr1': set(['attr1val1']),
+                           'attr6': set([basicdb.AllAttributes]),
+                           'attr7': set(['attr7val1'])})
+
+    def test_decode_batch_params(self):
+        params = {'Item.1.ItemName': 'item1',
+                  'Item.1.Attribute.1.Name': 'attr1',
+                  'Item.1.Attribute.1.Value': 'attr1val1',
+                  'Item.3.ItemName': 'item3',
+                  'Item.3.Attribute.1.Name': 'attr3',
+                  'Item.3.Attribute.1.Value': 'attr3val1',
+                  'Item.1.Attribute.6.Name': 'attr6',
+                  'Item.1.Attribute.7.Name': 'attr7',
+                  'Item.1.Attribute.7.Value': 'attr7val1',
+                  'Item.1.Attribute.7.Replace': 'true',
+                  'Item.1.Attribute.8.Foobar': 'blah',
+                  'Item.4.Attribute.1.Name': 'nameless',
+                  'Item.4.Attribute.1.Value': 'nameless',
+                  'Attribute.1.Name': 'attr9',
+                  'Attribute.1.Value': 'attr9val1'}
+
+        decoded = utils.decode_params(params, batch=True)
+        self.assertEquals(decoded.additions, {'item1': {'attr1': set(['attr1val1'])},
+                                              'item3': {'attr3': set(['attr3val1'])}})
+        self.assertEquals(decoded.replacements, {'item1': {'attr7': set(['attr7val1'])}})
+        self.assertEquals(utils.decode_params(params, deletions=True, batch=True).deletions,
+                          {'item1': {'attr1': set(['attr1val1']),
+                                     'attr6': set([basicdb.AllAttributes]),
+                                     'attr7': set(['attr7val1'])},
+                           'item3': {'attr3': set(['attr3val1'])}})
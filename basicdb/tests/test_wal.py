@@ -0,0 +1,112 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import testtools as unittest
+
+from basicdb import wal
+
+class WriteAheadLogTest(unittest.TestCase):
+    def setUp(self):
+        super(WriteAheadLogTest, self).setUp()
+        self.data_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.data_dir)
+
+    def open_log(self, sync_interval=0):
+        log = wal.WriteAheadLog(self.data_dir, sync_interval)
+        self.addCleanup(log.close)
+        return log
+
+    def test_records_are_replayed(self):
+        log = self.open_log()
+        snapshot, records = log.recover()
+        self.assertEquals((snapshot, list(records)), (None, []))
+        log.sync(log.append(('a', 1)))
+        log.sync(log.append(('b', 2)))
+        log.close()
+
+        snapshot, records = self.open_log().recover()
+        self.assertEquals((snapshot, list(records)), (None, [('a', 1), ('b', 2)]))
+
+    def test_records_from_several_restarts_are_replayed_in_order(self):
+        for i in range(3):
+            log = self.open_log()
+            self.assertEquals(len(list(log.recover()[1])), i)
+            log.sync(log.append(i))
+            log.close()
+        self.assertEquals(list(self.open_log().recover()[1]), [0, 1, 2])
+
+    def test_snapshot_replaces_older_records(self):
+        log = self.open_log()
+        log.recover()
+        log.append('a')
+        snapshot = log.start_snapshot({'state': 1})
+        log.sync(log.append('b'))
+        log.write_snapshot(snapshot)
+        log.close()
+
+        snapshot, records = self.open_log().recover()
+        self.assertEquals((snapshot, list(records)), ({'state': 1}, ['b']))
+        self.assertEquals(len([f for f in os.listdir(self.data_dir) if f.startswith('snapshot.')]), 1)
+
+    def test_unfinished_snapshot_is_ignored(self):
+        log = self.open_log()
+        log.recover()
+        log.append('a')
+        log.start_snapshot({'state': 1})
+        log.sync(log.append('b'))
+        log.close()
+
+        snapshot, records = self.open_log().recover()
+        self.assertEquals((snapshot, list(records)), (None, ['a', 'b']))
+
+    def test_torn_record_ends_the_log(self):
+        log = self.open_log()
+        log.recover()
+        log.sync(log.append('a'))
+        log.sync(log.append('b'))
+        log.close()
+        path = os.path.join(self.data_dir, sorted(os.listdir(self.data_dir))[-1])
+        with open(path, 'r+b') as fp:
+            fp.truncate(os.path.getsize(path) - 1)
+
+        log = self.open_log()
+        self.assertEquals(list(log.recover()[1]), ['a'])
+        log.sync(log.append('c'))
+        log.close()
+        self.assertEquals(list(self.open_log().recover()[1]), ['a', 'c'])
+
+    def test_one_fsync_covers_records_appended_by_others(self):
+        log = self.open_log()
+        log.recover()
+        seqs = []
+        threads = [threading.Thread(target=lambda: seqs.append(log.append('a')))
+                   for i in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        fsyncs = []
+        original = os.fsync
+        self.patch(os, 'fsync', lambda fd: (fsyncs.append(fd), original(fd)))
+        for seq in sorted(seqs):
+            log.sync(seq)
+        self.assertEquals(len(fsyncs), 1)
+
+    def test_background_sync(self):
+        log = self.open_log(sync_interval=0.01)
+        log.recover()
+        fsyncs = []
+        original = os.fsync
+        self.patch(os, 'fsync', lambda fd: (fsyncs.append(fd), original(fd)))
+        seq = log.append('a')
+        log.sync(seq)
+        for i in range(500):
+            if log._synced >= seq:
+                break
+            time.sleep(0.01)
+        self.assertEquals(log._synced, seq)
+        self.assertEquals(len(fsyncs), 1)
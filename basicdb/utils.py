@@ -1,125 +1,81 @@
-import re
+import collections
 
-BATCH_QUERY_REGEX = re.compile(r'Item\.(\d+)\.(.*)')
-PUT_ATTRIBUTE_QUERY_REGEX = re.compile(r'Attribute\.(\d+)\.(Name|Value|Replace)')
-DELETE_QUERY_ARG_REGEX = re.compile(r'Attribute\.(\d+)\.(Name|Value)')
-EXPECTED_QUERY_ARG_REGEX = re.compile(r'Expected\.(\d+)\.(Name|Value|Exists)')
+import basicdb
 
-def extract_numbered_args(regex, params):
-    attrs = {}
-    for (k, v) in params.iteritems():
-        match = regex.match(k)
-        if not match:
-            continue
-    
-        idx, elem = match.groups()
-        if idx not in attrs:
-            attrs[idx] = {}
-        attrs[idx][elem] = v
-    return attrs
-     
-def extract_batch_additions_and_replacements_from_query_params(req): 
-    args = extract_numbered_args(BATCH_QUERY_REGEX, req._params)
+DecodedParams = collections.namedtuple('DecodedParams', ['additions', 'replacements',
+                                                         'deletions', 'expectations'])
 
-    additions = {}
-    replacements = {}
-    for data in args.values():
-        if 'ItemName' in data:
-            item_name = data['ItemName']
-            subargs = extract_numbered_args(PUT_ATTRIBUTE_QUERY_REGEX, data)
-            for subdata in subargs.values():
-                if 'Name' in subdata and 'Value' in subdata:
-                    attr_name = subdata['Name']
-                    attr_value = subdata['Value']
-                    if 'Replace' in subdata and subdata['Replace'] == 'true':
-                        if item_name not in replacements:
-                            replacements[item_name] = {}
-                        if attr_name not in replacements[item_name]:
-                            replacements[item_name][attr_name] = set()
-                        replacements[item_name][attr_name].add(attr_value)
-                    else:
-                        if item_name not in additions:
-                            additions[item_name] = {}
-                        if attr_name not in additions[item_name]:
-                            additions[item_name][attr_name] = set()
-                        additions[item_name][attr_name].add(attr_value)
-    return additions, replacements
+def decode_params(params, deletions=False, batch=False):
+    """Decode the Attribute.N.* and Expected.N.* query params of a
+    PutAttributes or DeleteAttributes request, or the Item.N.* params of a
+    BatchPutAttributes or BatchDeleteAttributes request if batch is true
 
-def extract_batch_deletions_from_query_params(req): 
-    args = extract_numbered_args(BATCH_QUERY_REGEX, req._params)
+    The attributes are decoded as deletions if deletions is true, and as
+    additions and replacements otherwise. For batch requests, additions,
+    replacements and deletions are dicts mapping item names to what they
+    would be for that item alone.
 
-    deletions = {}
-    for data in args.values():
-        if 'ItemName' in data:
-            item_name = data['ItemName']
-            subargs = extract_numbered_args(DELETE_QUERY_ARG_REGEX, data)
-            for subdata in subargs.values():
-                if 'Name' not in subdata:
-                    continue
-    
-                attr_name = subdata['Name']
-                if item_name not in deletions:
-                     deletions[item_name] = {}
-                if attr_name not in deletions[item_name]:
-                    deletions[item_name][attr_name] = set()
+    Params are sorted by what comes after their last dot in a single pass
+    over params, keyed by what comes before it (e.g. "Item.2.Attribute.5"),
+    and those prefixes are only parsed once per attribute afterwards."""
+    names = {}
+    values = {}
+    replace = {}
+    exists = {}
+    item_names = {}
+    for key, value in params.iteritems():
+        prefix, _, field = key.rpartition('.')
+        if field == 'Name':
+            names[prefix] = value
+        elif field == 'Value':
+            values[prefix] = value
+        elif field == 'Replace':
+            replace[prefix] = value
+        elif field == 'ItemName':
+            item_names[prefix] = value
+        elif field == 'Exists':
+            exists[prefix] = value
 
-                if 'Value' in subdata:
-                    deletions[item_name][attr_name].add(subdata['Value'])
+    decoded = DecodedParams({}, {}, {}, set())
+    for prefix, attr_name in names.iteritems():
+        parts = prefix.split('.')
+        if len(parts) == 2:
+            kind, idx = parts
+            if batch or not idx.isdigit():
+                continue
+            if kind == 'Expected':
+                if prefix in values:
+                    expected_value = values[prefix]
                 else:
-                    import basicdb
-                    deletions[item_name][attr_name].add(basicdb.AllAttributes)
-    return deletions
-    
-def extract_additions_and_replacements_from_query_params(req): 
-    args = extract_numbered_args(PUT_ATTRIBUTE_QUERY_REGEX, req._params)
-    
-    additions = {}
-    replacements = {}
-    for idx, data in args.iteritems():
-        if 'Name' in args[idx] and 'Value' in args[idx]:
-            name = args[idx]['Name']
-            value = args[idx]['Value']
-            if 'Replace' in args[idx] and args[idx]['Replace'] == 'true':
-                if name not in replacements:
-                    replacements[name] = set()
-                replacements[name].add(value)
-            else:
-                if name not in additions:
-                    additions[name] = set()
-                additions[name].add(value)
-    return additions, replacements
-
-def extract_expectations_from_query_params(req):
-    args = extract_numbered_args(EXPECTED_QUERY_ARG_REGEX, req._params)
-
-    expectations = set()
-    for data in args.values():
-        if 'Name' in data:
-            if  'Value' in data:
-                expected_value = data['Value']
-            elif  'Exists' in data:
-                val = data['Exists']
-                expected_value = not (val == 'false')
-            expectations.add((data['Name'], expected_value))
-    
-    return expectations
-
-def extract_deletions_from_query_params(req):
-    args = extract_numbered_args(DELETE_QUERY_ARG_REGEX, req._params)
-    
-    deletions = {}
-    for data in args.values():
-        if 'Name' not in data:
+                    expected_value = exists.get(prefix) != 'false'
+                decoded.expectations.add((attr_name, expected_value))
+                continue
+            elif kind != 'Attribute':
+                continue
+        elif len(parts) == 4:
+            if not batch or parts[0] != 'Item' or parts[2] != 'Attribute':
+                continue
+            item_name = item_names.get('Item.' + parts[1])
+            if item_name is None or not parts[1].isdigit() or not parts[3].isdigit():
+                continue
+        else:
             continue
-    
-        attr_name = data['Name']
-    
-        if attr_name not in deletions:
-            deletions[attr_name] = set()
-    
-        if 'Value' in data:
-            deletions[attr_name].add(data['Value'])
+
+        if deletions:
+            target = decoded.deletions
+            attr_value = values.get(prefix, basicdb.AllAttributes)
+        elif prefix in values:
+            if replace.get(prefix) == 'true':
+                target = decoded.replacements
+            else:
+                target = decoded.additions
+            attr_value = values[prefix]
         else:
-            import basicdb
-            deletions[attr_name].add(basicdb.AllAttributes)
-    return deletions
+            continue
+        if batch:
+            target = target.get(item_name) or target.setdefault(item_name, {})
+        attr_values = target.get(attr_name)
+        if attr_values is None:
+            target[attr_name] = attr_values = set()
+        attr_values.add(attr_value)
+    return decoded
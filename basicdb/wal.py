@@ -0,0 +1,200 @@
+import errno
+import marshal
+import os
+import struct
+import threading
+import zlib
+
+"""
+A write-ahead log with snapshots, for keeping in-memory state durable.
+
+A data directory holds numbered log segments (wal.<n>) and snapshots
+(snapshot.<n>). Snapshot n holds the state as of the start of segment n,
+so recovering means loading the newest intact snapshot and replaying the
+segments from its number onwards. Taking a snapshot starts a new segment,
+and once the snapshot is on disk, older segments and snapshots are
+removed.
+
+Records and snapshots are marshalled and preceded by a header with their
+length and CRC32. Reading a segment stops at the first record that doesn't
+check out, which is where a crash in the middle of a write leaves it.
+"""
+
+_HEADER = struct.Struct('<II')
+
+def _frame(payload):
+    return _HEADER.pack(len(payload), zlib.crc32(payload) & 0xffffffff) + payload
+
+def _read_frames(fp):
+    while True:
+        header = fp.read(_HEADER.size)
+        if len(header) < _HEADER.size:
+            return
+        length, crc = _HEADER.unpack(header)
+        payload = fp.read(length)
+        if len(payload) != length or zlib.crc32(payload) & 0xffffffff != crc:
+            return
+        yield payload
+
+def _fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class WriteAheadLog(object):
+    """Log of records (any marshallable values) in a data directory
+
+    If sync_interval is 0, sync() makes appended records durable before
+    returning, and callers waiting at the same time share a single fsync
+    (group commit). Otherwise a background thread fsyncs the log every
+    sync_interval seconds and sync() returns right away, so a crash can
+    lose that much of the most recent changes."""
+    def __init__(self, data_dir, sync_interval=0):
+        self.data_dir = data_dir
+        self.sync_interval = sync_interval
+        if not os.path.exists(data_dir):
+            os.makedirs(data_dir)
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._fp = None
+        self._segment = None
+        self._seq = 0
+        self._synced = 0
+        self._snapshot_seq = 0
+        self._closed = threading.Event()
+        self._syncer = None
+
+    def _files(self, prefix):
+        numbers = []
+        for filename in os.listdir(self.data_dir):
+            if filename.startswith(prefix + '.'):
+                try:
+                    numbers.append(int(filename[len(prefix) + 1:]))
+                except ValueError:
+                    pass
+        return sorted(numbers)
+
+    def _path(self, prefix, number):
+        return os.path.join(self.data_dir, '%s.%010d' % (prefix, number))
+
+    def recover(self):
+        """Read what's on disk and start a new segment to append to
+
+        Returns the newest snapshot (None if there is none) and an iterator
+        over the records logged after it, in order. The iterator must be
+        consumed before appending anything."""
+        snapshot, start = None, 0
+        for number in reversed(self._files('snapshot')):
+            with open(self._path('snapshot', number), 'rb') as fp:
+                payloads = list(_read_frames(fp))
+            if payloads:
+                snapshot, start = marshal.loads(payloads[0]), number
+                break
+
+        segments = [number for number in self._files('wal') if number >= start]
+        self._open_segment(max(segments + [start]) + 1)
+        if self.sync_interval and self._syncer is None:
+            self._syncer = threading.Thread(target=self._sync_periodically)
+            self._syncer.daemon = True
+            self._syncer.start()
+
+        def records():
+            for number in segments:
+                with open(self._path('wal', number), 'rb') as fp:
+                    for payload in _read_frames(fp):
+                        yield marshal.loads(payload)
+        return snapshot, records()
+
+    def _open_segment(self, number):
+        self._fp = open(self._path('wal', number), 'ab')
+        self._segment = number
+        _fsync_dir(self.data_dir)
+
+    def append(self, record):
+        """Append a record and return its sequence number (for sync())"""
+        data = _frame(marshal.dumps(record, 2))
+        with self._lock:
+            self._fp.write(data)
+            self._seq += 1
+            return self._seq
+
+    def sync(self, seq):
+        """Make sure the record with the given sequence number, and every
+        record before it, is on disk"""
+        if self.sync_interval:
+            return
+        self._sync(seq)
+
+    def _sync(self, seq):
+        with self._sync_lock:
+            if self._synced >= seq:
+                # Someone else's fsync covered it
+                return
+            with self._lock:
+                self._fp.flush()
+                target = self._seq
+                fd = self._fp.fileno()
+            os.fsync(fd)
+            self._synced = target
+
+    def _sync_periodically(self):
+        while not self._closed.wait(self.sync_interval):
+            with self._lock:
+                seq = self._seq
+            if seq > self._synced:
+                self._sync(seq)
+
+    def records_since_snapshot(self):
+        return self._seq - self._snapshot_seq
+
+    def start_snapshot(self, state):
+        """Start a new segment whose starting state is state
+
+        The caller must make sure nothing is appended until this returns.
+        The returned snapshot is then written by passing it to
+        write_snapshot(), which may take a while. state is only serialized
+        then, so it must not change in the meantime either."""
+        with self._sync_lock:
+            with self._lock:
+                self._fp.flush()
+                os.fsync(self._fp.fileno())
+                self._synced = self._seq
+                self._snapshot_seq = self._seq
+                self._fp.close()
+                self._open_segment(self._segment + 1)
+                return self._segment, state
+
+    def write_snapshot(self, snapshot):
+        """Write a snapshot taken by start_snapshot() and remove the files
+        it makes obsolete"""
+        number, state = snapshot
+        path = self._path('snapshot', number)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as fp:
+            fp.write(_frame(marshal.dumps(state, 2)))
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.rename(tmp_path, path)
+        _fsync_dir(self.data_dir)
+
+        for prefix in ('wal', 'snapshot'):
+            for old in self._files(prefix):
+                if old < number:
+                    try:
+                        os.unlink(self._path(prefix, old))
+                    except OSError, e:
+                        if e.errno != errno.ENOENT:
+                            raise
+
+    def close(self):
+        self._closed.set()
+        if self._syncer is not None:
+            self._syncer.join()
+        with self._sync_lock:
+            with self._lock:
+                if self._fp is not None and not self._fp.closed:
+                    self._fp.flush()
+                    os.fsync(self._fp.fileno())
+                    self._fp.close()
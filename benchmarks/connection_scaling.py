@@ -0,0 +1,177 @@
+"""Load test holding many concurrent keep-alive connections to a local
+server, comparing the event-driven front end (basicdb.asyncserver) with a
+basicdb.server worker that has a thread per connection
+
+The server runs the fake backend in a separate process, with a delay added
+to every GetAttributes call to stand in for the I/O wait of the Riak and
+filesystem backends. The client opens the given number of connections and
+sends a number of GetAttributes requests on each, one after the other and
+all connections at once, from a single thread. It reports the requests per
+second, the slowest request and the server's resident set size at the end.
+
+Usage: python benchmarks/connection_scaling.py [connections,...] [requests per connection] [delay ms]
+"""
+import errno
+import os
+import resource
+import select
+import socket
+import subprocess
+import sys
+import time
+
+REQUEST = ('GET /?Action=GetAttributes&DomainName=domain1&ItemName=item1 HTTP/1.1\r\n'
+           'Host: localhost\r\n\r\n')
+
+def serve(mode, port, connections, delay):
+    """Run a server (in the process the benchmark started)"""
+    os.environ.setdefault('REMOTE_USER', 'owner')
+    import basicdb
+    import basicdb.asyncserver
+    import basicdb.server
+    basicdb.asyncserver._raise_fd_limit()
+    backend = basicdb.get_backend()
+    backend.create_domain('owner', 'domain1')
+    backend.put_attributes('owner', 'domain1', 'item1', {'a': set(['1'])}, {})
+    get_attributes = backend.get_attributes
+    def slow_get_attributes(*args):
+        time.sleep(delay)
+        return get_attributes(*args)
+    backend.get_attributes = slow_get_attributes
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('127.0.0.1', port))
+    listener.listen(4096)
+    if mode == 'async':
+        basicdb.asyncserver.AsyncServer(listener, basicdb.app, threads=16,
+                                        queue=64).serve_forever()
+    else:
+        listener.settimeout(basicdb.server.POLL_INTERVAL)
+        worker = basicdb.server.Worker(listener, basicdb.app, threads=connections,
+                                       keepalive=60)
+        worker.start()
+        while True:
+            time.sleep(1)
+
+def rss_kb(pid):
+    with open('/proc/%d/status' % (pid,)) as fp:
+        for line in fp:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+
+class Client(object):
+    """A keep-alive connection sending requests one after the other"""
+    def __init__(self, port, requests):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setblocking(0)
+        err = self.sock.connect_ex(('127.0.0.1', port))
+        if err not in (0, errno.EINPROGRESS):
+            raise socket.error(err, os.strerror(err))
+        self.remaining = requests
+        self.inbuf = ''
+        self.outbuf = REQUEST
+        self.sent_at = None
+        self.slowest = 0
+
+    def on_writable(self):
+        if self.sent_at is None:
+            self.sent_at = time.time()
+        sent = self.sock.send(self.outbuf)
+        self.outbuf = self.outbuf[sent:]
+
+    def on_readable(self):
+        """Returns True once the last response has been read"""
+        data = self.sock.recv(65536)
+        if not data:
+            raise socket.error(errno.ECONNRESET, 'Connection closed by the server')
+        self.inbuf += data
+        end = self.inbuf.find('\r\n\r\n')
+        if end < 0:
+            return False
+        headers = self.inbuf[:end].lower()
+        length = int(headers.split('content-length:')[1].split('\r\n')[0])
+        if len(self.inbuf) < end + 4 + length:
+            return False
+        self.inbuf = self.inbuf[end + 4 + length:]
+        self.slowest = max(self.slowest, time.time() - self.sent_at)
+        self.remaining -= 1
+        if not self.remaining:
+            return True
+        self.outbuf = REQUEST
+        self.sent_at = time.time()
+        return False
+
+def run(mode, connections, requests, delay):
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    server = subprocess.Popen([sys.executable, __file__, '--serve', mode, str(port),
+                               str(connections), str(delay)],
+                              stderr=open(os.devnull, 'w'))
+    try:
+        for i in range(100):
+            try:
+                socket.create_connection(('127.0.0.1', port), 1).close()
+                break
+            except socket.error:
+                time.sleep(0.1)
+        idle_rss = rss_kb(server.pid)
+
+        start = time.time()
+        poller = select.poll()
+        clients = {}
+        for i in range(connections):
+            client = Client(port, requests)
+            clients[client.sock.fileno()] = client
+            poller.register(client.sock, select.POLLOUT)
+        done = 0
+        while done < connections:
+            for fd, event in poller.poll(1000):
+                client = clients[fd]
+                if event & select.POLLOUT:
+                    client.on_writable()
+                    if not client.outbuf:
+                        poller.modify(fd, select.POLLIN)
+                elif event & (select.POLLIN | select.POLLHUP | select.POLLERR):
+                    if client.on_readable():
+                        poller.unregister(fd)
+                        done += 1
+                    elif client.outbuf:
+                        poller.modify(fd, select.POLLOUT)
+        elapsed = time.time() - start
+        rss = rss_kb(server.pid)
+        slowest = max(client.slowest for client in clients.values())
+        for client in clients.values():
+            client.sock.close()
+        return connections * requests / elapsed, slowest, idle_rss, rss
+    finally:
+        server.kill()
+        server.wait()
+
+def main(connection_counts, requests, delay):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    print '%-8s %12s %10s %12s %14s %14s' % ('mode', 'connections', 'req/s', 'slowest s',
+                                           'idle RSS MB', 'loaded RSS MB')
+    for connections in connection_counts:
+        for mode in ('async', 'threads'):
+            try:
+                result = run(mode, connections, requests, delay)
+            except Exception, e:
+                print '%-8s %12d failed (%s: %s)' % (mode, connections,
+                                                     e.__class__.__name__, e)
+                continue
+            req_per_s, slowest, idle_rss, rss = result
+            print '%-8s %12d %10.0f %12.3f %14.1f %14.1f' % (mode, connections, req_per_s,
+                                                           slowest, idle_rss / 1024.0,
+                                                           rss / 1024.0)
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--serve']:
+        serve(sys.argv[2], int(sys.argv[3]), int(sys.argv[4]), float(sys.argv[5]))
+    else:
+        main([int(n) for n in (sys.argv[1] if len(sys.argv) > 1 else '100,1000,4000').split(',')],
+             int(sys.argv[2]) if len(sys.argv) > 2 else 5,
+             float(sys.argv[3]) / 1000 if len(sys.argv) > 3 else 0.005)
@@ -0,0 +1,221 @@
+"""Compares decoding the query params of maximum-size requests with the
+regex-based extract_*() functions below, which basicdb used before, and
+with utils.decode_params()
+
+The requests are a BatchPutAttributes and a BatchDeleteAttributes of 25
+items with 256 attributes each, and a PutAttributes and a DeleteAttributes
+of 256 attributes with an expected value, the most SimpleDB allows. Both ways must decode them to
+the same thing.
+
+Usage: python benchmarks/decode_params.py [repetitions]
+"""
+import re
+import sys
+import time
+
+import basicdb
+from basicdb import utils
+
+ITEMS = 25
+ATTRIBUTES = 256
+
+BATCH_QUERY_REGEX = re.compile(r'Item\.(\d+)\.(.*)')
+PUT_ATTRIBUTE_QUERY_REGEX = re.compile(r'Attribute\.(\d+)\.(Name|Value|Replace)')
+DELETE_QUERY_ARG_REGEX = re.compile(r'Attribute\.(\d+)\.(Name|Value)')
+EXPECTED_QUERY_ARG_REGEX = re.compile(r'Expected\.(\d+)\.(Name|Value|Exists)')
+
+def extract_numbered_args(regex, params):
+    attrs = {}
+    for (k, v) in params.iteritems():
+        match = regex.match(k)
+        if not match:
+            continue
+
+        idx, elem = match.groups()
+        if idx not in attrs:
+            attrs[idx] = {}
+        attrs[idx][elem] = v
+    return attrs
+
+def extract_batch_additions_and_replacements_from_query_params(req):
+    args = extract_numbered_args(BATCH_QUERY_REGEX, req._params)
+
+    additions = {}
+    replacements = {}
+    for data in args.values():
+        if 'ItemName' in data:
+            item_name = data['ItemName']
+            subargs = extract_numbered_args(PUT_ATTRIBUTE_QUERY_REGEX, data)
+            for subdata in subargs.values():
+                if 'Name' in subdata and 'Value' in subdata:
+                    attr_name = subdata['Name']
+                    attr_value = subdata['Value']
+                    if 'Replace' in subdata and subdata['Replace'] == 'true':
+                        if item_name not in replacements:
+                            replacements[item_name] = {}
+                        if attr_name not in replacements[item_name]:
+                            replacements[item_name][attr_name] = set()
+                        replacements[item_name][attr_name].add(attr_value)
+                    else:
+                        if item_name not in additions:
+                            additions[item_name] = {}
+                        if attr_name not in additions[item_name]:
+                            additions[item_name][attr_name] = set()
+                        additions[item_name][attr_name].add(attr_value)
+    return additions, replacements
+
+def extract_batch_deletions_from_query_params(req):
+    args = extract_numbered_args(BATCH_QUERY_REGEX, req._params)
+
+    deletions = {}
+    for data in args.values():
+        if 'ItemName' in data:
+            item_name = data['ItemName']
+            subargs = extract_numbered_args(DELETE_QUERY_ARG_REGEX, data)
+            for subdata in subargs.values():
+                if 'Name' not in subdata:
+                    continue
+
+                attr_name = subdata['Name']
+                if item_name not in deletions:
+                     deletions[item_name] = {}
+                if attr_name not in deletions[item_name]:
+                    deletions[item_name][attr_name] = set()
+
+                if 'Value' in subdata:
+                    deletions[item_name][attr_name].add(subdata['Value'])
+                else:
+                    deletions[item_name][attr_name].add(basicdb.AllAttributes)
+    return deletions
+
+def extract_additions_and_replacements_from_query_params(req):
+    args = extract_numbered_args(PUT_ATTRIBUTE_QUERY_REGEX, req._params)
+
+    additions = {}
+    replacements = {}
+    for idx, data in args.iteritems():
+        if 'Name' in args[idx] and 'Value' in args[idx]:
+            name = args[idx]['Name']
+            value = args[idx]['Value']
+            if 'Replace' in args[idx] and args[idx]['Replace'] == 'true':
+                if name not in replacements:
+                    replacements[name] = set()
+                replacements[name].add(value)
+            else:
+                if name not in additions:
+                    additions[name] = set()
+                additions[name].add(value)
+    return additions, replacements
+
+def extract_expectations_from_query_params(req):
+    args = extract_numbered_args(EXPECTED_QUERY_ARG_REGEX, req._params)
+
+    expectations = set()
+    for data in args.values():
+        if 'Name' in data:
+            if  'Value' in data:
+                expected_value = data['Value']
+            elif  'Exists' in data:
+                val = data['Exists']
+                expected_value = not (val == 'false')
+            expectations.add((data['Name'], expected_value))
+
+    return expectations
+
+def extract_deletions_from_query_params(req):
+    args = extract_numbered_args(DELETE_QUERY_ARG_REGEX, req._params)
+
+    deletions = {}
+    for data in args.values():
+        if 'Name' not in data:
+            continue
+
+        attr_name = data['Name']
+
+        if attr_name not in deletions:
+            deletions[attr_name] = set()
+
+        if 'Value' in data:
+            deletions[attr_name].add(data['Value'])
+        else:
+            deletions[attr_name].add(basicdb.AllAttributes)
+    return deletions
+
+class Request(object):
+    def __init__(self, params):
+        self._params = params
+
+def batch_params():
+    params = {}
+    for i in range(1, ITEMS + 1):
+        params['Item.%d.ItemName' % (i,)] = 'item%d' % (i,)
+        for j in range(1, ATTRIBUTES + 1):
+            params['Item.%d.Attribute.%d.Name' % (i, j)] = 'attr%d' % (j % 64,)
+            params['Item.%d.Attribute.%d.Value' % (i, j)] = 'value%d-%d' % (i, j)
+            if j % 2:
+                params['Item.%d.Attribute.%d.Replace' % (i, j)] = 'true'
+    return params
+
+def put_params():
+    params = {'Expected.1.Name': 'version', 'Expected.1.Value': '3'}
+    for j in range(1, ATTRIBUTES + 1):
+        params['Attribute.%d.Name' % (j,)] = 'attr%d' % (j % 64,)
+        params['Attribute.%d.Value' % (j,)] = 'value%d' % (j,)
+        if j % 2:
+            params['Attribute.%d.Replace' % (j,)] = 'true'
+    return params
+
+def batch_put_old(params):
+    return extract_batch_additions_and_replacements_from_query_params(Request(params))
+
+def batch_put_new(params):
+    decoded = utils.decode_params(params, batch=True)
+    return decoded.additions, decoded.replacements
+
+def batch_delete_old(params):
+    return extract_batch_deletions_from_query_params(Request(params))
+
+def batch_delete_new(params):
+    return utils.decode_params(params, deletions=True, batch=True).deletions
+
+def delete_old(params):
+    return extract_deletions_from_query_params(Request(params))
+
+def delete_new(params):
+    return utils.decode_params(params, deletions=True).deletions
+
+def put_old(params):
+    req = Request(params)
+    additions, replacements = extract_additions_and_replacements_from_query_params(req)
+    return additions, replacements, extract_expectations_from_query_params(req)
+
+def put_new(params):
+    decoded = utils.decode_params(params)
+    return decoded.additions, decoded.replacements, decoded.expectations
+
+CASES = [('BatchPutAttributes', batch_params(), batch_put_old, batch_put_new),
+         ('BatchDeleteAttributes', batch_params(), batch_delete_old, batch_delete_new),
+         ('PutAttributes', put_params(), put_old, put_new),
+         ('DeleteAttributes', put_params(), delete_old, delete_new)]
+
+def timed(decode, params, repetitions):
+    best = None
+    for i in range(repetitions):
+        start = time.time()
+        decode(params)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def main(repetitions):
+    print '%-22s %8s %12s %12s %8s' % ('request', 'params', 'regex ms', 'single ms', 'speedup')
+    for name, params, old, new in CASES:
+        assert old(params) == new(params)
+        old_time = timed(old, params, repetitions)
+        new_time = timed(new, params, repetitions)
+        print '%-22s %8d %12.3f %12.3f %7.1fx' % (name, len(params), old_time * 1000,
+                                                  new_time * 1000, old_time / new_time)
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20)
@@ -0,0 +1,63 @@
+"""Measures the memory used per item by the fake backend's storage modes
+
+Each item gets the same 6 attribute names. 4 of them are single-valued
+and 2 have 3 values; values repeat across items the way enum-like values
+do. Each mode runs in a separate process, and the growth of its resident
+set size is divided by the number of items. Indexing is off by default so
+only item storage is measured.
+
+Usage: python benchmarks/fake_memory.py [item count] [index]
+"""
+import gc
+import resource
+import subprocess
+import sys
+import time
+
+def rss_bytes():
+    with open('/proc/self/statm') as fp:
+        pages = int(fp.read().split()[1])
+    return pages * resource.getpagesize()
+
+def item_attrs(i):
+    attrs = {'status': set(['status%d' % (i % 5,)]),
+             'owner': set(['user%d' % (i % 1000,)]),
+             'created': set(['2013-%02d-%02d' % (i % 12 + 1, i % 28 + 1)]),
+             'size': set([str(i)])}
+    attrs['tags'] = set('tag%d' % ((i + k) % 50,) for k in range(3))
+    attrs['groups'] = set('group%d' % ((i * 7 + k) % 20,) for k in range(3))
+    return attrs
+
+def measure(storage, count, index):
+    import basicdb.backends.fake
+    import basicdb.sqlparser
+    backend = basicdb.backends.fake.driver(index=index, storage=storage)
+    backend.create_domain('owner', 'domain1')
+    gc.collect()
+    before = rss_bytes()
+    start = time.time()
+    for i in xrange(count):
+        backend.batch_put_attributes('owner', 'domain1', {'item%d' % (i,): item_attrs(i)}, {})
+    elapsed = time.time() - start
+    gc.collect()
+    used = rss_bytes() - before
+
+    parsed = basicdb.sqlparser.parse(
+        "select * from domain1 where status = 'status3' and tags = 'tag8'")
+    start = time.time()
+    matches = len(list(backend.select_iter('owner', parsed)))
+    select = time.time() - start
+    print '%-8s %14.0f %14.0f %14.3f %8d' % (storage, float(used) / count, count / elapsed,
+                                            select, matches)
+
+def main(count, index):
+    print '%-8s %14s %14s %14s %8s' % ('storage', 'bytes/item', 'puts/s', 'select s', 'matches')
+    for storage in ('dicts', 'compact'):
+        subprocess.check_call([sys.executable, __file__, '--measure', storage, str(count), index])
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--measure']:
+        measure(sys.argv[2], int(sys.argv[3]), sys.argv[4])
+    else:
+        main(int(float(sys.argv[1])) if len(sys.argv) > 1 else 200000,
+             sys.argv[2] if len(sys.argv) > 2 else 'none')
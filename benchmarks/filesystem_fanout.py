@@ -0,0 +1,56 @@
+"""Measures how long a Select has to scan a large filesystem domain with
+and without hashed directory fan-out
+
+Items are written with the packed layout, one small attribute each.
+
+Usage: python benchmarks/filesystem_fanout.py [item count] [fanout ...]
+"""
+import shutil
+import sys
+import tempfile
+import time
+
+import basicdb.backends.filesystem
+import basicdb.sqlparser
+
+def run(backend, count):
+    backend.create_domain('owner', 'domain1')
+    start = time.time()
+    for i in xrange(count):
+        backend.put_attributes('owner', 'domain1', 'item%d' % (i,), {'a': set([str(i % 1000)])}, {})
+    populate = time.time() - start
+
+    parsed = basicdb.sqlparser.parse("select * from domain1 where a = '7'")
+    start = time.time()
+    matches = len(list(backend.select_iter('owner', parsed)))
+    select = time.time() - start
+    assert matches == count // 1000 + (count % 1000 > 7)
+
+    parsed = basicdb.sqlparser.parse("select count(*) from domain1")
+    start = time.time()
+    assert backend.count('owner', parsed) == count
+    listing = time.time() - start
+
+    start = time.time()
+    for i in xrange(0, count, max(count // 10000, 1)):
+        backend.get_attributes('owner', 'domain1', 'item%d' % (i,))
+    lookup = (time.time() - start) / min(count, 10000)
+    return populate, select, listing, lookup
+
+def main(count, fanouts):
+    print '%-8s %12s %12s %12s %12s' % ('fanout', 'populate s', 'select s', 'count(*) s',
+                                        'get us')
+    for fanout in fanouts:
+        base_dir = tempfile.mkdtemp()
+        try:
+            backend = basicdb.backends.filesystem.driver(base_dir, 'packed', fanout)
+            populate, select, listing, lookup = run(backend, count)
+            print '%-8d %12.1f %12.2f %12.2f %12.1f' % (fanout, populate, select, listing,
+                                                        lookup * 1e6)
+        finally:
+            shutil.rmtree(base_dir)
+
+if __name__ == '__main__':
+    count = int(float(sys.argv[1])) if len(sys.argv) > 1 else 1000000
+    fanouts = [int(arg) for arg in sys.argv[2:]] or [0, 2]
+    main(count, fanouts)
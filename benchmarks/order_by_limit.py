@@ -0,0 +1,51 @@
+"""Compares the ordering stage of Select for ORDER BY ... DESC LIMIT 20
+
+The old implementation sorted every (value, item name) pair and then
+removed adjacent duplicates before slicing. sort_items keeps a bounded heap
+of the best items instead.
+
+Usage: python benchmarks/order_by_limit.py [item count ...]
+"""
+import random
+import sys
+import time
+
+import basicdb.backends
+
+def full_sort(items, key, reverse, limit):
+    order = []
+    for item_name, item_attrs in items.iteritems():
+        for val in item_attrs[key]:
+            order.append((val, item_name))
+    order.sort(key=lambda x:x[0], reverse=reverse)
+    order = map(lambda x:x[1], order)
+    prev = [None]
+    def remove_if_same_as_previous(x):
+        retval = x != prev[0]
+        prev[0] = x
+        return retval
+    order = filter(remove_if_same_as_previous, order)
+    return order[:limit]
+
+def make_items(count):
+    rnd = random.Random(count)
+    return dict(('item%d' % (i,),
+                 {'ts': set('%012d' % (rnd.randint(0, 10 ** 12),)
+                            for _ in range(rnd.randint(1, 3)))})
+                for i in xrange(count))
+
+def timed(f, *args):
+    start = time.time()
+    f(*args)
+    return time.time() - start
+
+def main(counts):
+    print '%10s %12s %12s %8s' % ('items', 'full sort', 'top-k heap', 'speedup')
+    for count in counts:
+        items = make_items(count)
+        old = timed(full_sort, items, 'ts', True, 20)
+        new = timed(basicdb.backends.sort_items, items.iteritems(), 'ts', True, 20)
+        print '%10d %11.3fs %11.3fs %7.1fx' % (count, old, new, old / new)
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or [10 ** 5, 10 ** 6])
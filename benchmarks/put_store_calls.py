@@ -0,0 +1,136 @@
+"""Counts the storage operations a PutAttributes and a DeleteAttributes
+call turn into, with each backend's own put_attributes and
+delete_attributes and with the generic ones in StorageBackend that go
+through add_attribute_value and friends
+
+Each item first gets 5 attributes with 4 values each, then 2 of its
+attributes are replaced with 4 new values each, and finally one attribute
+is deleted and one value of another. Storage operations are log records
+for the fake backend, files and directories written, created or removed
+for the filesystem backend and objects stored for the Riak backend, which
+is only included if the riak package is installed and a Riak node is
+running on localhost. The directories layout of the filesystem backend
+keeps a file per value, so it can only avoid redundant operations, while
+the other backends store each item once per call.
+
+Usage: python benchmarks/put_store_calls.py [item count]
+"""
+import __builtin__
+import os
+import shutil
+import sys
+import tempfile
+
+import basicdb
+import basicdb.backends
+import basicdb.backends.fake
+import basicdb.backends.filesystem
+
+class Counter(object):
+    def __init__(self):
+        self.count = 0
+        self._patched = []
+
+    def wrap(self, obj, name):
+        original = getattr(obj, name)
+        def wrapper(*args, **kwargs):
+            self.count += 1
+            return original(*args, **kwargs)
+        self._patched.append((obj, name, original))
+        setattr(obj, name, wrapper)
+
+    def restore(self):
+        for obj, name, original in reversed(self._patched):
+            setattr(obj, name, original)
+
+def fake(tmp_dir):
+    backend = basicdb.backends.fake.driver(data_dir=tmp_dir)
+    counter = Counter()
+    counter.wrap(backend._wal, 'append')
+    return backend, counter
+
+def filesystem(layout):
+    def setup(tmp_dir):
+        backend = basicdb.backends.filesystem.driver(base_dir=tmp_dir, layout=layout, fanout=0)
+        counter = Counter()
+        counter.wrap(__builtin__, 'file')
+        counter.wrap(__builtin__, 'open')
+        for name in ('mkdir', 'rmdir', 'unlink', 'remove', 'rename'):
+            counter.wrap(os, name)
+        return backend, counter
+    return setup
+
+def riak(tmp_dir):
+    import riak
+    import basicdb.backends.riak
+    backend = basicdb.backends.riak.driver(base_bucket='benchmark%s' % (os.path.basename(tmp_dir),))
+    counter = Counter()
+    counter.wrap(riak.RiakObject, 'store')
+    return backend, counter
+
+BACKENDS = [('fake', fake),
+            ('filesystem', filesystem('directories')),
+            ('fs-packed', filesystem('packed')),
+            ('riak', riak)]
+
+def additions(i):
+    return dict(('attr%d' % (j,), set('value%d-%d' % (i, k) for k in range(4)))
+                for j in range(5))
+
+def replacements(i):
+    return dict(('attr%d' % (j,), set('new%d-%d' % (i, k) for k in range(4)))
+                for j in range(2))
+
+def deletions(i):
+    return {'attr2': set([basicdb.AllAttributes]),
+            'attr3': set(['value%d-0' % (i,)])}
+
+def run(setup, count, generic):
+    """Returns the number of storage operations per put and per delete"""
+    if generic:
+        put = lambda backend, *args: basicdb.backends.StorageBackend.put_attributes(backend, *args)
+        delete = lambda backend, *args: basicdb.backends.StorageBackend.delete_attributes(backend, *args)
+    else:
+        put = lambda backend, *args: backend.put_attributes(*args)
+        delete = lambda backend, *args: backend.delete_attributes(*args)
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        backend, counter = setup(tmp_dir)
+        try:
+            backend.create_domain('owner', 'domain1')
+            counter.count = 0
+            for i in xrange(count):
+                put(backend, 'owner', 'domain1', 'item%d' % (i,), additions(i), {})
+                put(backend, 'owner', 'domain1', 'item%d' % (i,), {}, replacements(i))
+            puts = counter.count
+            counter.count = 0
+            for i in xrange(count):
+                delete(backend, 'owner', 'domain1', 'item%d' % (i,), deletions(i))
+            deletes = counter.count
+            expected = additions(0)
+            basicdb.backends.apply_changes(expected, {}, replacements(0), deletions(0))
+            assert backend.get_attributes('owner', 'domain1', 'item0') == expected
+        finally:
+            counter.restore()
+            if hasattr(backend, 'close'):
+                backend.close()
+        return float(puts) / (count * 2), float(deletes) / count
+    finally:
+        shutil.rmtree(tmp_dir)
+
+def main(count):
+    print '%-12s %14s %14s %14s %14s' % ('backend', 'generic put', 'native put',
+                                         'generic delete', 'native delete')
+    for name, setup in BACKENDS:
+        try:
+            generic = run(setup, count, True)
+            native = run(setup, count, False)
+        except Exception, e:
+            print '%-12s skipped (%s: %s)' % (name, e.__class__.__name__, e)
+            continue
+        print '%-12s %14.1f %14.1f %14.1f %14.1f' % (name, generic[0], native[0],
+                                                     generic[1], native[1])
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100)
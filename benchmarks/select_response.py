@@ -0,0 +1,75 @@
+"""Compares building a Select response as an element tree, the way all
+responses used to be built, with streaming it as the items are produced
+
+Each item has 5 attributes with 2 values each. Each mode runs in a separate
+process against the fake backend, and reports the time until the first
+piece of the response is ready, the time until the whole response has been
+produced, and how much the peak resident set size grew while doing so.
+
+Usage: python benchmarks/select_response.py [item count]
+"""
+import resource
+import subprocess
+import sys
+import time
+import uuid
+import xml.etree.cElementTree as etree
+
+def tree_response(backend, expr, start_time):
+    order, results = backend.select_wrapper('owner', expr)
+    dom = etree.Element("SelectResponse")
+    result = etree.SubElement(dom, "SelectResult")
+    for item_name in order:
+        item_elem = etree.SubElement(result, "Item")
+        etree.SubElement(item_elem, "Name").text = item_name
+        for attr_name, attr_values in results[item_name].iteritems():
+            for attr_value in attr_values:
+                attr_elem = etree.SubElement(item_elem, "Attribute")
+                etree.SubElement(attr_elem, "Name").text = attr_name
+                etree.SubElement(attr_elem, "Value").text = attr_value
+    metadata = etree.SubElement(dom, "ResponseMetadata")
+    etree.SubElement(metadata, "RequestId").text = str(uuid.uuid4())
+    etree.SubElement(metadata, "BoxUsage").text = str(time.time() - start_time)
+    return [etree.tostring(dom)]
+
+def stream_response(backend, expr, start_time):
+    from basicdb import responses
+    items = backend.select_items('owner', expr)
+    return responses.stream('SelectResponse', responses.items_xml(items),
+                            responses.request_id(), start_time)
+
+def measure(mode, count):
+    import basicdb.backends.fake
+    backend = basicdb.backends.fake.driver()
+    backend.create_domain('owner', 'domain1')
+    for i in xrange(count):
+        backend.batch_put_attributes('owner', 'domain1', {
+            'item%d' % (i,): dict(('attr%d' % (j,), set(['value%d-%d-%d' % (i, j, k)
+                                                         for k in range(2)]))
+                                  for j in range(5))}, {})
+
+    response = {'tree': tree_response, 'stream': stream_response}[mode]
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    first_byte = None
+    size = 0
+    for piece in response(backend, 'select * from domain1', start):
+        if first_byte is None:
+            first_byte = time.time() - start
+        size += len(piece)
+    elapsed = time.time() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before
+    print '%-8s %14.3f %14.3f %14.1f %14.1f' % (mode, first_byte, elapsed,
+                                                peak / 1024.0, size / 1048576.0)
+
+def main(count):
+    print '%-8s %14s %14s %14s %14s' % ('mode', 'first byte s', 'total s',
+                                        'peak grew MB', 'response MB')
+    for mode in ('tree', 'stream'):
+        subprocess.check_call([sys.executable, __file__, '--measure', mode, str(count)])
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--measure']:
+        measure(sys.argv[2], int(sys.argv[3]))
+    else:
+        main(int(float(sys.argv[1])) if len(sys.argv) > 1 else 50000)
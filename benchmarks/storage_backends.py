@@ -0,0 +1,58 @@
+"""Compares put, get and select throughput of the on-disk backends
+
+Each item gets 5 attributes with 4 values each, written with one
+PutAttributes call.
+
+Usage: python benchmarks/storage_backends.py [item count]
+"""
+import shutil
+import sys
+import tempfile
+import time
+
+import basicdb.backends.filesystem
+import basicdb.backends.logstructured
+import basicdb.sqlparser
+
+BACKENDS = [('filesystem', lambda base_dir: basicdb.backends.filesystem.driver(base_dir, 'directories')),
+            ('fs-packed', lambda base_dir: basicdb.backends.filesystem.driver(base_dir, 'packed')),
+            ('logstructured', basicdb.backends.logstructured.driver)]
+
+def item_attrs(i):
+    return dict(('attr%d' % (j,), set('value%d-%d' % (i % 100, k) for k in range(4)))
+                for j in range(5))
+
+def run(backend, count):
+    backend.create_domain('owner', 'domain1')
+    timings = []
+
+    start = time.time()
+    for i in xrange(count):
+        backend.put_attributes('owner', 'domain1', 'item%d' % (i,), item_attrs(i), {})
+    timings.append(time.time() - start)
+
+    start = time.time()
+    for i in xrange(count):
+        backend.get_attributes('owner', 'domain1', 'item%d' % (i,))
+    timings.append(time.time() - start)
+
+    parsed = basicdb.sqlparser.parse("select * from domain1 where attr3 = 'value7-2'")
+    start = time.time()
+    matches = len(list(backend.select_iter('owner', parsed)))
+    timings.append(time.time() - start)
+    assert matches == count // 100 + (count % 100 > 7)
+    return timings
+
+def main(count):
+    print '%-14s %14s %14s %14s' % ('backend', 'put/s', 'get/s', 'select items/s')
+    for name, driver in BACKENDS:
+        base_dir = tempfile.mkdtemp()
+        try:
+            backend = driver(base_dir=base_dir)
+            put, get, select = run(backend, count)
+            print '%-14s %14.0f %14.0f %14.0f' % (name, count / put, count / get, count / select)
+        finally:
+            shutil.rmtree(base_dir)
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
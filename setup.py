@@ -28,4 +28,11 @@ setup(
     packages=find_packages(),
     include_package_data=True,
     license='Apache 2.0',
-    keywords='basicdb simpledb')
+    keywords='basicdb simpledb',
+    entry_points={
+        'console_scripts': [
+            'basicdb-filesystem-migrate = basicdb.backends.filesystem:main',
+            'basicdb-server = basicdb.server:main',
+            'basicdb-async-server = basicdb.asyncserver:main',
+        ],
+    })